@@ -0,0 +1,59 @@
+import torch, time, argparse, collections, functools, sys
+from m3p2i_aip.utils import scenario_utils
+
+# Counts the tensor constructor calls of steady-state planner ticks, which must be zero. The random number draws of
+# the samplers that draw fresh samples at every tick (random, sobol, colored) are reported apart. With --top_trajs the
+# top trajectories are read after every tick, as for the visualization, which constructs tensors and is not checked.
+# The mean tick time is reported with them
+parser = argparse.ArgumentParser(prog='Allocation check', description='pass args')
+parser.add_argument('--robot', type=str, default='point_robot', help='point_robot, heijn or boxer')
+parser.add_argument('--K', type=int, default=200, help='Number of samples')
+parser.add_argument('--B', type=int, default=1, help='Number of problems, uses command_batch if > 1')
+parser.add_argument('--sample_method', type=str, default='sobol', help='sobol, random, colored or halton (needs ghalton)')
+parser.add_argument('--top_trajs', action='store_true', help='Read the top trajectories after every tick')
+parser.add_argument('--warmup', type=int, default=3, help='Ticks before counting')
+parser.add_argument('--ticks', type=int, default=20, help='Counted ticks')
+args = parser.parse_args()
+
+constructors = ['tensor', 'as_tensor', 'zeros', 'ones', 'empty', 'full', 'arange', 'eye', 'rand', 'randn',
+                'zeros_like', 'ones_like', 'empty_like', 'full_like', 'rand_like', 'randn_like']
+counts = collections.Counter()
+counting = False
+
+def hook(name, fn):
+    @functools.wraps(fn)
+    def wrapper(*a, **kw):
+        if counting:
+            counts[name] += 1
+        return fn(*a, **kw)
+    return wrapper
+
+for name in constructors:
+    setattr(torch, name, hook(name, getattr(torch, name)))
+
+params = scenario_utils.make_params(args.robot, num_envs=args.K)
+planner = scenario_utils.make_planner(params, sample_method=args.sample_method)
+state = scenario_utils.initial_state(params)
+if args.B > 1:
+    state = state.repeat(args.B, 1)
+    planner.update_task('navigation', torch.tensor([3., 3.]).repeat(args.B, 1))
+command = planner.command_batch if args.B > 1 else planner.command
+
+def tick():
+    command(state)
+    if args.top_trajs:
+        planner.top_trajs
+
+for _ in range(args.warmup):
+    tick()
+counting = True
+start_time = time.monotonic()
+for _ in range(args.ticks):
+    tick()
+tick_ms = (time.monotonic() - start_time) / args.ticks * 1000
+counting = False
+
+draws = {name: counts.pop(name) for name in ['rand', 'randn'] if name in counts}
+print("Tensor constructions in", args.ticks, "steady-state ticks:", dict(counts) if counts else 0,
+      "| random draws:", draws if draws else 0, "| tick", format(tick_ms, '.2f'), "ms")
+sys.exit(1 if counts and not args.top_trajs else 0)
@@ -0,0 +1,39 @@
+import torch, time, argparse
+import numpy as np
+from m3p2i_aip.utils import scenario_utils
+
+# Closed-loop analytic navigation with and without a per-tick deadline: tick times, evaluated samples and goal distance
+parser = argparse.ArgumentParser(prog='Anytime benchmark', description='pass args')
+parser.add_argument('--robot', type=str, default='point_robot', help='point_robot, heijn or boxer')
+parser.add_argument('--K', type=int, default=1000, help='Number of samples')
+parser.add_argument('--T', type=int, default=15, help='Horizon')
+parser.add_argument('--sample_method', type=str, default='sobol', help='sobol, random, colored or halton (needs ghalton)')
+parser.add_argument('--control_variate', action='store_true', help='Mean update with the control variate')
+parser.add_argument('--deadlines', type=float, nargs='+', default=[0.002, 0.005, 0.02], help='Deadlines in seconds')
+parser.add_argument('--ticks', type=int, default=80, help='Closed-loop ticks')
+args = parser.parse_args()
+torch.set_num_threads(1)
+
+def run(deadline):
+    params = scenario_utils.make_params(args.robot, num_envs=args.K, horizon=args.T)
+    planner = scenario_utils.make_planner(params, sample_method=args.sample_method, anytime=deadline is not None)
+    planner.control_variate = args.control_variate
+    state = scenario_utils.initial_state(params)
+    goal = planner.nav_goal
+    planner.command(state, deadline) # warmup
+
+    tick_times, samples = [], []
+    for _ in range(args.ticks):
+        start_time = time.monotonic()
+        action = planner.command(state, deadline)
+        tick_times.append(time.monotonic() - start_time)
+        samples.append(planner.samples_evaluated)
+        state = planner.F(state.unsqueeze(0), action[:1])[0][0]
+    dist = torch.linalg.norm(state[[0, 2]] - goal).item()
+    return np.array(tick_times) * 1000, np.mean(samples), dist
+
+for deadline in [None] + args.deadlines:
+    tick_ms, samples, dist = run(deadline)
+    print("deadline", "none" if deadline is None else format(deadline * 1000, 'g') + " ms",
+          "| tick mean", format(tick_ms.mean(), '.2f'), "ms, p95", format(np.percentile(tick_ms, 95), '.2f'), "ms, max",
+          format(tick_ms.max(), '.2f'), "ms | samples/tick", format(samples, '.0f'), "| goal distance", format(dist, '.3f'))
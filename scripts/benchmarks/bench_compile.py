@@ -0,0 +1,46 @@
+import torch, time, argparse
+from m3p2i_aip.utils import scenario_utils
+
+# Ticks per second of the analytic navigation planner with eager and scripted rollouts, and the largest difference
+# of the rollout costs of the same samples
+parser = argparse.ArgumentParser(prog='Compile benchmark', description='pass args')
+parser.add_argument('--robot', type=str, default='point_robot', help='point_robot, heijn or boxer')
+parser.add_argument('--K', type=int, nargs='+', default=[50, 200, 1000], help='Number of samples')
+parser.add_argument('--T', type=int, default=15, help='Horizon')
+parser.add_argument('--sample_method', type=str, default='sobol', help='sobol, random, colored or halton (needs ghalton)')
+parser.add_argument('--ticks', type=int, default=100, help='Timed ticks')
+args = parser.parse_args()
+torch.set_num_threads(1)
+
+def make(K, compile_rollouts):
+    params = scenario_utils.make_params(args.robot, num_envs=K, horizon=args.T)
+    planner = scenario_utils.make_planner(params, sample_method=args.sample_method)
+    planner.compile_rollouts = compile_rollouts
+    return planner, scenario_utils.initial_state(params)
+
+def run(K, compile_rollouts):
+    planner, state = make(K, compile_rollouts)
+    # The first tick allocates the workspace
+    planner.command(state)
+    start_time = time.monotonic()
+    for _ in range(args.ticks):
+        planner.command(state)
+    return args.ticks / (time.monotonic() - start_time)
+
+def cost_difference(K):
+    torch.manual_seed(0)
+    eager, state = make(K, False)
+    scripted, _ = make(K, True)
+    eager.state, scripted.state = state, state
+    actions = torch.randn(K, args.T, eager.nu)
+    eager._get_workspace(K)
+    scripted._get_workspace(K)
+    eager_cost = eager._compute_rollout_costs(actions.clone())[0].clone()
+    scripted_cost = scripted._compute_rollout_costs(actions.clone())[0]
+    return torch.max(torch.abs(eager_cost - scripted_cost)).item()
+
+for K in args.K:
+    eager_tps = run(K, False)
+    scripted_tps = run(K, True)
+    print("K", K, "| eager", format(eager_tps, '.1f'), "ticks/s | scripted", format(scripted_tps, '.1f'),
+          "ticks/s | speedup", format(scripted_tps/eager_tps, '.2f'), "| max cost difference", format(cost_difference(K), '.2e'))
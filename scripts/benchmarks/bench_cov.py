@@ -0,0 +1,34 @@
+import torch, argparse
+from m3p2i_aip.utils import scenario_utils
+
+# Scripted analytic push of a block to the origin: success rate over several start states for a range of sample counts,
+# with a fixed or an adapted diagonal covariance. The smallest K with the target success rate is reported
+parser = argparse.ArgumentParser(prog='Covariance adaptation benchmark', description='pass args')
+parser.add_argument('--Ks', type=int, nargs='+', default=[25, 50, 100, 200, 400], help='Sample counts')
+parser.add_argument('--T', type=int, default=15, help='Horizon')
+parser.add_argument('--sample_method', type=str, default='sobol', help='sobol, random or halton (needs ghalton)')
+parser.add_argument('--multi_modal', action='store_true', help='Multi-modal M3P2I, two modes')
+parser.add_argument('--ticks', type=int, default=300, help='Closed-loop ticks per episode')
+parser.add_argument('--tol', type=float, default=0.15, help='Block to goal distance counted as success')
+parser.add_argument('--success', type=float, default=1., help='Required success rate')
+args = parser.parse_args()
+torch.set_num_threads(1)
+
+def episode(K, update_cov, robot_start, block_start):
+    params = scenario_utils.make_push_params(K, args.T)
+    planner = scenario_utils.make_push_planner(params, sample_method=args.sample_method, multi_modal=args.multi_modal)
+    planner.update_cov = update_cov
+    success, ticks, _ = scenario_utils.push_episode(planner, params, robot_start, block_start, args.ticks, args.tol)
+    return success, ticks
+
+for update_cov in [False, True]:
+    min_K = None
+    for K in args.Ks:
+        results = [episode(K, update_cov, *start) for start in scenario_utils.push_starts]
+        rate = sum(success for success, _ in results) / len(results)
+        ticks = [tick for success, tick in results if success]
+        print("update_cov", update_cov, "| K", K, "| success", format(rate, '.2f'),
+              "| mean ticks", format(sum(ticks) / len(ticks), '.1f') if ticks else "-")
+        if min_K is None and rate >= args.success:
+            min_K = K
+    print("update_cov", update_cov, "| samples needed", min_K if min_K is not None else "more than " + str(args.Ks[-1]))
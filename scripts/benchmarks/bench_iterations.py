@@ -0,0 +1,53 @@
+import torch, argparse
+from m3p2i_aip.utils import scenario_utils
+
+# Sharp goal switch in analytic navigation: rollouts needed until the planned mean trajectory reaches a cost level,
+# with more samples per pass or with more inner iterations per tick. The robot state is held at the switch
+parser = argparse.ArgumentParser(prog='Inner iterations benchmark', description='pass args')
+parser.add_argument('--robot', type=str, default='point_robot', help='point_robot, heijn or boxer')
+parser.add_argument('--K', type=int, default=200, help='Number of samples per pass')
+parser.add_argument('--T', type=int, default=15, help='Horizon')
+parser.add_argument('--sample_method', type=str, default='sobol', help='sobol, random, colored or halton (needs ghalton)')
+parser.add_argument('--switch', type=int, default=20, help='Tick of the goal switch')
+parser.add_argument('--ticks', type=int, default=60, help='Ticks after the switch')
+parser.add_argument('--level', type=float, default=1.05, help='Cost level relative to the best plan found by any run')
+args = parser.parse_args()
+torch.set_num_threads(1)
+
+goal_1, goal_2 = (3., 3.), (-3., 1.)
+
+def plan_cost(planner, state, plan, goal):
+    # Undiscounted distance to the goal along the plan
+    state, cost = state.unsqueeze(0), 0
+    for t in range(plan.shape[0]):
+        state, _ = planner.F(state, plan[t:t+1])
+        cost += torch.linalg.norm(state[0, [0, 2]] - goal).item()
+    return cost
+
+def run(K, num_iterations):
+    torch.manual_seed(0)
+    params = scenario_utils.make_params(args.robot, num_envs=K, horizon=args.T)
+    planner = scenario_utils.make_planner(params, goal=goal_1, sample_method=args.sample_method)
+    state = scenario_utils.initial_state(params)
+    for _ in range(args.switch):
+        action = planner.command(state)
+        state = planner.F(state.unsqueeze(0), action[:1])[0][0]
+
+    goal = torch.tensor(goal_2, **params.tensor_args)
+    planner.update_task('navigation', goal)
+    planner.num_iterations = num_iterations
+    costs, rollouts = [], []
+    for _ in range(args.ticks):
+        planner.command(state)
+        costs.append(plan_cost(planner, state, planner.mean_action, goal))
+        rollouts.append(K * planner.iterations + (rollouts[-1] if rollouts else 0))
+    return costs, rollouts
+
+configs = [(args.K, 1), (2 * args.K, 1), (4 * args.K, 1), (args.K, 2), (args.K, 4), (args.K, 8)]
+results = [run(K, num_iterations) for K, num_iterations in configs]
+level = args.level * min(min(costs) for costs, _ in results)
+print("cost level", format(level, '.3f'))
+for (K, num_iterations), (costs, rollouts) in zip(configs, results):
+    reached = [i for i, c in enumerate(costs) if c <= level]
+    summary = "ticks {} | rollouts {}".format(reached[0] + 1, rollouts[reached[0]]) if reached else "not reached"
+    print("K", K, "| max iterations", num_iterations, "|", summary, "| final cost", format(costs[-1], '.3f'))
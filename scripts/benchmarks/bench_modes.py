@@ -0,0 +1,40 @@
+import torch, argparse
+from m3p2i_aip.utils import scenario_utils
+
+# Scripted analytic hybrid push/pull of a block to the origin with multi-modal M3P2I: success rate over several start
+# states for a range of total sample counts, with equal or adaptive samples per mode. The modes have different costs,
+# and PointPushDynamics has no suction, so only the push modes can move the block and the samples of the pull modes
+# are wasted. The smallest K with the target success rate is reported, and the mean tick time
+parser = argparse.ArgumentParser(prog='Mode allocation benchmark', description='pass args')
+parser.add_argument('--Ks', type=int, nargs='+', default=[6, 9, 12, 18, 30], help='Total sample counts')
+parser.add_argument('--modes', type=str, nargs='+', default=['push', 'pull', 'pull'], help='Skill of every mode, push or pull')
+parser.add_argument('--sample_method', type=str, default='sobol', help='sobol, random, colored or halton (needs ghalton)')
+parser.add_argument('--T', type=int, default=15, help='Horizon')
+parser.add_argument('--ticks', type=int, default=300, help='Closed-loop ticks per episode')
+parser.add_argument('--tol', type=float, default=0.15, help='Block to goal distance counted as success')
+parser.add_argument('--success', type=float, default=1., help='Required success rate')
+args = parser.parse_args()
+torch.set_num_threads(1)
+
+def episode(K, adaptive, robot_start, block_start):
+    params = scenario_utils.make_push_params(K, args.T)
+    planner = scenario_utils.make_push_planner(params, sample_method=args.sample_method, multi_modal=True)
+    planner.hybrid_modes = args.modes
+    planner.update_task('hybrid', torch.tensor([0., 0.], **params.tensor_args))
+    planner.adaptive_modes = adaptive
+    success, ticks, tick_time = scenario_utils.push_episode(planner, params, robot_start, block_start, args.ticks, args.tol)
+    return success, ticks, planner.mode_counts, tick_time
+
+for adaptive in [False, True]:
+    min_K = None
+    for K in args.Ks:
+        results = [episode(K, adaptive, *start) for start in scenario_utils.push_starts]
+        rate = sum(success for success, _, _, _ in results) / len(results)
+        ticks = [tick for success, tick, _, _ in results if success]
+        print("adaptive", adaptive, "| K", K, "| success", format(rate, '.2f'),
+              "| mean ticks", format(sum(ticks) / len(ticks), '.1f') if ticks else "-",
+              "| tick", format(1000 * sum(t for _, _, _, t in results) / len(results), '.1f'), "ms",
+              "| final samples per mode", [counts for _, _, counts, _ in results])
+        if min_K is None and rate >= args.success:
+            min_K = K
+    print("adaptive", adaptive, "| samples needed", min_K if min_K is not None else "more than " + str(args.Ks[-1]))
@@ -0,0 +1,40 @@
+import torch, argparse
+import numpy as np
+from m3p2i_aip.utils import scenario_utils
+
+# Scripted analytic push of a block to the origin with white, colored and spline samples, in the simple and the
+# halton-spline modes: achieved cost (the push distance cost summed over the executed ticks) and success rate for a
+# range of sample counts
+parser = argparse.ArgumentParser(prog='Colored noise benchmark', description='pass args')
+parser.add_argument('--Ks', type=int, nargs='+', default=[25, 50, 100, 200, 400], help='Sample counts')
+parser.add_argument('--beta', type=float, nargs='+', default=[2.], help='Colored noise exponent, one or one per action dimension')
+parser.add_argument('--T', type=int, default=15, help='Horizon')
+parser.add_argument('--spline_method', type=str, default='sobol', help='Spline sampler compared with the noise, sobol or halton (needs ghalton)')
+parser.add_argument('--no_sobol_shift', action='store_true', help='Keep the sobol points fixed instead of shifting them at every tick')
+parser.add_argument('--ticks', type=int, default=300, help='Closed-loop ticks per episode')
+parser.add_argument('--tol', type=float, default=0.15, help='Block to goal distance counted as success')
+parser.add_argument('--no_filter', action='store_true', help='Do not smooth the commands with the Savitzky-Golay filter')
+args = parser.parse_args()
+torch.set_num_threads(1)
+
+samplers = [('simple', 'random'), ('simple', 'colored'), ('halton-spline', 'random'), ('halton-spline', 'colored'),
+            ('halton-spline', args.spline_method)]
+
+def episode(K, mppi_mode, sample_method, robot_start, block_start):
+    params = scenario_utils.make_push_params(K, args.T)
+    params.filter_u = not args.no_filter
+    planner = scenario_utils.make_push_planner(params)
+    planner.set_mode(mppi_mode=mppi_mode, sample_method=sample_method, multi_modal=False)
+    planner.noise_beta = torch.tensor(args.beta, **params.tensor_args).expand(planner.nu)
+    planner.sobol_shift = not args.no_sobol_shift
+    cost = []
+    def add_cost(planner, state):
+        cost.append(3 * (torch.linalg.norm(state[[0, 2]] - state[4:]).item() + 10 * torch.linalg.norm(state[4:]).item()))
+    success, _, _ = scenario_utils.push_episode(planner, params, robot_start, block_start, args.ticks, args.tol, on_tick=add_cost)
+    return success, sum(cost)
+
+for mppi_mode, sample_method in samplers:
+    for K in args.Ks:
+        results = [episode(K, mppi_mode, sample_method, *start) for start in scenario_utils.push_starts]
+        print(mppi_mode, "|", sample_method, "| K", K, "| success", format(np.mean([s for s, _ in results]), '.2f'),
+              "| mean cost", format(np.mean([c for _, c in results]), '.1f'))
@@ -0,0 +1,79 @@
+import torch, time, argparse
+import numpy as np
+from m3p2i_aip.utils import scenario_utils
+from torch.distributions.multivariate_normal import MultivariateNormal
+from m3p2i_aip.utils.mppi_utils import NoisePool
+
+# Noise of the simple mode drawn with MultivariateNormal.sample against taken from a NoisePool. First the time of the
+# noise generation alone, for the point robot (2 action dimensions) and an albert-like action space where only the
+# last --active of --nu dimensions are used. Then the correlation of all pairs of samples, and the success
+# rate and tick time of a scripted analytic push of a block to the origin in the simple mode
+parser = argparse.ArgumentParser(prog='Noise pool benchmark', description='pass args')
+parser.add_argument('--K', type=int, default=1000, help='Number of samples')
+parser.add_argument('--T', type=int, default=15, help='Horizon')
+parser.add_argument('--nu', type=int, default=13, help='Action dimensions of the albert-like case')
+parser.add_argument('--active', type=int, default=2, help='Used action dimensions of the albert-like case')
+parser.add_argument('--reps', type=int, default=200, help='Repetitions of the timing')
+parser.add_argument('--pairs_reps', type=int, default=50, help='Ticks of the pairwise correlation')
+parser.add_argument('--repeat', type=float, default=0.99, help='Absolute correlation of a pair counted as a repeated sequence')
+parser.add_argument('--ticks', type=int, default=300, help='Closed-loop ticks per episode')
+parser.add_argument('--tol', type=float, default=0.15, help='Block to goal distance counted as success')
+args = parser.parse_args()
+torch.set_num_threads(1)
+tensor_args = {'device':'cpu', 'dtype':torch.float32}
+
+def timed(fn):
+    fn()
+    start_time = time.monotonic()
+    for _ in range(args.reps):
+        fn()
+    return (time.monotonic() - start_time) / args.reps * 1000
+
+for name, nu, active in [('point', 2, 2), ('albert-like', args.nu, args.active)]:
+    sigma = 3 * torch.eye(nu, **tensor_args)
+    dist = MultivariateNormal(torch.zeros(nu, **tensor_args), covariance_matrix=sigma)
+    scale_tril = torch.linalg.cholesky(sigma[-active:, -active:])
+    pool = NoisePool(8 * args.K, args.T, active, tensor_args, seed_val=0)
+    sample_ms = timed(lambda: dist.sample((args.K, args.T)))
+    pool_ms = timed(lambda: pool.take(args.K) @ scale_tril.T)
+    print(name, "| nu", nu, "| active", active, "| sample", format(sample_ms, '.3f'), "ms | pool", format(pool_ms, '.3f'),
+          "ms | speedup", format(sample_ms / pool_ms, '.1f'))
+
+# Correlation of every pair of samples within a tick and between consecutive ticks, for the pool and for fresh normal
+# noise: mean squared correlation of the pairs (about 1 / (T n) for independent noise) and pairs per tick that repeat
+# a sequence up to the signs (absolute correlation above --repeat)
+def correlations(a, b, same_tick):
+    a, b = a.reshape(args.K, -1), b.reshape(args.K, -1)
+    a = (a - a.mean(dim=1, keepdim=True)) / a.std(dim=1, keepdim=True)
+    b = (b - b.mean(dim=1, keepdim=True)) / b.std(dim=1, keepdim=True)
+    corr = torch.abs(a @ b.T / (a.shape[1] - 1))
+    if same_tick:
+        corr = corr[torch.triu(torch.ones(args.K, args.K, dtype=torch.bool), diagonal=1)]
+    return torch.mean(corr ** 2).item(), torch.sum(corr > args.repeat).item()
+
+pool = NoisePool(8 * args.K, args.T, 2, tensor_args, seed_val=0)
+for name, take in [('fresh', lambda: torch.randn(args.K, args.T, 2)), ('pool', lambda: pool.take(args.K).clone())]:
+    torch.manual_seed(0)
+    previous, within, across = take(), [], []
+    for _ in range(args.pairs_reps):
+        current = take()
+        within.append(correlations(current, current, True))
+        across.append(correlations(previous, current, False))
+        previous = current
+    for label, stats in [('within a tick', within), ('consecutive ticks', across)]:
+        print(name, "|", label, "| mean squared correlation", format(np.mean([m for m, _ in stats]), '.5f'),
+              "| repeated pairs per tick", format(np.mean([r for _, r in stats]), '.2f'))
+
+def episode(use_noise_pool, robot_start, block_start):
+    params = scenario_utils.make_push_params(args.K, args.T)
+    planner = scenario_utils.make_push_planner(params)
+    planner.set_mode(mppi_mode='simple', sample_method='random', multi_modal=False)
+    planner.use_noise_pool = use_noise_pool
+    return scenario_utils.push_episode(planner, params, robot_start, block_start, args.ticks, args.tol)
+
+for use_noise_pool in [False, True]:
+    results = [episode(use_noise_pool, *start) for start in scenario_utils.push_starts]
+    ticks = [tick for success, tick, _ in results if success]
+    print("noise pool" if use_noise_pool else "sample", "| success", format(np.mean([s for s, _, _ in results]), '.2f'),
+          "| mean ticks", format(np.mean(ticks), '.1f') if ticks else "-",
+          "| tick", format(np.mean([t for _, _, t in results]) * 1000, '.1f'), "ms")
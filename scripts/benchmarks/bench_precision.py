@@ -0,0 +1,54 @@
+import torch, time, argparse
+import numpy as np
+from m3p2i_aip.utils import scenario_utils
+
+# Validation of the reduced precision rollouts against float32. Both planners get the same state and the same mean
+# before every tick, so the divergence of one update is measured: total variation distance of the weights, the
+# largest difference of the mean actions and of the best costs. Also reports the rollout buffer memory and tick time
+parser = argparse.ArgumentParser(prog='Rollout precision benchmark', description='pass args')
+parser.add_argument('--robot', type=str, default='point_robot', help='point_robot, heijn, boxer or push, the point robot pushing a block from the first push start')
+parser.add_argument('--K', type=int, default=5000, help='Number of samples')
+parser.add_argument('--T', type=int, default=15, help='Horizon')
+parser.add_argument('--sample_method', type=str, default='sobol', help='sobol or halton (needs ghalton), the sobol points are not shifted so that both planners use the same samples')
+parser.add_argument('--ticks', type=int, default=50, help='Closed-loop ticks')
+args = parser.parse_args()
+torch.set_num_threads(1)
+
+def make(rollout_dtype):
+    if args.robot == 'push':
+        params = scenario_utils.make_push_params(num_envs=args.K, horizon=args.T)
+        params.filter_u = False
+        planner = scenario_utils.make_push_planner(params, sample_method=args.sample_method)
+    else:
+        params = scenario_utils.make_params(args.robot, num_envs=args.K, horizon=args.T)
+        params.filter_u = False
+        planner = scenario_utils.make_planner(params, sample_method=args.sample_method)
+    planner.sobol_shift = False
+    planner.rollout_dtype = rollout_dtype
+    return planner, params
+
+def run(rollout_dtype):
+    ref, params = make(torch.float32)
+    planner, _ = make(rollout_dtype)
+    if args.robot == 'push':
+        state = scenario_utils.push_state(*scenario_utils.push_starts[0], params)
+    else:
+        state = scenario_utils.initial_state(params)
+    tv, action_diff, cost_diff, tick_times = [], [], [], []
+    for _ in range(args.ticks):
+        planner.mean_action = ref.mean_action.clone()
+        action = ref.command(state)
+        start_time = time.monotonic()
+        planner.command(state)
+        tick_times.append(time.monotonic() - start_time)
+        tv.append(0.5 * torch.sum(torch.abs(planner.weights - ref.weights)).item())
+        action_diff.append(torch.max(torch.abs(planner.mean_action - ref.mean_action)).item())
+        cost_diff.append(abs(torch.min(planner.cost_total).item() - torch.min(ref.cost_total).item()))
+        state = ref.F(state.unsqueeze(0), action[:1])[0][0]
+    return np.mean(tv), np.max(tv), np.max(action_diff), np.max(cost_diff), planner.workspace.nbytes(), np.mean(tick_times) * 1000
+
+for rollout_dtype in [torch.float32, torch.bfloat16, torch.float16]:
+    tv_mean, tv_max, action_diff, cost_diff, nbytes, tick_ms = run(rollout_dtype)
+    print(str(rollout_dtype).split('.')[-1], "| weights tv mean", format(tv_mean, '.4f'), "max", format(tv_max, '.4f'),
+          "| mean action max diff", format(action_diff, '.4f'), "| best cost max diff", format(cost_diff, '.4f'),
+          "| buffers", format(nbytes / 2**20, '.1f'), "MiB | tick", format(tick_ms, '.1f'), "ms")
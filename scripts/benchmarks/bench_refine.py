@@ -0,0 +1,41 @@
+import torch, time, argparse
+import numpy as np
+from m3p2i_aip.utils import scenario_utils
+
+# Scripted analytic push of a block to the origin with gradient refinement of the mean: tick time, plan cost and the
+# cost decrease per ms of refinement for a range of sample counts and refinement steps, to trade samples for steps
+parser = argparse.ArgumentParser(prog='Gradient refinement benchmark', description='pass args')
+parser.add_argument('--Ks', type=int, nargs='+', default=[50, 100, 200, 400], help='Sample counts')
+parser.add_argument('--steps', type=int, nargs='+', default=[0, 3, 5], help='Refinement steps per tick')
+parser.add_argument('--lr', type=float, default=0.05, help='Refinement step size')
+parser.add_argument('--T', type=int, default=15, help='Horizon')
+parser.add_argument('--sample_method', type=str, default='sobol', help='sobol, random, colored or halton (needs ghalton)')
+parser.add_argument('--ticks', type=int, default=100, help='Closed-loop ticks')
+args = parser.parse_args()
+torch.set_num_threads(1)
+
+def run(K, refine_steps):
+    params = scenario_utils.make_push_params(K, args.T)
+    planner = scenario_utils.make_push_planner(params, sample_method=args.sample_method)
+    planner.refine_steps = refine_steps
+    planner.refine_lr = args.lr
+    state = scenario_utils.push_state(*scenario_utils.push_starts[0], params)
+    tick_times, plan_costs, improvements, rates = [], [], [], []
+    for _ in range(args.ticks):
+        start_time = time.monotonic()
+        action = planner.command(state)
+        tick_times.append(time.monotonic() - start_time)
+        plan_costs.append(planner._mean_cost(planner.mean_action).item())
+        if refine_steps > 0:
+            improvements.append(planner.refine_improvement)
+            rates.append(planner.refine_rate)
+        state = planner.F(state.unsqueeze(0), action[:1])[0][0]
+    return (np.mean(tick_times) * 1000, np.mean(plan_costs), np.mean(improvements) if improvements else 0.,
+            np.mean(rates) if rates else 0., torch.linalg.norm(state[4:]).item())
+
+for K in args.Ks:
+    for refine_steps in args.steps:
+        tick_ms, plan_cost, improvement, rate, block_dist = run(K, refine_steps)
+        print("K", K, "| steps", refine_steps, "| tick", format(tick_ms, '.1f'), "ms | plan cost", format(plan_cost, '.3f'),
+              "| improvement", format(improvement, '.3f'), "| per ms", format(rate, '.4f'),
+              "| final block distance", format(block_dist, '.3f'))
@@ -0,0 +1,34 @@
+import torch, argparse
+import numpy as np
+from m3p2i_aip.utils import scenario_utils
+
+# Closed-loop analytic navigation with fresh samples only or with the elites of the last tick reused:
+# effective sample size of the weights, and the distance to the goal after a fixed number of ticks
+parser = argparse.ArgumentParser(prog='Rollout reuse benchmark', description='pass args')
+parser.add_argument('--robot', type=str, default='point_robot', help='point_robot, heijn or boxer')
+parser.add_argument('--K', type=int, default=400, help='Number of samples of the baseline')
+parser.add_argument('--T', type=int, default=15, help='Horizon')
+parser.add_argument('--sample_method', type=str, default='sobol', help='sobol, random or halton (needs ghalton)')
+parser.add_argument('--ticks', type=int, default=60, help='Closed-loop ticks')
+args = parser.parse_args()
+torch.set_num_threads(1)
+
+def run(K, reuse_elites):
+    params = scenario_utils.make_params(args.robot, num_envs=K, horizon=args.T)
+    planner = scenario_utils.make_planner(params, sample_method=args.sample_method)
+    planner.reuse_elites = reuse_elites
+    state = scenario_utils.initial_state(params)
+    goal = planner.nav_goal
+    ess = []
+    for _ in range(args.ticks):
+        action = planner.command(state)
+        ess.append(1. / torch.sum(planner.weights ** 2).item())
+        state = planner.F(state.unsqueeze(0), action[:1])[0][0]
+    dist = torch.linalg.norm(state[[0, 2]] - goal).item()
+    return np.mean(ess), dist
+
+configs = [(args.K, 0), (args.K // 2, 0), (args.K // 2, args.K // 8), (args.K // 4, 0), (args.K // 4, args.K // 16)]
+for K, reuse_elites in configs:
+    ess, dist = run(K, reuse_elites)
+    print("K", K, "| elites", reuse_elites, "| fresh samples", K - reuse_elites, "| mean ess", format(ess, '.1f'),
+          "| goal distance", format(dist, '.3f'))
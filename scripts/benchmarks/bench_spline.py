@@ -0,0 +1,53 @@
+import torch, time, argparse
+from m3p2i_aip.utils import skill_utils, mppi_utils
+
+# Compare the per-sample scipy spline loop against the batched basis matmul used in MPPI.get_samples. The loop is the
+# smoothing spline (s=0.5) of skill_utils.bspline, the basis the interpolating one, they are the same for horizons with
+# degree + 1 knots (T=12 and T=15). For more knots (T=20) the difference and the standard deviation of both samples
+# are reported, as well as the error of smoothing_bspline, which the halton sampler uses to keep the smoothing
+parser = argparse.ArgumentParser(prog='Spline benchmark', description='pass args')
+parser.add_argument('--K', type=int, nargs='+', default=[200, 2000, 20000], help='Number of samples')
+parser.add_argument('--T', type=int, nargs='+', default=[12, 20], help='Horizons')
+parser.add_argument('--nu', type=int, default=9, help='Action dimension')
+parser.add_argument('--device', type=str, default='cpu', help='Planner device')
+args = parser.parse_args()
+
+degree = 2
+tensor_args = {'device':args.device, 'dtype':torch.float32}
+
+def sync():
+    if args.device != 'cpu':
+        torch.cuda.synchronize()
+
+for T in args.T:
+    # Same number of knots as MPPI
+    n_knots = T // min(4, T // (degree + 1))
+    for K in args.K:
+        knots = torch.randn(K, args.nu, n_knots, **tensor_args)
+
+        # Per-sample scipy loop
+        start_time = time.monotonic()
+        samples_loop = torch.zeros((K, T, args.nu), **tensor_args)
+        for i in range(K):
+            for j in range(args.nu):
+                samples_loop[i, :, j] = skill_utils.bspline(knots[i, j, :], n=T, degree=degree)
+        sync()
+        loop_time = time.monotonic() - start_time
+
+        # Batched basis matmul, the basis is computed once per configuration
+        start_time = time.monotonic()
+        basis = mppi_utils.bspline_basis(n_knots, n=T, degree=degree, device=args.device, float_dtype=torch.float32)
+        sync()
+        basis_time = time.monotonic() - start_time
+        start_time = time.monotonic()
+        samples_batched = mppi_utils.batched_bspline(knots, basis).transpose(1, 2)
+        sync()
+        batched_time = time.monotonic() - start_time
+
+        err = torch.abs(samples_loop - samples_batched)
+        smoothing_err = torch.max(torch.abs(samples_loop - mppi_utils.smoothing_bspline(knots, basis, degree).transpose(1, 2)))
+        print("T", T, "| knots", n_knots, "| K", K, "| loop", format(loop_time*1000, '.2f'), "ms | batched",
+              format(batched_time*1000, '.3f'), "ms (+ basis", format(basis_time*1000, '.3f'), "ms once) | speedup",
+              format(loop_time/batched_time, '.0f'), "| max err", format(err.max().item(), '.2e'), "| mean err",
+              format(err.mean().item(), '.2e'), "| std loop", format(samples_loop.std().item(), '.3f'), "| std batched",
+              format(samples_batched.std().item(), '.3f'), "| smoothing_bspline max err", format(smoothing_err.item(), '.2e'))
@@ -0,0 +1,44 @@
+import torch, argparse
+from m3p2i_aip.utils import scenario_utils
+
+# Scripted analytic push of a block to the origin, multi-modal halton-spline against the stein mode: success rate for a
+# range of sample counts and the smallest K with the target success rate. The pull skill and the corner obstacles of
+# the IsaacGym scenarios need contact physics, here the modes come from the side the robot passes the block on
+parser = argparse.ArgumentParser(prog='Stein variational benchmark', description='pass args')
+parser.add_argument('--Ks', type=int, nargs='+', default=[40, 80, 160, 320], help='Sample counts')
+parser.add_argument('--particles', type=int, default=4, help='Particles of the stein mode')
+parser.add_argument('--T', type=int, default=15, help='Horizon')
+parser.add_argument('--sample_method', type=str, default='sobol', help='sobol, random, colored or halton (needs ghalton)')
+parser.add_argument('--ticks', type=int, default=300, help='Closed-loop ticks per episode')
+parser.add_argument('--tol', type=float, default=0.15, help='Block to goal distance counted as success')
+parser.add_argument('--success', type=float, default=1., help='Required success rate')
+args = parser.parse_args()
+torch.set_num_threads(1)
+
+# Robot and block start positions. Behind the block the push is direct, in front of it the robot has to go around it
+scenarios = {
+    'behind': [((-1.5, -1.5), (-0.8, -0.8)), ((-2., 0.5), (-1., 0.3)), ((1., -2.), (0.8, -1.))],
+    'in front': [((0., 0.5), (0., 1.2)), ((0.6, 0.), (1.3, 0.)), ((-0.4, -0.4), (-1., -1.))],
+}
+
+def episode(K, mppi_mode, robot_start, block_start):
+    params = scenario_utils.make_push_params(K, args.T)
+    planner = scenario_utils.make_push_planner(params, sample_method=args.sample_method, multi_modal=mppi_mode == 'halton-spline')
+    if mppi_mode == 'stein':
+        planner.num_particles = args.particles
+        planner.set_mode(mppi_mode='stein', sample_method=args.sample_method, multi_modal=False)
+    success, ticks, _ = scenario_utils.push_episode(planner, params, robot_start, block_start, args.ticks, args.tol)
+    return success, ticks
+
+for name, starts in scenarios.items():
+    for mppi_mode in ['halton-spline', 'stein']:
+        min_K = None
+        for K in args.Ks:
+            results = [episode(K, mppi_mode, *start) for start in starts]
+            rate = sum(success for success, _ in results) / len(results)
+            ticks = [tick for success, tick in results if success]
+            print(name, "|", mppi_mode, "| K", K, "| success", format(rate, '.2f'),
+                  "| mean ticks", format(sum(ticks) / len(ticks), '.1f') if ticks else "-")
+            if min_K is None and rate >= args.success:
+                min_K = K
+        print(name, "|", mppi_mode, "| samples needed", min_K if min_K is not None else "more than " + str(args.Ks[-1]))
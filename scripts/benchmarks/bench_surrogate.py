@@ -0,0 +1,43 @@
+import torch, argparse
+import numpy as np
+from m3p2i_aip.utils import scenario_utils
+from m3p2i_aip.planners.motion_planner import dynamics
+from m3p2i_aip.planners.motion_planner.learned_models import RolloutLog, load_surrogate_dynamics, multi_step_error
+
+# Accuracy of the surrogate dynamics saved by train_surrogate.py. With --data, the open-loop multi-step error on logged
+# rollouts, e.g. held-out IsaacGym rollouts. Then the scripted analytic push of a block to the origin, planned with the
+# PointPushDynamics rollouts and with the surrogate, both executed on PointPushDynamics: success rate, mean ticks and
+# tick time. This end-to-end check needs a model trained on analytic push rollouts (scripts/train_value.py --save_log). For
+# IsaacGym, run reactive_tamp.py with dynamics_backend = "surrogate" against sim.py
+parser = argparse.ArgumentParser(prog='Surrogate dynamics benchmark', description='pass args')
+parser.add_argument('--model', type=str, default='surrogate_dynamics.pt', help='Model saved by train_surrogate.py')
+parser.add_argument('--data', type=str, default=None, help='RolloutLog for the multi-step error')
+parser.add_argument('--K', type=int, default=200, help='Number of samples')
+parser.add_argument('--T', type=int, default=15, help='Horizon')
+parser.add_argument('--sample_method', type=str, default='sobol', help='sobol, random, colored or halton (needs ghalton)')
+parser.add_argument('--ticks', type=int, default=300, help='Closed-loop ticks per episode')
+parser.add_argument('--tol', type=float, default=0.15, help='Block to goal distance counted as success')
+args = parser.parse_args()
+torch.set_num_threads(1)
+
+if args.data is not None:
+    states, actions, _ = RolloutLog.load(args.data).tensors()
+    robot_error, block_error = multi_step_error(load_surrogate_dynamics(args.model, {'device':'cpu', 'dtype':torch.float32}), states, actions)
+    for t in range(len(robot_error)):
+        print("step", t + 1, "| robot position error", format(robot_error[t].item(), '.4f'),
+              "| block position error", format(block_error[t].item(), '.4f') if block_error is not None else "-")
+
+def episode(surrogate, robot_start, block_start):
+    params = scenario_utils.make_push_params(args.K, args.T)
+    system = dynamics.PointPushDynamics(params.dt)
+    model = load_surrogate_dynamics(args.model, params.tensor_args) if surrogate else system
+    planner = scenario_utils.make_push_planner(params, sample_method=args.sample_method, dynamics=model)
+    return scenario_utils.push_episode(planner, params, robot_start, block_start, args.ticks, args.tol, system=system)
+
+for name, surrogate in [('physics', False), ('surrogate', True)]:
+    results = [episode(surrogate, *start) for start in scenario_utils.push_starts]
+    rate = sum(success for success, _, _ in results) / len(results)
+    ticks = [tick for success, tick, _ in results if success]
+    print(name, "| success", format(rate, '.2f'),
+          "| mean ticks", format(sum(ticks) / len(ticks), '.1f') if ticks else "-",
+          "| tick", format(np.mean([tick_time for _, _, tick_time in results]) * 1000, '.1f'), "ms")
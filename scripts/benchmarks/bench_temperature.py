@@ -0,0 +1,59 @@
+import torch, time, argparse
+import numpy as np
+from m3p2i_aip.utils.mppi_utils import solve_temperature
+
+# Temperature of the weights exp(-c / beta) for an effective number of samples eta within [3, 10]: the removed
+# multiplicative loop of M3P2I.update_infinite_beta (beta *= 0.9 or 1.2 until eta is within the bounds, starting from
+# the beta of the previous tick) against solve_temperature for all rows at once. Costs of M modes with K samples are
+# drawn with a cost spread of --scale, every tick from a new spread. Reports the time per tick, the iterations of the
+# loop and the eta reached
+parser = argparse.ArgumentParser(prog='Temperature benchmark', description='pass args')
+parser.add_argument('--K', type=int, default=1000, help='Number of samples')
+parser.add_argument('--M', type=int, default=3, help='Rows solved per tick, the two modes and all samples in M3P2I')
+parser.add_argument('--scale', type=float, nargs='+', default=[1., 100., 10000.], help='Cost spreads')
+parser.add_argument('--ticks', type=int, default=200, help='Ticks per spread')
+parser.add_argument('--max_loop', type=int, default=10000, help='Cap of the loop iterations, the removed loop had none')
+args = parser.parse_args()
+torch.set_num_threads(1)
+eta_l, eta_u = 3., 10.
+
+def loop(costs, beta):
+    for i in range(args.max_loop):
+        eta = torch.sum(torch.exp((-1.0/beta) * costs))
+        if eta > eta_u:
+            beta = beta * 0.9
+        elif eta < eta_l:
+            beta = beta * 1.2
+        else:
+            return beta, eta.item(), i + 1
+    return beta, eta.item(), args.max_loop
+
+for scale in args.scale:
+    torch.manual_seed(0)
+    # Spreads vary by a factor of 10 around scale between ticks, as the costs change while the robot moves
+    spreads = scale * 10 ** (torch.rand(args.ticks) - 0.5)
+    costs = [s * torch.rand(args.M, args.K) ** 2 for s in spreads]
+    costs = [c - torch.min(c, dim=1, keepdim=True)[0] for c in costs]
+
+    betas = torch.ones(args.M)
+    loop_etas, loop_iters = [], []
+    start_time = time.monotonic()
+    for c in costs:
+        for m in range(args.M):
+            betas[m], eta, iters = loop(c[m], betas[m])
+            loop_etas.append(eta)
+            loop_iters.append(iters)
+    loop_ms = (time.monotonic() - start_time) / args.ticks * 1000
+
+    solve_etas = []
+    start_time = time.monotonic()
+    for c in costs:
+        _, eta, _ = solve_temperature(c, (eta_l * eta_u) ** 0.5)
+        solve_etas.append(eta)
+    solve_ms = (time.monotonic() - start_time) / args.ticks * 1000
+    solve_etas = torch.cat(solve_etas).numpy()
+
+    print("spread", format(scale, 'g'), "| loop", format(loop_ms, '.3f'), "ms, iterations mean",
+          format(np.mean(loop_iters), '.1f'), "max", np.max(loop_iters), ", eta", format(np.min(loop_etas), '.2f'), "-",
+          format(np.max(loop_etas), '.2f'), "| solve", format(solve_ms, '.3f'), "ms, eta", format(solve_etas.min(), '.2f'),
+          "-", format(solve_etas.max(), '.2f'))
@@ -0,0 +1,46 @@
+import torch, argparse
+import numpy as np
+from m3p2i_aip.utils import scenario_utils
+
+# Samples clamped onto u_min/u_max against samples from the truncated Gaussian, in a scripted analytic push of a block
+# to the origin: share of saturated sample actions (within --tol of a bound), a histogram of the sample actions over
+# the action box, success rate and mean ticks
+parser = argparse.ArgumentParser(prog='Truncated sampling benchmark', description='pass args')
+parser.add_argument('--K', type=int, default=200, help='Number of samples')
+parser.add_argument('--T', type=int, default=15, help='Horizon')
+parser.add_argument('--sigma', type=float, default=3., help='Variance of the samples, as noise_sigma in params_point')
+parser.add_argument('--sample_method', type=str, default='sobol', help='sobol, random, colored or halton (needs ghalton)')
+parser.add_argument('--bins', type=int, default=10, help='Histogram bins over the action box')
+parser.add_argument('--ticks', type=int, default=300, help='Closed-loop ticks per episode')
+parser.add_argument('--tol', type=float, default=1e-3, help='Distance to a bound counted as saturated')
+parser.add_argument('--goal_tol', type=float, default=0.15, help='Block to goal distance counted as success')
+args = parser.parse_args()
+torch.set_num_threads(1)
+
+def episode(truncate, robot_start, block_start, histogram):
+    params = scenario_utils.make_push_params(args.K, args.T)
+    params.noise_sigma = args.sigma * torch.eye(2, **params.tensor_args)
+    planner = scenario_utils.make_push_planner(params, sample_method=args.sample_method)
+    planner.truncate_samples = truncate
+    saturated = []
+    def count_samples(planner, state):
+        # The null action is left out
+        samples = planner.perturbed_action[:-1]
+        at_bound = (torch.abs(samples - params.u_min) < args.tol) | (torch.abs(samples - params.u_max) < args.tol)
+        saturated.append(at_bound.float().mean(dim=(0, 1)).numpy())
+        for i in range(planner.nu):
+            histogram[i] += torch.histc(samples[..., i], bins=args.bins, min=params.u_min[i].item(), max=params.u_max[i].item()).numpy()
+    success, ticks, _ = scenario_utils.push_episode(planner, params, robot_start, block_start, args.ticks, args.goal_tol,
+                                                 on_tick=count_samples)
+    return success, ticks, np.mean(saturated, axis=0)
+
+for truncate in [False, True]:
+    histogram = np.zeros((2, args.bins))
+    results = [episode(truncate, *start, histogram) for start in scenario_utils.push_starts]
+    ticks = [tick for success, tick, _ in results if success]
+    print("truncated" if truncate else "clamped", "| success", format(np.mean([s for s, _, _ in results]), '.2f'),
+          "| mean ticks", format(np.mean(ticks), '.1f') if ticks else "-",
+          "| saturated per dimension", np.round(np.mean([sat for _, _, sat in results], axis=0), 3))
+    for i in range(2):
+        shares = histogram[i] / histogram[i].sum()
+        print("  dimension", i, "| histogram", " ".join(format(share, '.3f') for share in shares))
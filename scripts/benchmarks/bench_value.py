@@ -0,0 +1,30 @@
+import torch, argparse
+import numpy as np
+from m3p2i_aip.utils import scenario_utils
+
+# Scripted analytic push of a block to the origin with the long horizon, the short horizon, and the short horizon
+# with the terminal value trained by scripts/train_value.py: success rate, mean ticks to success and tick time
+parser = argparse.ArgumentParser(prog='Terminal value benchmark', description='pass args')
+parser.add_argument('--value', type=str, default='terminal_value.pt', help='Model saved by train_value.py')
+parser.add_argument('--K', type=int, default=200, help='Number of samples')
+parser.add_argument('--T', type=int, default=15, help='Long horizon')
+parser.add_argument('--short_T', type=int, default=8, help='Short horizon, the one the value was trained for')
+parser.add_argument('--sample_method', type=str, default='random', help='random, colored, halton (needs ghalton) or sobol (not for short_T=8, see MPPI.set_mode)')
+parser.add_argument('--ticks', type=int, default=300, help='Closed-loop ticks per episode')
+parser.add_argument('--tol', type=float, default=0.15, help='Block to goal distance counted as success')
+args = parser.parse_args()
+torch.set_num_threads(1)
+
+def episode(T, value, robot_start, block_start):
+    params = scenario_utils.make_push_params(args.K, T)
+    params.terminal_state_cost = value
+    planner = scenario_utils.make_push_planner(params, sample_method=args.sample_method)
+    return scenario_utils.push_episode(planner, params, robot_start, block_start, args.ticks, args.tol)
+
+for name, T, value in [('long', args.T, None), ('short', args.short_T, None), ('short + value', args.short_T, args.value)]:
+    results = [episode(T, value, *start) for start in scenario_utils.push_starts]
+    rate = sum(success for success, _, _ in results) / len(results)
+    ticks = [tick for success, tick, _ in results if success]
+    print(name, "| T", T, "| success", format(rate, '.2f'),
+          "| mean ticks", format(sum(ticks) / len(ticks), '.1f') if ticks else "-",
+          "| tick", format(np.mean([tick_time for _, _, tick_time in results]) * 1000, '.1f'), "ms")
@@ -0,0 +1,58 @@
+import torch, argparse
+from m3p2i_aip.utils import scenario_utils
+
+# Variance of the mean update at a fixed K, with antithetic pairs, the control variate and both. The state and the
+# mean of a scripted analytic push are fixed after some warmup ticks, and the update from them is repeated with fresh
+# samples: total variance of the updated mean over the repeats, its ratio to the plain update, and the distance of the
+# average update to the plain one. The control variate is a heuristic, that distance is its bias when it is clearly
+# above the standard error of the difference of the two averages
+parser = argparse.ArgumentParser(prog='Variance reduction benchmark', description='pass args')
+parser.add_argument('--K', type=int, default=100, help='Number of samples')
+parser.add_argument('--T', type=int, default=15, help='Horizon')
+parser.add_argument('--warmup', type=int, default=30, help='Ticks before the state and the mean are fixed')
+parser.add_argument('--repeats', type=int, default=200, help='Updates from the fixed state and mean')
+args = parser.parse_args()
+torch.set_num_threads(1)
+
+samplers = [('simple', 'random'), ('halton-spline', 'random'), ('halton-spline', 'colored'), ('halton-spline', 'sobol')]
+variants = [('plain', False, False), ('antithetic', True, False), ('control variate', False, True), ('both', True, True)]
+
+def make(mppi_mode, sample_method):
+    params = scenario_utils.make_push_params(args.K, args.T)
+    planner = scenario_utils.make_push_planner(params)
+    planner.set_mode(mppi_mode=mppi_mode, sample_method=sample_method, multi_modal=False)
+    return planner, params
+
+def mean_of(planner, mppi_mode):
+    return planner.U if mppi_mode == 'simple' else planner.mean_action
+
+for mppi_mode, sample_method in samplers:
+    torch.manual_seed(0)
+    planner, params = make(mppi_mode, sample_method)
+    state = scenario_utils.push_state(*scenario_utils.push_starts[0], params)
+    for _ in range(args.warmup):
+        action = planner.command(state)
+        state = planner.F(state.unsqueeze(0), action[:1])[0][0]
+    mean0 = mean_of(planner, mppi_mode).clone()
+
+    plain_var, plain_avg = None, None
+    for name, antithetic, control_variate in variants:
+        planner, _ = make(mppi_mode, sample_method)
+        planner.antithetic, planner.control_variate = antithetic, control_variate
+        updates = []
+        for _ in range(args.repeats):
+            if mppi_mode == 'simple':
+                planner.U = mean0.clone()
+            else:
+                planner.mean_action = mean0.clone()
+            planner.command(state)
+            updates.append(mean_of(planner, mppi_mode).clone())
+        updates = torch.stack(updates)
+        var = torch.sum(torch.var(updates, dim=0)).item()
+        avg = torch.mean(updates, dim=0)
+        if plain_var is None:
+            plain_var, plain_avg = var, avg
+        print(mppi_mode, "|", sample_method, "|", name, "| update variance", format(var, '.5f'),
+              "| ratio to plain", format(var / plain_var, '.3f'),
+              "| average update shift", format(torch.linalg.norm(avg - plain_avg).item(), '.4f'),
+              "| standard error", format(((var + plain_var) / args.repeats) ** 0.5, '.4f'))
@@ -1,5 +1,5 @@
 from isaacgym import gymtorch
-from m3p2i_aip.planners.motion_planner import m3p2i
+from m3p2i_aip.planners.motion_planner import m3p2i, learned_models
 from m3p2i_aip.planners.task_planner import task_planner
 from m3p2i_aip.utils import sim_init, data_transfer
 from m3p2i_aip.params import params_utils
@@ -34,10 +34,20 @@ class REACTIVE_TAMP:
         # Choose the motion planner
         self.motion_planner = m3p2i.M3P2I(self.params)
         self.motion_planner.set_mode(mppi_mode = 'halton-spline', # 'halton-spline', 'simple'
-                                     sample_method = 'halton',    # 'halton', 'random'
+                                     sample_method = 'halton',    # 'halton', 'random', 'sobol'
                                      multi_modal = params.multimodal)
         self.prefer_pull = -1
+
+        # Rollouts of the planner logged for the learned models, saved to params.rollout_log
+        self.rollout_log = None
+        if getattr(params, 'rollout_log', None) is not None:
+            # The block position is appended to the [pos_x, vel_x, pos_y, vel_y] states
+            self.rollout_log = learned_models.RolloutLog(block_idx=[4, 5])
+            self.motion_planner.block_in_state = True
         
+        # Received states copied to all rollout envs, allocated once
+        self.state_buffers = {}
+
         # Make sure the socket does not already exist
         self.server_address = './uds_socket'
         data_transfer.check_server(self.server_address)
@@ -72,6 +82,21 @@ class REACTIVE_TAMP:
         task_success = task_success and not stay_still
         return task_success
 
+    def repeat_state(self, name, state):
+        # Same as state.repeat(self.num_envs, 1), written into a preallocated buffer
+        buffer = self.state_buffers.get(name)
+        if buffer is None or buffer.shape[1:] != state.shape:
+            buffer = torch.zeros((self.num_envs, *state.shape), dtype=state.dtype, device=state.device)
+            self.state_buffers[name] = buffer
+        buffer.copy_(state.unsqueeze(0).expand_as(buffer))
+        return buffer.view(-1, *state.shape[1:])
+
+    def planner_state(self, dof_state):
+        # Models with the block in the state, e.g. the surrogate dynamics, plan from the robot and block positions
+        if self.motion_planner.block_idx is None:
+            return dof_state
+        return torch.cat([dof_state, self.block_state[0, :2]])
+
     def reset(self, i, reset_flag):
         if reset_flag:
             self.task_planner.reset_plan()
@@ -86,6 +111,7 @@ class REACTIVE_TAMP:
             conn, addr = s.accept()
             with conn:
                 print(f"Connected by {addr}")
+                self.motion_planner.subscribe_top_trajs()
                 i=0
                 while True:
                     i+=1
@@ -98,13 +124,13 @@ class REACTIVE_TAMP:
                     # Receive dof states
                     res = conn.recv(2**14)
                     r = copy.copy(res)
-                    _dof_states = data_transfer.bytes_to_torch(r).repeat(self.num_envs, 1)
+                    _dof_states = self.repeat_state("dof_states", data_transfer.bytes_to_torch(r))
                     conn.sendall(bytes(self.task_planner.task, 'utf-8'))
 
                     # Receive root states
                     res = conn.recv(2**14)
                     r = copy.copy(res)
-                    _root_states = data_transfer.bytes_to_torch(r).repeat(self.num_envs, 1)
+                    _root_states = self.repeat_state("root_states", data_transfer.bytes_to_torch(r))
 
                     # Reset the simulator to requested state
                     s = _dof_states.view(-1, 2*self.dofs_per_robot)
@@ -127,8 +153,12 @@ class REACTIVE_TAMP:
                     # Compute optimal action and send to real simulator
                     else:
                         motion_time_prev = time.monotonic()
-                        actions = self.motion_planner.command(s[0])
+                        actions = self.motion_planner.command(self.planner_state(s[0]))
                         self.motion_freq = format(1/(time.monotonic()-motion_time_prev), '.2f')
+                        if self.rollout_log is not None:
+                            self.rollout_log.record(self.motion_planner)
+                            if i % 100 == 0:
+                                self.rollout_log.save(self.params.rollout_log)
                         self.prefer_pull = self.motion_planner.get_weights_preference()
                     conn.sendall(data_transfer.torch_to_bytes(actions))
 
@@ -0,0 +1,31 @@
+import torch, argparse
+from m3p2i_aip.planners.motion_planner.learned_models import RolloutLog, train_surrogate, multi_step_error
+
+# Trains the surrogate dynamics from a RolloutLog, e.g. the one reactive_tamp.py saves to params.rollout_log while
+# planning with IsaacGym. The rollouts of one skill (push or pull) train one model. Held-out rollouts are predicted
+# open-loop from their first state to report the multi-step error. Set the saved model as params.surrogate_model
+# with dynamics_backend = "surrogate" to plan with it
+parser = argparse.ArgumentParser(prog='Surrogate dynamics training', description='pass args')
+parser.add_argument('--data', type=str, required=True, help='RolloutLog file to train from')
+parser.add_argument('--out', type=str, default='surrogate_dynamics.pt', help='Where to save the model')
+parser.add_argument('--test_fraction', type=float, default=0.1, help='Rollouts held out for the multi-step error')
+parser.add_argument('--hidden', type=int, default=128, help='Hidden units per layer')
+parser.add_argument('--layers', type=int, default=2, help='Hidden layers')
+parser.add_argument('--block_idx', type=int, nargs=2, default=None, help='State columns of the block position, by default the ones saved with the log')
+parser.add_argument('--epochs', type=int, default=100, help='Training epochs')
+parser.add_argument('--lr', type=float, default=1e-3, help='Adam step size')
+parser.add_argument('--seed', type=int, default=0, help='Seed of the split and the training')
+args = parser.parse_args()
+
+train_log, test_log = RolloutLog.load(args.data).split(args.test_fraction, seed=args.seed)
+model, history = train_surrogate(train_log, block_idx=args.block_idx, hidden=args.hidden, layers=args.layers, epochs=args.epochs, lr=args.lr, seed=args.seed)
+for epoch in range(0, args.epochs, max(1, args.epochs // 10)):
+    print("epoch", epoch, "| train mse", format(history['train'][epoch], '.6f'), "| val mse", format(history['val'][epoch], '.6f'))
+
+states, actions, _ = test_log.tensors()
+robot_error, block_error = multi_step_error(model, states, actions)
+for t in range(len(robot_error)):
+    print("step", t + 1, "| robot position error", format(robot_error[t].item(), '.4f'),
+          "| block position error", format(block_error[t].item(), '.4f') if block_error is not None else "-")
+model.save(args.out)
+print("saved", args.out, "| block_idx", model.block_idx)
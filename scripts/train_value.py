@@ -0,0 +1,65 @@
+import torch, argparse
+from m3p2i_aip.utils import scenario_utils
+from m3p2i_aip.planners.motion_planner import dynamics
+from m3p2i_aip.planners.motion_planner.learned_models import RolloutLog, train_value
+
+# Trains the terminal value of a planner with a short horizon from the rollouts of a planner with the long horizon.
+# Without --data, the rollouts are logged from closed-loop episodes of the analytic push (or navigation) from random
+# start states. Any other planner can be logged with RolloutLog.record(planner) after every command and passed with
+# --data. The model is saved to --out, set it as params.terminal_state_cost of the short horizon planner
+parser = argparse.ArgumentParser(prog='Terminal value training', description='pass args')
+parser.add_argument('--task', type=str, default='push', help='push or navigation')
+parser.add_argument('--data', type=str, default=None, help='RolloutLog file to train from, skips the logging')
+parser.add_argument('--save_log', type=str, default=None, help='Where to save the logged rollouts')
+parser.add_argument('--out', type=str, default='terminal_value.pt', help='Where to save the model')
+parser.add_argument('--K', type=int, default=200, help='Number of samples of the logged planner')
+parser.add_argument('--T', type=int, default=15, help='Horizon of the logged planner')
+parser.add_argument('--short_T', type=int, default=8, help='Horizon of the planner the value is for')
+parser.add_argument('--sample_method', type=str, default='random', help='random, colored, halton (needs ghalton) or sobol (not for short_T=8, see MPPI.set_mode)')
+parser.add_argument('--episodes', type=int, default=20, help='Logged episodes')
+parser.add_argument('--ticks', type=int, default=200, help='Closed-loop ticks per episode')
+parser.add_argument('--per_tick', type=int, default=32, help='Rollouts logged per tick')
+parser.add_argument('--hidden', type=int, default=64, help='Hidden units per layer')
+parser.add_argument('--layers', type=int, default=2, help='Hidden layers')
+parser.add_argument('--epochs', type=int, default=100, help='Training epochs')
+parser.add_argument('--lr', type=float, default=1e-3, help='Adam step size')
+parser.add_argument('--seed', type=int, default=0, help='Seed of the start states and the training')
+args = parser.parse_args()
+torch.set_num_threads(1)
+torch.manual_seed(args.seed)
+
+def make_planner(T):
+    if args.task == 'push':
+        params = scenario_utils.make_push_params(args.K, T)
+        return scenario_utils.make_push_planner(params, sample_method=args.sample_method), params
+    params = scenario_utils.make_params('point_robot', num_envs=args.K, horizon=T)
+    return scenario_utils.make_planner(params, task='navigation', goal=(3., 3.), sample_method=args.sample_method,
+                                    dynamics=dynamics.PointRobotDynamics(params.dt)), params
+
+def log_episodes():
+    log = None
+    for episode in range(args.episodes):
+        planner, params = make_planner(args.T)
+        if log is None:
+            log = RolloutLog(per_tick=args.per_tick, block_idx=planner.block_idx)
+        robot = torch.empty(2).uniform_(-2., 2.)
+        state = torch.tensor([robot[0], 0., robot[1], 0.], **params.tensor_args)
+        if args.task == 'push':
+            state = torch.cat([state, torch.empty(2, **params.tensor_args).uniform_(-1.5, 1.5)])
+        for _ in range(args.ticks):
+            action = planner.command(state)
+            log.record(planner)
+            state = planner.F(state.unsqueeze(0), action[:1])[0][0]
+        print("episode", episode, "| logged rollouts", len(log))
+    return log
+
+log = RolloutLog.load(args.data) if args.data is not None else log_episodes()
+if args.save_log is not None:
+    log.save(args.save_log)
+model, history = train_value(log, tail=args.T - args.short_T, hidden=args.hidden, layers=args.layers,
+                             epochs=args.epochs, lr=args.lr, seed=args.seed)
+for epoch in range(0, args.epochs, max(1, args.epochs // 10)):
+    print("epoch", epoch, "| train mse", format(history['train'][epoch], '.4f'), "| val mse", format(history['val'][epoch], '.4f'))
+print("final | train mse", format(history['train'][-1], '.4f'), "| val mse", format(history['val'][-1], '.4f'))
+model.save(args.out)
+print("saved", args.out, "| tail", args.T - args.short_T, "steps")
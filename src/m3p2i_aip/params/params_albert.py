@@ -21,6 +21,7 @@ u_max[12] = 6
 u_min = -u_max
 step_dependent_dynamics = True
 terminal_state_cost = None
+dynamics_backend = "isaacgym"                # only "isaacgym" for manipulators
 sample_null_action = True
 use_priors = False
 u_per_command = 12
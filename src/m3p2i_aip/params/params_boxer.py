@@ -13,6 +13,7 @@ u_max = torch.tensor([2.5, 5.5], **tensor_args)
 u_min = torch.tensor([-2.5, -5.5], **tensor_args)
 step_dependent_dynamics = True
 terminal_state_cost = None
+dynamics_backend = "isaacgym"                # choose from "isaacgym", "analytic"
 sample_null_action = True
 use_priors = False
 u_per_command = 15
@@ -17,6 +17,7 @@ u_min = -2 * torch.ones(9, **tensor_args)
 u_min[7:] = -1.5
 step_dependent_dynamics = True
 terminal_state_cost = None
+dynamics_backend = "isaacgym"                # only "isaacgym" for manipulators
 sample_null_action = True
 use_priors = False
 u_per_command = 12
@@ -14,6 +14,9 @@ u_max = torch.tensor([3, 3], **tensor_args) # 2.5
 u_min = torch.tensor([-3, -3], **tensor_args) # 3 hybrid one corner becomes push
 step_dependent_dynamics = True
 terminal_state_cost = None
+dynamics_backend = "isaacgym"                # choose from "isaacgym", "analytic", "surrogate"
+surrogate_model = None                       # Model saved by train_surrogate.py, for the surrogate backend
+rollout_log = None                           # Path to save a RolloutLog of the planner to, see learned_models.py
 sample_null_action = True
 use_priors = False
 u_per_command = 15
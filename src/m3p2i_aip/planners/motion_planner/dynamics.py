@@ -0,0 +1,182 @@
+import torch
+from m3p2i_aip.utils import skill_utils
+
+# Analytic dynamics backends for the rollouts of MPPI/M3P2I in velocity control mode.
+# They replace the IsaacGym physics step by a vectorized torch update, so that navigation
+# rollouts can run on any device without a simulator. Every backend is a callable
+# (state, u, t) -> (next_state, u) working on a batch [K, nx] of states.
+# The first four columns of the state are the same [pos_x, vel_x, pos_y, vel_y] stack the
+# IsaacGym rollouts return, the orientation of the base is appended when it is needed.
+# Every backend also has rollout(state, actions, out), which steps a whole [K, T, nu] horizon
+# of actions inside one TorchScript function and writes the states into out [K, T, nx].
+
+@torch.jit.script
+def _point_robot_rollout(state: torch.Tensor, actions: torch.Tensor, dt: float, out: torch.Tensor) -> torch.Tensor:
+    pos_x, pos_y = state[:, 0], state[:, 2]
+    for t in range(actions.shape[1]):
+        u = actions[:, t]
+        pos_x = pos_x + u[:, 0] * dt
+        pos_y = pos_y + u[:, 1] * dt
+        out[:, t] = torch.stack([pos_x, u[:, 0], pos_y, u[:, 1]], dim=1)
+    return out
+
+@torch.jit.script
+def _heijn_rollout(state: torch.Tensor, actions: torch.Tensor, dt: float, out: torch.Tensor) -> torch.Tensor:
+    pos_x, pos_y, theta = state[:, 0], state[:, 2], state[:, 4]
+    for t in range(actions.shape[1]):
+        u = actions[:, t]
+        pos_x = pos_x + u[:, 0] * dt
+        pos_y = pos_y + u[:, 1] * dt
+        theta = theta + u[:, 2] * dt
+        out[:, t] = torch.stack([pos_x, u[:, 0], pos_y, u[:, 1], theta, u[:, 2]], dim=1)
+    return out
+
+@torch.jit.script
+def _boxer_rollout(state: torch.Tensor, actions: torch.Tensor, dt: float, r: float, L: float,
+                   out: torch.Tensor) -> torch.Tensor:
+    pos_x, pos_y, yaw = state[:, 0], state[:, 2], state[:, 4]
+    for t in range(actions.shape[1]):
+        u = actions[:, t]
+        # Same wheel velocities as apply_ik
+        left = u[:, 0] / r - L * u[:, 1] / (2 * r)
+        right = u[:, 0] / r + L * u[:, 1] / (2 * r)
+        forward_vel = r * (left + right) / 2
+        yaw_rate = r * (right - left) / L
+        mid_yaw = yaw + 0.5 * yaw_rate * dt
+        yaw = yaw + yaw_rate * dt
+        # cos and sin have no float16 kernels on the CPU
+        heading = mid_yaw.float()
+        vel_x = forward_vel * torch.cos(heading).to(forward_vel.dtype)
+        vel_y = forward_vel * torch.sin(heading).to(forward_vel.dtype)
+        pos_x = pos_x + vel_x * dt
+        pos_y = pos_y + vel_y * dt
+        out[:, t] = torch.stack([pos_x, vel_x, pos_y, vel_y, yaw], dim=1)
+    return out
+
+@torch.jit.script
+def _point_push_rollout(state: torch.Tensor, actions: torch.Tensor, dt: float, contact_dist: float,
+                        out: torch.Tensor) -> torch.Tensor:
+    pos_x, pos_y, block_x, block_y = state[:, 0], state[:, 2], state[:, 4], state[:, 5]
+    for t in range(actions.shape[1]):
+        u = actions[:, t]
+        pos_x = pos_x + u[:, 0] * dt
+        pos_y = pos_y + u[:, 1] * dt
+        dx, dy = block_x - pos_x, block_y - pos_y
+        # sqrt has no float16 kernel on the CPU
+        dist = torch.sqrt(dx.float()**2 + dy.float()**2).clamp(min=1e-6)
+        push = (torch.clamp(contact_dist - dist, min=0) / dist).to(dx.dtype)
+        block_x = block_x + push * dx
+        block_y = block_y + push * dy
+        out[:, t] = torch.stack([pos_x, u[:, 0], pos_y, u[:, 1], block_x, block_y], dim=1)
+    return out
+
+class PointRobotDynamics():
+    """
+        Holonomic point robot, the velocity targets are reached within one time step.
+        State [pos_x, vel_x, pos_y, vel_y], action [vel_x, vel_y]
+    """
+    def __init__(self, dt):
+        self.dt = dt
+
+    def __call__(self, state, u, t=None):
+        pos_x = state[:, 0] + u[:, 0] * self.dt
+        pos_y = state[:, 2] + u[:, 1] * self.dt
+        return torch.stack([pos_x, u[:, 0], pos_y, u[:, 1]], dim=1), u
+
+    def rollout(self, state, actions, out):
+        return _point_robot_rollout(state, actions, self.dt, out)
+
+class HeijnDynamics():
+    """
+        Holonomic base with prismatic x, y and revolute theta joints, as in heijn.urdf.
+        State [pos_x, vel_x, pos_y, vel_y, theta, vel_theta], action [vel_x, vel_y, vel_theta]
+    """
+    def __init__(self, dt):
+        self.dt = dt
+
+    def __call__(self, state, u, t=None):
+        pos_x = state[:, 0] + u[:, 0] * self.dt
+        pos_y = state[:, 2] + u[:, 1] * self.dt
+        theta = state[:, 4] + u[:, 2] * self.dt
+        return torch.stack([pos_x, u[:, 0], pos_y, u[:, 1], theta, u[:, 2]], dim=1), u
+
+    def rollout(self, state, actions, out):
+        return _heijn_rollout(state, actions, self.dt, out)
+
+class BoxerDynamics():
+    """
+        Differential drive base, the action is mapped to wheel velocities with the same
+        apply_ik used for the IsaacGym velocity targets and integrated as a unicycle.
+        State [pos_x, vel_x, pos_y, vel_y, yaw], action [forward vel, yaw rate]
+    """
+    def __init__(self, dt):
+        self.dt = dt
+
+    def __call__(self, state, u, t=None):
+        u_wheels = skill_utils.apply_ik('boxer', u)
+        r, L = skill_utils.wheel_radius, skill_utils.wheel_base
+        forward_vel = r * (u_wheels[:, 0] + u_wheels[:, 1]) / 2
+        yaw_rate = r * (u_wheels[:, 1] - u_wheels[:, 0]) / L
+
+        # Midpoint heading for the translation
+        yaw = state[:, 4] + yaw_rate * self.dt
+        mid_yaw = state[:, 4] + 0.5 * yaw_rate * self.dt
+        # cos and sin have no float16 kernels on the CPU
+        heading = mid_yaw.float()
+        vel_x = forward_vel * torch.cos(heading).to(forward_vel.dtype)
+        vel_y = forward_vel * torch.sin(heading).to(forward_vel.dtype)
+        pos_x = state[:, 0] + vel_x * self.dt
+        pos_y = state[:, 2] + vel_y * self.dt
+        return torch.stack([pos_x, vel_x, pos_y, vel_y, yaw], dim=1), u
+
+    def rollout(self, state, actions, out):
+        return _boxer_rollout(state, actions, self.dt, skill_utils.wheel_radius, skill_utils.wheel_base, out)
+
+class PointPushDynamics():
+    """
+        Point robot pushing a block, both seen as disks. When the robot ends a step closer to the block center than
+        contact_dist, the block is moved away along the center line until they touch. A quasi-static model for
+        planning benchmarks of the push task without a simulator, the block does not rotate or slide on its own.
+        State [pos_x, vel_x, pos_y, vel_y, block_x, block_y], action [vel_x, vel_y]
+    """
+    block_idx = [4, 5]
+
+    def __init__(self, dt, contact_dist=0.4):
+        self.dt = dt
+        self.contact_dist = contact_dist
+
+    def __call__(self, state, u, t=None):
+        pos_x = state[:, 0] + u[:, 0] * self.dt
+        pos_y = state[:, 2] + u[:, 1] * self.dt
+        block_x, block_y = state[:, 4], state[:, 5]
+
+        dx, dy = block_x - pos_x, block_y - pos_y
+        # sqrt has no float16 kernel on the CPU
+        dist = torch.sqrt(dx.float()**2 + dy.float()**2).clamp(min=1e-6)
+        push = (torch.clamp(self.contact_dist - dist, min=0) / dist).to(dx.dtype)
+        return torch.stack([pos_x, u[:, 0], pos_y, u[:, 1], block_x + push * dx, block_y + push * dy], dim=1), u
+
+    def rollout(self, state, actions, out):
+        return _point_push_rollout(state, actions, self.dt, self.contact_dist, out)
+
+def get_dynamics(params):
+    """
+        Returns the analytic dynamics chosen by params.dynamics_backend, the learned model of
+        params.surrogate_model for the surrogate backend, or None when the rollouts are simulated in IsaacGym
+    """
+    if params.dynamics_backend == 'isaacgym':
+        return None
+    elif params.dynamics_backend == 'surrogate':
+        if getattr(params, 'surrogate_model', None) is None:
+            raise ValueError("The surrogate dynamics backend needs the path of a model in params.surrogate_model")
+        from m3p2i_aip.planners.motion_planner.learned_models import load_surrogate_dynamics
+        return load_surrogate_dynamics(params.surrogate_model, params.tensor_args)
+    elif params.dynamics_backend == 'analytic':
+        models = {'point_robot': PointRobotDynamics,
+                  'heijn': HeijnDynamics,
+                  'boxer': BoxerDynamics}
+        if params.robot not in models:
+            raise ValueError("No analytic dynamics for the {} robot".format(params.robot))
+        return models[params.robot](params.dt)
+    else:
+        raise ValueError("Unknown dynamics backend {}".format(params.dynamics_backend))
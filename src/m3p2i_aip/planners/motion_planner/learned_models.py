@@ -0,0 +1,257 @@
+import torch
+
+# Learned models for MPPI/M3P2I, trained offline from the rollouts the planner evaluates anyway.
+# RolloutLog collects a subset of the rollouts after every command, the models are small MLPs
+# that are evaluated batched on the rollout states, on the same device and dtype as the planner.
+
+def mlp(n_in, n_out, hidden=64, layers=2):
+    """
+        Fully connected network with tanh activations, smooth so that it can be differentiated through
+    """
+    modules, n = [], n_in
+    for _ in range(layers):
+        modules += [torch.nn.Linear(n, hidden), torch.nn.Tanh()]
+        n = hidden
+    modules.append(torch.nn.Linear(n, n_out))
+    return torch.nn.Sequential(*modules)
+
+class RolloutLog():
+    """
+        Rollouts of a planner, per_tick of them are copied to the CPU after every command with record(planner):
+        states [N, T, nx], actions [N, T, nu] and cost_horizon [N, T] as computed by _compute_rollout_costs.
+        block_idx are the state columns of the block position, if the states have one. The oldest rollouts are
+        dropped beyond max_rollouts
+    """
+    def __init__(self, per_tick=32, max_rollouts=200000, block_idx=None):
+        self.per_tick = per_tick
+        self.max_rollouts = max_rollouts
+        self.block_idx = block_idx
+        self.states, self.actions, self.costs = [], [], []
+
+    def __len__(self):
+        return sum(len(states) for states in self.states)
+
+    def record(self, planner):
+        K = planner.states.shape[0]
+        idx = torch.randperm(K, device=planner.states.device)[:self.per_tick]
+        self.states.append(planner.states[idx].float().cpu())
+        self.actions.append(planner.actions[idx].float().cpu())
+        self.costs.append(planner.cost_horizon[idx].float().cpu())
+        while len(self) > self.max_rollouts:
+            for buffer in [self.states, self.actions, self.costs]:
+                buffer.pop(0)
+
+    def tensors(self):
+        return torch.cat(self.states), torch.cat(self.actions), torch.cat(self.costs)
+
+    def save(self, path):
+        states, actions, costs = self.tensors()
+        torch.save({'states': states, 'actions': actions, 'costs': costs, 'block_idx': self.block_idx}, path)
+
+    @classmethod
+    def from_tensors(cls, states, actions, costs, block_idx=None):
+        log = cls(max_rollouts=len(states), block_idx=block_idx)
+        log.states, log.actions, log.costs = [states], [actions], [costs]
+        return log
+
+    @classmethod
+    def load(cls, path):
+        data = torch.load(path)
+        return cls.from_tensors(data['states'], data['actions'], data['costs'], data.get('block_idx'))
+
+    def split(self, fraction, seed=0):
+        """
+            Random split of the rollouts into two logs, the second with the given fraction of them
+        """
+        states, actions, costs = self.tensors()
+        perm = torch.randperm(len(states), generator=torch.Generator().manual_seed(seed))
+        n = int(fraction * len(states))
+        first, second = perm[n:], perm[:n]
+        return (RolloutLog.from_tensors(states[first], actions[first], costs[first], self.block_idx),
+                RolloutLog.from_tensors(states[second], actions[second], costs[second], self.block_idx))
+
+def _fit(model, predict, inputs, targets, scale, epochs, lr, batch_size, val_fraction, generator):
+    """
+        Adam on the mse of predict(model, inputs[batch]) / scale, with a random validation split.
+        Returns the train and validation mse per epoch, in the units of the targets
+    """
+    perm = torch.randperm(len(targets), generator=generator)
+    n_val = int(val_fraction * len(targets))
+    val_idx, train_idx = perm[:n_val], perm[n_val:]
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    history = {'train': [], 'val': []}
+    for _ in range(epochs):
+        model.train()
+        batches = train_idx[torch.randperm(len(train_idx), generator=generator)].split(batch_size)
+        train_loss = 0.
+        for batch in batches:
+            loss = torch.mean(((predict(model, inputs[batch]) - targets[batch]) / scale)**2)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            train_loss += loss.item() * len(batch)
+        history['train'].append(train_loss / len(train_idx) * torch.mean(scale**2).item())
+        model.eval()
+        with torch.no_grad():
+            history['val'].append(torch.mean((predict(model, inputs[val_idx]) - targets[val_idx])**2).item() if n_val else float('nan'))
+    return history
+
+#################### Terminal Value ####################
+class TerminalValue(torch.nn.Module):
+    """
+        Discounted cost of the tail steps that follow a state, sum_j gamma^j c_{t+j} for j = 1..tail.
+        As terminal_state_cost of a planner with horizon T, it stands in for the steps of a planner with horizon
+        T + tail. The model only sees the rollout states, so everything the cost depends on (e.g. the block in the
+        analytic push) has to be part of them, and the goal has to be the one of the training rollouts
+    """
+    def __init__(self, nx, hidden=64, layers=2, tail=10, gamma=0.95):
+        super().__init__()
+        self.config = {'nx': nx, 'hidden': hidden, 'layers': layers, 'tail': tail, 'gamma': gamma}
+        self.net = mlp(nx, 1, hidden, layers)
+        # Normalization of the inputs and the targets, set from the training data
+        self.register_buffer('state_mean', torch.zeros(nx))
+        self.register_buffer('state_std', torch.ones(nx))
+        self.register_buffer('cost_mean', torch.zeros(()))
+        self.register_buffer('cost_std', torch.ones(()))
+
+    def forward(self, states):
+        x = (states - self.state_mean) / self.state_std
+        return self.net(x).squeeze(-1) * self.cost_std + self.cost_mean
+
+    def terminal_cost(self, states, actions):
+        """
+            terminal_state_cost of MPPI, value of the final rollout states. Input: states [K, T, nx], output [K]
+        """
+        return self(states[:, -1].to(self.state_mean.dtype))
+
+    def save(self, path):
+        torch.save({'config': self.config, 'state_dict': self.state_dict()}, path)
+
+def value_dataset(states, costs, tail, gamma):
+    """
+        Inputs [N * (T - tail), nx] and targets of the terminal value from logged rollouts: the states of every
+        step with tail steps after them, and the discounted cost of these steps
+    """
+    T = costs.shape[1]
+    if tail >= T:
+        raise ValueError("The value tail ({}) has to be shorter than the logged horizon ({})".format(tail, T))
+    discount = gamma ** torch.arange(1, tail + 1, dtype=costs.dtype)
+    windows = costs.unfold(1, tail, 1)[:, 1:] # [N, T - tail, tail] Costs of the steps after every state
+    targets = torch.sum(windows * discount, dim=-1)
+    inputs = states[:, :T - tail]
+    return inputs.reshape(-1, states.shape[-1]), targets.reshape(-1)
+
+def train_value(log, tail, gamma=0.95, hidden=64, layers=2, epochs=100, lr=1e-3, batch_size=1024, val_fraction=0.1, seed=0):
+    """
+        Fits a TerminalValue to the rollouts of a RolloutLog. Returns the model (on the CPU, in eval mode and
+        without gradients for its parameters) and the train and validation mse per epoch, in cost units
+    """
+    generator = torch.Generator().manual_seed(seed)
+    states, _, costs = log.tensors()
+    inputs, targets = value_dataset(states, costs, tail, gamma)
+    finite = torch.isfinite(targets) & torch.all(torch.isfinite(inputs), dim=1)
+    inputs, targets = inputs[finite], targets[finite]
+
+    model = TerminalValue(inputs.shape[1], hidden, layers, tail, gamma)
+    model.state_mean.copy_(inputs.mean(dim=0))
+    model.state_std.copy_(inputs.std(dim=0).clamp(min=1e-6))
+    model.cost_mean.copy_(targets.mean())
+    model.cost_std.copy_(targets.std().clamp(min=1e-6))
+    history = _fit(model, lambda model, x: model(x), inputs, targets, model.cost_std, epochs, lr, batch_size,
+                   val_fraction, generator)
+    return model.requires_grad_(False), history
+
+def load_terminal_value(path, tensor_args):
+    """
+        TerminalValue saved with TerminalValue.save, on the device and in the dtype of tensor_args
+    """
+    data = torch.load(path, map_location=tensor_args['device'])
+    model = TerminalValue(**data['config'])
+    model.load_state_dict(data['state_dict'])
+    return model.to(**tensor_args).eval().requires_grad_(False)
+
+#################### Surrogate Dynamics ####################
+class SurrogateDynamics(torch.nn.Module):
+    """
+        Learned dynamics backend, (state, u, t) -> (next_state, u) like the ones of dynamics.py. The MLP predicts the
+        change of the state over one step. With the block in the state, e.g. [pos_x, vel_x, pos_y, vel_y, block_x,
+        block_y] as in dynamics.PointPushDynamics with block_idx [4, 5], M3P2I computes the push and pull costs from
+        the block_idx columns. block_idx is saved with the model, a state of the same size without a block (heijn)
+        has None. Contacts and the suction of the pull are whatever the logged rollouts did, so a model is trained
+        per skill
+    """
+    def __init__(self, nx, nu, block_idx=None, hidden=128, layers=2):
+        super().__init__()
+        self.config = {'nx': nx, 'nu': nu, 'block_idx': block_idx, 'hidden': hidden, 'layers': layers}
+        self.block_idx = block_idx
+        self.net = mlp(nx + nu, nx, hidden, layers)
+        # Normalization of the inputs and the state changes, set from the training data
+        self.register_buffer('input_mean', torch.zeros(nx + nu))
+        self.register_buffer('input_std', torch.ones(nx + nu))
+        self.register_buffer('delta_mean', torch.zeros(nx))
+        self.register_buffer('delta_std', torch.ones(nx))
+
+    def forward(self, state, u, t=None):
+        x = torch.cat([state, u], dim=-1).to(self.input_mean.dtype)
+        delta = self.net((x - self.input_mean) / self.input_std) * self.delta_std + self.delta_mean
+        return (x[..., :state.shape[-1]] + delta).to(state.dtype), u
+
+    def save(self, path):
+        torch.save({'config': self.config, 'state_dict': self.state_dict()}, path)
+
+def transition_dataset(states, actions):
+    """
+        (state, action) inputs [N * (T - 1), nx + nu] and next states [N * (T - 1), nx] from logged rollouts. The
+        start state of the rollouts is not logged, so the first step is left out
+    """
+    nx = states.shape[-1]
+    inputs = torch.cat([states[:, :-1], actions[:, 1:]], dim=-1)
+    return inputs.reshape(-1, inputs.shape[-1]), states[:, 1:].reshape(-1, nx)
+
+def train_surrogate(log, block_idx=None, hidden=128, layers=2, epochs=100, lr=1e-3, batch_size=1024, val_fraction=0.1, seed=0):
+    """
+        Fits a SurrogateDynamics to the transitions of a RolloutLog, with the block_idx of the log unless given.
+        Returns the model (on the CPU, in eval mode and without gradients for its parameters) and the train and
+        validation mse of the next state per epoch
+    """
+    generator = torch.Generator().manual_seed(seed)
+    states, actions, _ = log.tensors()
+    inputs, targets = transition_dataset(states, actions)
+    finite = torch.all(torch.isfinite(inputs), dim=1) & torch.all(torch.isfinite(targets), dim=1)
+    inputs, targets = inputs[finite], targets[finite]
+    nx = targets.shape[1]
+
+    model = SurrogateDynamics(nx, inputs.shape[1] - nx, log.block_idx if block_idx is None else block_idx, hidden, layers)
+    deltas = targets - inputs[:, :nx]
+    model.input_mean.copy_(inputs.mean(dim=0))
+    model.input_std.copy_(inputs.std(dim=0).clamp(min=1e-6))
+    model.delta_mean.copy_(deltas.mean(dim=0))
+    model.delta_std.copy_(deltas.std(dim=0).clamp(min=1e-6))
+    predict = lambda model, x: model(x[:, :nx], x[:, nx:])[0]
+    history = _fit(model, predict, inputs, targets, model.delta_std, epochs, lr, batch_size, val_fraction, generator)
+    return model.requires_grad_(False), history
+
+def multi_step_error(dynamics, states, actions):
+    """
+        Open-loop prediction of logged rollouts from their first state with their actions. Returns the mean distance
+        to the logged robot positions and, for states with a block, block positions at every step [T - 1]
+    """
+    block_idx = getattr(dynamics, 'block_idx', None)
+    state = states[:, 0]
+    robot_error, block_error = [], []
+    with torch.no_grad():
+        for t in range(1, states.shape[1]):
+            state, _ = dynamics(state, actions[:, t], t)
+            robot_error.append(torch.linalg.norm(state[:, [0, 2]] - states[:, t, [0, 2]], dim=1).mean())
+            if block_idx is not None:
+                block_error.append(torch.linalg.norm(state[:, block_idx] - states[:, t, block_idx], dim=1).mean())
+    return torch.stack(robot_error), torch.stack(block_error) if block_error else None
+
+def load_surrogate_dynamics(path, tensor_args):
+    """
+        SurrogateDynamics saved with SurrogateDynamics.save, on the device and in the dtype of tensor_args
+    """
+    data = torch.load(path, map_location=tensor_args['device'])
+    model = SurrogateDynamics(**data['config'])
+    model.load_state_dict(data['state_dict'])
+    return model.to(**tensor_args).eval().requires_grad_(False)
@@ -1,14 +1,25 @@
-import torch
-from isaacgym import gymtorch, gymapi
-from m3p2i_aip.utils import sim_init, skill_utils, mppi_utils
+import torch, math
+try:
+    from isaacgym import gymtorch, gymapi
+    from m3p2i_aip.utils import sim_init
+except ImportError:
+    # Only the analytic dynamics backends can be used without IsaacGym
+    gymtorch, gymapi, sim_init = None, None, None
+from m3p2i_aip.utils import skill_utils, mppi_utils
 import m3p2i_aip.planners.motion_planner.mppi as mppi
+from m3p2i_aip.planners.motion_planner import dynamics as dynamics_backends
 
 class M3P2I(mppi.MPPI):
     def __init__(self, params, dynamics=None, running_cost=None):
+        if dynamics is None:
+            dynamics = dynamics_backends.get_dynamics(params)
         super().__init__(params, dynamics, running_cost)
+        # Rollouts are simulated in IsaacGym unless an analytic dynamics backend is given
+        self.use_gym = self.F is None
+        if self.use_gym and gymtorch is None:
+            raise ImportError("IsaacGym is required for the isaacgym dynamics backend")
         self.kp_suction = 400
         self.suction_active = params.suction_active
-        self.env_type = params.environment_type
         
         # Additional variables for the environment
         if self.env_type == "normal":
@@ -21,7 +32,17 @@ class M3P2I(mppi.MPPI):
         self.task = "navigation"  # "navigation", "push", "pull", "push_not_goal"
         self.align_weight = {"heijn":1, "point_robot":0.5, "boxer":1}
         self.align_offset = {"heijn":0.1, "point_robot":0.05}
-        self.goal_quaternion = torch.tensor([0, 0, 0, 1], device=self.device).repeat(self.num_envs).view(self.num_envs, 4)
+        self.goal_quaternion = torch.tensor([0, 0, 0, 1], device=self.device) # Expanded to the rollouts, see _block_ori_cost
+        self.multi_modal_eta_target = math.sqrt(3 * 10) # Significant samples per mode, within [3, 10]
+        # Modes of the multi-modal tasks, one block of samples each
+        self.hybrid_modes = ['push', 'pull']    # Skill of every mode of the hybrid task
+        self.pick_tilts = [0, 0.5]              # Tilt between end effector and cube of every mode of the multi-modal pick
+
+        # Analytic backends with a block in the state, see dynamics.PointPushDynamics. Their blocks do not rotate
+        self.block_idx = getattr(self.F, 'block_idx', None)
+        # Append the block position to the IsaacGym rollout states, in the layout of PointPushDynamics, so that
+        # logged rollouts can train a surrogate of the push and pull, see learned_models.py
+        self.block_in_state = False
 
         # Store obstacle list
         self.allow_dyn_obs = True
@@ -36,6 +57,14 @@ class M3P2I(mppi.MPPI):
             self.obs_list = torch.tensor(0, device=self.device) 
             self.allow_dyn_obs = False
         # self.obs_list = torch.arange(self.bodies_per_env, device=self.device) # avoid all obstacles
+        # Obs boundary [-2.5, 1.5] <--> [-1.5, 2.5]
+        self.obs_lb = torch.tensor([-2.5, 1.5], **self.tensor_args)
+        self.obs_ub = torch.tensor([-1.5, 2.5], **self.tensor_args)
+
+        # Cost buffers written in place at every rollout step
+        self.align_cost = torch.zeros(self.num_envs, **self.tensor_args)
+        self.vel_cost = torch.zeros(self.num_envs, **self.tensor_args)
+        self.suction_forces = None  # [num_envs, bodies_per_env, 3]
 
     def update_gym(self, gym, sim, viewer=None):
         self.gym = gym
@@ -66,6 +95,9 @@ class M3P2I(mppi.MPPI):
     
     def update_task(self, task, goal):
         self.task = task
+        if torch.is_tensor(goal) and goal.dim() == 2:
+            # One goal per problem of command_batch, repeated for the K rollouts of each problem
+            goal = goal.repeat_interleave(self.K, dim=0)
         if self.task in ['navigation', 'go_recharge']:
             self.nav_goal = goal
         elif self.task in ['push', 'pull', 'hybrid']:
@@ -74,100 +106,111 @@ class M3P2I(mppi.MPPI):
             self.cube_goal_state = goal
         elif self.task == 'place':
             self.ee_goal = goal
+        if self.task == 'hybrid':
+            self.set_num_modes(len(self.hybrid_modes))
+        elif self.task == 'pick' and self.multi_modal:
+            self.set_num_modes(len(self.pick_tilts))
         # if self.robot == 'albert':
         #     self.cube_goal_state = torch.tensor([0.5, 0.2, 0.7, 0, 0, 0, 1], device='cuda:0')
     
     def update_params(self, params, weight_prefer_pull):
+        """
+            weight_prefer_pull is the preferred mode from get_weights_preference, -1 if there is none
+        """
         self.params = params
-        if self.task == 'hybrid' and weight_prefer_pull == 1:
+        if self.task == 'hybrid' and weight_prefer_pull >= 0 and self.hybrid_modes[weight_prefer_pull] == 'pull':
             params.suction_active = True
         else:
             self.suction_active = params.suction_active
         return params
 
     def get_weights_preference(self):
+        """
+            Mode of the hybrid task with the largest total weight, -1 for the other tasks
+        """
         if self.task == 'hybrid':
-            weight_push = torch.sum(self.weights[:int(self.num_envs/2)]).item()
-            weight_pull = torch.sum(self.weights[int(self.num_envs/2):]).item()
-            return int(weight_pull > weight_push)
+            mode_weights = torch.zeros(self.num_modes, **self.tensor_args).index_add_(0, self.mode_idx, self.weights)
+            return torch.argmax(mode_weights).item()
         else:
             return -1
         
-    def update_infinite_beta(self, costs, beta, eta_u_bound, eta_l_bound):
-        """
-            Update the inverse temperature on the fly
-        """
-        found = False
-        # Makes sure beta is properly tuned before computing the weights
-        while not found:
-        # Normalization of the weights
-            exp_ = torch.exp((-1.0/beta) * costs)
-            eta = torch.sum(exp_)       # tells how many significant samples we have, more or less
-
-            # Update beta to make eta converge within the bounds
-            beta_lm = 0.9
-            beta_um = 1.2
-            if eta > eta_u_bound:
-                beta = beta * beta_lm
-            elif eta < eta_l_bound:
-                beta = beta * beta_um
-            else:
-                found = True
-        return eta, exp_
-
     def _multi_modal_exp_util(self, costs):
         """
            Calculate weights using exponential utility given cost
            Iuput: costs [K, T], costs within horizon
         """
-        traj_costs = mppi_utils.cost_to_go(costs, self.gamma_seq) # [K, T]
+        traj_costs = mppi_utils.cost_to_go(costs.to(self.dtype), self.gamma_seq) # [K, T]
         traj_costs = traj_costs[:,0] # [K] Costs for the next timestep
-
-        total_costs_1 = traj_costs[:self.half_K] - torch.min(traj_costs[:self.half_K])
-        total_costs_2 = traj_costs[self.half_K:] - torch.min(traj_costs[self.half_K:])
-        total_costs = traj_costs - torch.min(traj_costs)
-        # print('1', total_costs_1)
-        # print('2', total_costs_2)
-        eta_1, exp_1 = self.update_infinite_beta(total_costs_1, self.beta_1, 10, 3)
-        eta_2, exp_2 = self.update_infinite_beta(total_costs_2, self.beta_2, 10, 3)
-        eta, exp_ = self.update_infinite_beta(total_costs, self.beta, 10, 3)
-        # exp_ = torch.exp((-1.0/self.beta) * total_costs)
-        # eta = torch.sum(exp_)
-
-        self.weights_1 = 1 / eta_1 * exp_1 
-        self.weights_2 = 1 / eta_2 * exp_2
-        self.weights = 1 / eta * exp_ 
+        self.traj_costs = traj_costs
+
+        # Temperatures of every mode and of all samples, solved at once with the samples of the other modes
+        # masked out, so that eta is within [3, 10] for each of them
+        mode_costs = torch.where(self.mode_mask, traj_costs, torch.full_like(traj_costs, float('inf'))) # [M+1, K]
+        betas, etas, exp_ = mppi_utils.solve_temperature(mode_costs, self.multi_modal_eta_target, self.beta_iterations)
+        self.beta_modes, self.beta = betas[:-1], betas[-1]
+
+        # [M, K] weights of the samples normalized within their mode, zero outside of it
+        self.mode_weight_matrix = exp_[:-1] / etas[:-1].unsqueeze(1)
+        self.mode_weights = torch.sum(self.mode_weight_matrix, dim=0) # [K]
+        self.weights = exp_[-1] / etas[-1]
+        if self.trunc_log_mass is not None:
+            # Truncated samples weighted by p/q against the Gaussian of their mode, the mass of the box under it.
+            # It differs between the modes, within a mode it cancels
+            self.weights = self.weights * torch.exp(self.trunc_log_mass - torch.max(self.trunc_log_mass))
+            self.weights = self.weights / torch.sum(self.weights)
         # print('weights', self.weights.size())
     
     def _update_multi_modal_distribution(self, costs, actions):
         """
             Update moments using sample trajectories.
-            So far only mean is updated, eventually one could also update the covariance
+            The means, best trajectories and, with update_cov, the covariances of all modes are updated at once
+            from their own samples
         """
 
         self._multi_modal_exp_util(costs)
 
-        # # Update best action
-        self.best_idx_1 = torch.argmax(self.weights_1)
-        self.best_idx_2 = torch.argmax(self.weights_2)
-        self.best_traj_1 = torch.index_select(actions, 0, self.best_idx_1).squeeze(0)
-        self.best_traj_2 = torch.index_select(actions, 0, self.best_idx_2+self.half_K).squeeze(0)
+        # Update best action of every mode
+        self.best_idx_modes = torch.argmax(self.mode_weight_matrix, dim=1) # [M]
+        self.best_traj_modes = actions[self.best_idx_modes].to(self.dtype)
        
         weighted_seq = self.weights.view(-1, 1, 1) * actions # [K, T, nu]
-        # print(actions)
-        self.mean_action_1 = torch.sum(self.weights_1.view(-1, 1, 1) * actions[:self.half_K], dim=0)
-        self.mean_action_2 = torch.sum(self.weights_2.view(-1, 1, 1) * actions[self.half_K:], dim=0)
+        mode_weighted_seq = self.mode_weights.view(-1, 1, 1) * actions
+        self.mean_action_modes = torch.zeros_like(self.mean_action_modes).index_add_(0, self.mode_idx, mode_weighted_seq)
+
+        # Covariance of every mode from its own samples
+        if self.update_cov:
+            self.cov_action_modes = self._update_cov(self.cov_action_modes, self.mode_weights,
+                                                     actions - self.mean_action_modes[self.mode_idx], self.mode_idx)
+            self.scale_tril_modes = torch.sqrt(self.cov_action_modes)
 
         # Gradient update for the mean
         self.mean_action = (1.0 - self.step_size_mean) * self.mean_action +\
             self.step_size_mean * torch.sum(weighted_seq, 0)
-        # print(torch.sum(weighted_seq, 0))
         # print(self.mean_action.size()) # [T, nu]
        
         delta = actions - self.mean_action.unsqueeze(0)
 
+        # Samples of every mode at the next tick
+        if self.adaptive_modes:
+            self._allocate_mode_samples(self.traj_costs)
+
         return delta
 
+    def _cost_buffer(self, buffer, x):
+        """
+            Cost buffer to write a cost computed from x into, None for rollouts of another size or when x needs
+            gradients, see MPPI._refine_mean
+        """
+        if x.requires_grad or x.shape != buffer.shape:
+            return None
+        return buffer
+
+    def _block_ori_cost(self):
+        # One goal orientation for every rollout, B*K of them in command_batch. The analytic blocks keep it
+        goal_quaternion = self.goal_quaternion.expand(self.block_pos.shape[0], 4)
+        block_quat = goal_quaternion if self.block_idx is not None else self.block_quat
+        return skill_utils.get_general_ori_cube2goal(block_quat, goal_quaternion)
+
     def get_navigation_cost(self):
         return torch.clamp(torch.linalg.norm(self.robot_pos - self.nav_goal, axis=1)-0.05, min=0, max=1999) 
     
@@ -187,12 +230,11 @@ class M3P2I(mppi.MPPI):
 
         # Force the robot behind block and goal, align_cost is actually cos(theta)+1
         # align_cost = self.align_weight[self.robot] * (self.cos_theta + 1) * 5
-        align_cost = torch.zeros(self.num_envs, **self.tensor_args)
-        align_cost[self.cos_theta>0] = self.cos_theta[self.cos_theta>0]
+        align_cost = torch.clamp(self.cos_theta, min=0, out=self._cost_buffer(self.align_cost, self.cos_theta)).nan_to_num_(nan=0)
         # print('push align', align_cost[:10])
         # if self.robot != 'boxer':
         #     align_cost += torch.abs(self.robot_to_goal_dist - self.block_to_goal_dist - self.align_offset[self.robot])
-        ori_cost = skill_utils.get_general_ori_cube2goal(self.block_quat, self.goal_quaternion)
+        ori_cost = self._block_ori_cost()
  
         return 3 * self.dist_cost + 1 * align_cost #+ 10 * ori_cost# [num_envs] 31
     
@@ -201,30 +243,34 @@ class M3P2I(mppi.MPPI):
         # True means the velocity moves towards block, otherwise means pull direction
         flag_towards_block = torch.sum(self.robot_vel*pos_dir, 1) > 0
 
-        # simulation of a magnetic/suction effect to attach to the box
-        suction_force, dir, mask = skill_utils.calculate_suction(self.block_pos, self.robot_pos, self.num_envs, self.kp_suction, self.block_index, self.bodies_per_env)
-        # Set no suction force if robot moves towards the block
-        suction_force[flag_towards_block] = 0
-        if hybrid:
-            suction_force[:self.half_K] = 0
-        # Apply suction/magnetic force
-        self.gym.apply_rigid_body_force_tensors(self.sim, gymtorch.unwrap_tensor(torch.reshape(suction_force, (self.num_envs*self.bodies_per_env, 3))), None, gymapi.ENV_SPACE)
+        # simulation of a magnetic/suction effect to attach to the box, learned dynamics include it already
+        if self.use_gym:
+            if self.suction_forces is None:
+                self.suction_forces = torch.zeros((self.num_envs, self.bodies_per_env, 3), **self.tensor_args)
+            suction_force, dir, mask = skill_utils.calculate_suction(self.block_pos, self.robot_pos, self.num_envs, self.kp_suction, self.block_index, self.bodies_per_env, forces=self.suction_forces)
+            # Set no suction force if robot moves towards the block
+            suction_force[flag_towards_block] = 0
+            if hybrid:
+                # Only the pull modes use the suction
+                for mode, samples in zip(self.hybrid_modes, self.mode_slices):
+                    if mode != 'pull':
+                        suction_force[samples] = 0
+            # Apply suction/magnetic force
+            self.gym.apply_rigid_body_force_tensors(self.sim, gymtorch.unwrap_tensor(torch.reshape(suction_force, (self.num_envs*self.bodies_per_env, 3))), None, gymapi.ENV_SPACE)
 
         # Calculate dist cost
         self.calculate_dist()
 
         # Force the robot to be in the middle between block and goal, align_cost is actually 1-cos(theta)
         # align_cost = (1 - self.cos_theta) * 5
-        align_cost = torch.zeros(self.num_envs, **self.tensor_args)
-        align_cost[self.cos_theta<0] = -self.cos_theta[self.cos_theta<0]
+        align_cost = torch.clamp(self.cos_theta, max=0, out=self._cost_buffer(self.align_cost, self.cos_theta)).neg_().nan_to_num_(nan=0)
         # print('pull align', align_cost[-10:])
 
         # Add the cost when the robot is close to the block and moves towards the block
-        vel_cost = torch.zeros(self.num_envs, **self.tensor_args)
         robot_block_close = self.robot_to_block_dist <= 0.5
-        vel_cost[flag_towards_block*robot_block_close] = 0.6
+        vel_cost = torch.mul(flag_towards_block*robot_block_close, 0.6, out=self._cost_buffer(self.vel_cost, robot_block_close))
 
-        ori_cost = skill_utils.get_general_ori_cube2goal(self.block_quat, self.goal_quaternion)
+        ori_cost = self._block_ori_cost()
 
         return 3 * self.dist_cost + vel_cost + 5 * align_cost #+ 10 * ori_cost # [num_envs] 315 
 
@@ -233,9 +279,7 @@ class M3P2I(mppi.MPPI):
         return torch.linalg.norm(self.robot_pos - self.block_pos, axis = 1) + non_goal_cost
 
     def _predict_dyn_obs(self, factor, t):
-        # Obs boundary [-2.5, 1.5] <--> [-1.5, 2.5]
-        obs_lb = torch.tensor([-2.5, 1.5], **self.tensor_args)
-        obs_ub = torch.tensor([-1.5, 2.5], **self.tensor_args)
+        obs_lb, obs_ub = self.obs_lb, self.obs_ub
         self.dyn_obs_vel = torch.clamp(self.dyn_obs_vel, min = -0.001, max = 0.001)
         pred_pos = self.dyn_obs_pos + t * self.dyn_obs_vel * 10
         # Check the prec_pos and boundary
@@ -301,12 +345,10 @@ class M3P2I(mppi.MPPI):
             # To make the z-axis direction of end effector to be perpendicular to the cube surface
             ori_ee2cube = skill_utils.get_general_ori_ee2cube(ee_quaternion, cube_quaternion, tilt_value=0)
         else:
-            # To combine costs of different tilt angles
-            cost_1 = skill_utils.get_general_ori_ee2cube(ee_quaternion[:self.half_K], 
-                                                         cube_quaternion[:self.half_K], tilt_value = 0)
-            cost_2 = skill_utils.get_general_ori_ee2cube(ee_quaternion[self.half_K:], 
-                                                         cube_quaternion[self.half_K:], tilt_value = 0.5) #0.9
-            ori_ee2cube =  torch.cat((cost_1, cost_2), dim=0)
+            # To combine costs of different tilt angles, one per mode
+            ori_ee2cube = torch.cat([skill_utils.get_general_ori_ee2cube(ee_quaternion[samples], cube_quaternion[samples],
+                                                                         tilt_value=tilt)
+                                     for tilt, samples in zip(self.pick_tilts, self.mode_slices)], dim=0)
 
         return 3 * ori_ee2cube
 
@@ -342,8 +384,20 @@ class M3P2I(mppi.MPPI):
         pick_cost[goal_cost<0.1] = 0
         return pick_cost #+ 100 * gripper_cost
 
+    def _set_rollout_state(self, states):
+        # Analytic backends keep the [pos_x, vel_x, pos_y, vel_y] layout, expose it to the costs
+        self.robot_pos = states[:, [0, 2]]
+        self.robot_vel = states[:, [1, 3]]
+        if self.block_idx is not None:
+            self.block_pos = states[:, self.block_idx]
+
     @mppi.handle_batch_input
     def _dynamics(self, state, u, t):
+        if not self.use_gym:
+            states, u = self.F(state, u, t)
+            self._set_rollout_state(states)
+            return states, u
+
         # Use inverse kinematics if the MPPI action space is different than dof velocity space
         u_ = skill_utils.apply_ik(self.robot, u) # forward simulate for the rollouts
         self.gym.set_dof_velocity_target_tensor(self.sim, gymtorch.unwrap_tensor(u_))
@@ -358,6 +412,8 @@ class M3P2I(mppi.MPPI):
                               self.robot_vel[:, 0], 
                               self.robot_pos[:, 1], 
                               self.robot_vel[:, 1]], dim=1) # [num_envs, 4]
+        if self.block_in_state:
+            states = torch.cat([states, self.block_pos[:, :2]], dim=1) # [num_envs, 6]
         return states, u
 
     def get_motion_cost(self, t):
@@ -396,7 +452,8 @@ class M3P2I(mppi.MPPI):
         elif self.task == 'push_not_goal':
             task_cost = self.get_push_not_goal_cost()
         elif self.task == 'hybrid':
-            return torch.cat((self.get_push_cost()[:self.half_K], self.get_pull_cost(True)[self.half_K:]), dim=0)
+            costs = {'push':self.get_push_cost(), 'pull':self.get_pull_cost(True)}
+            return torch.cat([costs[mode][samples] for mode, samples in zip(self.hybrid_modes, self.mode_slices)], dim=0)
             # print('push cost', task_cost[:10])
             # print('pull cost', task_cost[self.num_envs-10:])
         elif self.task == 'pick':
@@ -407,6 +464,7 @@ class M3P2I(mppi.MPPI):
         else:
             task_cost = 0
 
-        total_cost = task_cost + self.get_motion_cost(t)
+        # Contact forces and dynamic obstacles are only known in IsaacGym
+        total_cost = task_cost + self.get_motion_cost(t) if self.use_gym else task_cost
         
         return  total_cost
\ No newline at end of file
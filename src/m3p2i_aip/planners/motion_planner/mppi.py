@@ -1,8 +1,7 @@
-from scipy import signal
-import torch, logging, functools, numpy as np, scipy.interpolate as si
+import torch, math, time, logging, functools, numpy as np, scipy.interpolate as si
 from torch.distributions.multivariate_normal import MultivariateNormal
-from m3p2i_aip.utils.skill_utils import _ensure_non_zero, is_tensor_like, bspline
-from m3p2i_aip.utils.mppi_utils import generate_gaussian_halton_samples, scale_ctrl, cost_to_go
+from m3p2i_aip.utils.skill_utils import _ensure_non_zero, is_tensor_like
+from m3p2i_aip.utils.mppi_utils import generate_gaussian_halton_samples, generate_sobol_samples, uniform_to_gaussian, generate_colored_noise, truncate_gaussian_samples, scale_ctrl, cost_to_go, bspline_basis, batched_bspline, smoothing_bspline, load_sample_bank, savgol_coeffs, savgol_filter, RolloutWorkspace, NoisePool, solve_temperature
 logger = logging.getLogger(__name__)
 
 def handle_batch_input(func):
@@ -48,26 +47,35 @@ class MPPI():
 
     Code based off https://github.com/UM-ARM-Lab/pytorch_mppi and https://github.com/NVlabs/storm
 
-    This mppi can run in two modes: 'simple' and a 'halton-spline':
+    This mppi can run in three modes: 'simple', 'halton-spline' and 'stein':
         - simple:           random sampling at each MPPI iteration from normal distribution with simple mean update. To use this set 
-                            mppi_mode = 'simple_mean'
+                            mppi_mode = 'simple_mean', or sample_mode = 'colored' for temporally correlated noise
         - halton-spline:    samples only at the start a halton-spline which is then shifted according to the current moments of the control distribution. 
                             Moments are updated using gradient. To use this set
                             mppi_mode = 'halton-spline', sample_mode = 'halton'
                             Alternatively, one can also sample random trajectories at each iteration using gradient mean update by setting
                             mppi_mode = 'halton-spline', sample_mode = 'random'
+                            or scrambled Sobol splines, randomly shifted at each iteration, by setting
+                            mppi_mode = 'halton-spline', sample_mode = 'sobol'
+                            or power-law (1/f^noise_beta) colored noise at each iteration by setting
+                            mppi_mode = 'halton-spline', sample_mode = 'colored'
+        - stein:            a few particle means sampled like halton-spline, moved together with a Stein variational
+                            gradient step on the MPPI-weighted gradient estimate, so that the particles spread over
+                            the modes of the cost. To use this set mppi_mode = 'stein', any sample_mode
     """
 
     def __init__(self, params, dynamics=None, running_cost=None):
         """
-        :param dynamics: function(state, action) -> next_state (K x nx) taking in batch state (K x nx) and action (K x nu)
+        :param dynamics: function(state, action, t) -> (next_state (K x nx), action (K x nu)) taking in batch state (K x nx) and action (K x nu),
+            see dynamics.py for the analytic backends. None when the subclass simulates the rollouts itself
         :param running_cost: function(state, action) -> cost (K) taking in batch state and action (same as dynamics)
         :param nx: state dimension
         :param noise_sigma: (nu x nu) control noise covariance (assume v_t ~ N(u_t, noise_sigma))
         :param num_samples: K, number of trajectories to sample
         :param horizon: T, length of each trajectory
         :param device: pytorch device
-        :param terminal_state_cost: function(state) -> cost (K x 1) taking in batch state
+        :param terminal_state_cost: function(states, actions) -> cost (K) taking in the batch rollouts (K x T x nx) and (K x T x nu),
+            or the path of a TerminalValue saved by learned_models.py
         :param lambda_: temperature, positive scalar where larger values will allow more exploration
         :param noise_mu: (nu) control noise mean (used to bias control samples); defaults to zero mean
         :param u_min: (nu) minimum values for each dimension of control to pass into dynamics
@@ -86,7 +94,6 @@ class MPPI():
         # Utility vars
         self.num_envs = params.num_envs
         self.K = params.num_envs 
-        self.half_K = int(self.K/2)
         self.T = params.horizon  
         self.filter_u = params.filter_u
         self.lambda_ = 1.
@@ -95,6 +102,7 @@ class MPPI():
         self.sample_null_action = params.sample_null_action
         self.u_per_command = params.u_per_command
         self.robot = params.robot
+        self.env_type = params.environment_type
         self.tensor_args = params.tensor_args
         self.device = self.tensor_args['device']
         self.dtype = self.tensor_args['dtype']
@@ -123,10 +131,11 @@ class MPPI():
         u_init = torch.zeros_like(noise_mu)
         self.mean_action = torch.zeros((self.T, self.nu), **self.tensor_args)
         self.best_traj = self.mean_action.clone()
-        self.best_traj_1 = self.mean_action.clone()
-        self.best_traj_2 = self.mean_action.clone()
-        self.mean_action_1 = torch.zeros((self.T, self.nu), **self.tensor_args)
-        self.mean_action_2 = torch.zeros((self.T, self.nu), **self.tensor_args)
+
+        # Batched planning of independent problems, see command_batch
+        self.num_problems = 1
+        self.mean_action_batch = None   # [B, T, nu]
+        self.best_traj_batch = None     # [B, T, nu]
 
         # Bound actions
         self.u_min = params.u_min
@@ -154,6 +163,21 @@ class MPPI():
         self.F = dynamics
         self.running_cost = running_cost
         self.terminal_state_cost = params.terminal_state_cost
+        if isinstance(self.terminal_state_cost, str):
+            from m3p2i_aip.planners.motion_planner.learned_models import load_terminal_value
+            self.terminal_state_cost = load_terminal_value(self.terminal_state_cost, self.tensor_args).terminal_cost
+
+        # Step analytic dynamics over the whole horizon in one TorchScript call, see _scripted_rollout
+        self.compile_rollouts = False
+
+        # Precision of the rollouts: states, actions and the cost horizon can be kept in torch.bfloat16 or
+        # torch.float16, the weights, cost_to_go and the mean update stay in the dtype of tensor_args
+        self.rollout_dtype = self.dtype
+
+        # Preallocated rollout buffers, see RolloutWorkspace
+        self.workspace = None
+        self.workspaces = {}            # One per rollout batch size, the anytime mode alternates two sizes
+        self.pos_idx = torch.tensor([0, 2], device=self.device, dtype=torch.int32)
 
         # Sampled results from last command
         self.state = None
@@ -162,16 +186,32 @@ class MPPI():
         self.weights = None
         self.states = None
         self.actions = None
+        self.ee_l_state = 'None'        # End effector states are only available from IsaacGym
+        self.record_ee_states = False   # Store the end effector rollouts for top_trajs, see subscribe_top_trajs
+        self._top_trajs = None          # Computed on demand from the rollouts of the last command
 
         # Halton sampling 
-        self.knot_scale = 4             # From mppi config storm
+        self.degree = 2                # From sample_lib storm
+        # From mppi config storm. Horizons below 4 * (degree + 1) = 12 had fewer knots than a spline of this degree
+        # needs, they get a smaller knot_scale that keeps degree + 1 knots
+        self.knot_scale = max(1, min(4, self.T//(self.degree + 1)))
         self.seed_val = 0               # From mppi config storm
         self.n_knots = self.T//self.knot_scale
         self.ndims = self.n_knots * self.nu
-        self.degree = 2                # From sample_lib storm
+        self.spline_basis = bspline_basis(self.n_knots, n=self.T, degree=self.degree, device=self.device, float_dtype=self.dtype) # [T, n_knots]
+        self.use_sample_bank = True     # Load halton splines from the shared on-disk cache
+        self.sobol_points = None        # [K, n_knots * nu] uniform points of the sobol sampler
+        self.sobol_shift = True         # Random shift of the sobol points at every tick (Cranley-Patterson rotation)
+        self.noise_beta = torch.full((self.nu,), 2., **self.tensor_args) # Exponents of the colored noise per action dimension
         self.Z_seq = torch.zeros(1, self.T, self.nu, **self.tensor_args)
-        self.cov_action = torch.diagonal(noise_sigma, 0)
+        self.init_cov_action = torch.diagonal(self.noise_sigma, 0)                   # [nu]
+        self.cov_action = self.init_cov_action.repeat(self.T, 1)                     # [T, nu] diagonal per time step
         self.scale_tril = torch.sqrt(self.cov_action)
+        # Cholesky factor of the correlation of noise_sigma, None for a diagonal noise_sigma, see _random_sample_tril.
+        # The halton and sobol samples stay uncorrelated
+        std = torch.sqrt(self.init_cov_action)
+        diagonal = torch.count_nonzero(self.noise_sigma - torch.diag(self.init_cov_action)) == 0
+        self.corr_tril = None if diagonal else torch.linalg.cholesky(self.noise_sigma / torch.outer(std, std))
         self.squash_fn = 'clamp'
         self.step_size_mean = 0.98      # From storm
 
@@ -180,30 +220,201 @@ class MPPI():
         self.gamma_seq = torch.cumprod(torch.tensor([1.0] + [self.gamma] * (self.T - 1)),dim=0).reshape(1, self.T)
         self.gamma_seq = self.gamma_seq.to(**self.tensor_args)
         self.beta = 1 # param storm
-        self.beta_1 = 1
-        self.beta_2 = 1
-        self.beta = 1
+
+        # Modes of the multi-modal planner, see set_num_modes
+        self.num_modes = None
+        self.set_num_modes(2)
+
+        # Gradient refinement of the mean through the analytic dynamics and costs, see _refine_mean
+        self.refine_steps = 0           # Projected gradient steps per tick, 0 disables the refinement
+        self.refine_lr = 0.05           # Adam step size
+        self.refine_improvement = 0.    # Cost decrease, time in ms and decrease per ms of the last refinement
+        self.refine_time = 0.
+        self.refine_rate = 0.
+
+        # Stein variational planning, see _update_stein_distribution
+        self.num_particles = 4          # Particle means, each perturbed by K / num_particles samples
+        self.stein_step = self.step_size_mean # Step of the particles, preconditioned with the covariance
+
+        # Adaptive number of samples per mode, see _allocate_mode_samples
+        self.adaptive_modes = False
+        self.min_mode_fraction = 0.1    # Samples every mode keeps, as a fraction of K
+        self.mode_alloc_decay = 0.9     # Running averages of the best cost and the ESS of every mode
+        self.mode_alloc_temperature = None # Temperature of the best costs, the one of all samples if None
+        self.mode_best_cost = None      # [M]
+        self.mode_ess = None            # [M]
+
+        # Temperature control, beta is solved at every update so that about eta_target samples are significant,
+        # see solve_temperature. None keeps beta fixed
+        self.eta_target = math.sqrt(10 * 20) if self.env_type == 'cube' else None # Within [10, 20], grady's thesis
+        self.beta_iterations = 16
 
         # Filtering
-        self.sgf_window = 9
+        self.sgf_window = min(9, self.T)
         self.sgf_order = 2
         if (self.sgf_window % 2) == 0:
             self.sgf_window -=1       # Some versions of the sav-go filter require odd window size
+        self.sgf_coeffs = savgol_coeffs(self.sgf_window, self.sgf_order, device=self.device, float_dtype=self.dtype)
 
         # Lambda update, for now the update of lambda is not performed
         self.eta_max = 0.1      # 10%
         self.eta_min = 0.01     # 1%
         self.lambda_mult = 0.1  # Update rate
 
+        # Anytime mode, see set_mode and command(state, deadline)
+        self.anytime = False
+        self.anytime_chunk_size = max(1, self.K // 4)  # Rollouts evaluated between two deadline checks
+        self.anytime_margin = 0.9       # Fraction of the deadline the next sample budget is planned for
+        self.sample_budget = self.K     # Rollouts to evaluate at the next anytime tick
+        self.chunk_time = None          # Running averages of the seconds per chunk and outside the chunks
+        self.overhead_time = 0.
+        self.samples_evaluated = self.K
+
+        # Inner iterations, sample-evaluate-update passes per command from the same state
+        self.num_iterations = 1         # Maximum passes, more than one needs a dynamics function
+        self.iteration_tol = 1e-3       # Stop when the mean moves less than this (max abs change)
+        self.iteration_cost_tol = 1e-3  # or when the best cost changes less than this (relative)
+        self.iterations = 1             # Passes used at the last command
+
+        # Rollout reuse, the top reuse_elites samples of a tick are shifted and evaluated again at the next one
+        self.reuse_elites = 0           # E, replaces the last E fresh samples before the null action
+        self.elite_actions = None       # [E, T, nu]
+        self.elite_noise = None         # [E, T, nu] standardized noise under the distribution they were sampled from
+        self.elite_log_std = None       # [E] sum of the log standard deviations of that distribution
+        self.log_iw = None              # [K] log importance weights of the current samples, zero for fresh ones
+        self.max_log_iw = 0.            # Truncation of the log importance weights, see _inject_elites
+        self.ess = self.K               # Effective sample size 1 / sum(w^2) of the last update with reuse
+
+        # Variance reduction of the mean update, see _antithetic_pairs and _control_variate
+        self.antithetic = False         # Consecutive random samples mirror each other
+        self.control_variate = False    # Uni-modal mean update without the drift of the sample mean of the noise
+        self.sample_noise_raw = None    # [K, T, nu] scaled noise of the samples before the bounding
+
+        # Per-tick random noise taken from a pool generated once per configuration, see NoisePool
+        self.use_noise_pool = False
+        self.noise_pool_size = 8        # Sequences in the pool, as a multiple of K
+        self.noise_pool = None
+        self.pool_scale_tril = None     # Cholesky factor of the covariance of the active action dimensions
+        self.pool_noise = None          # [K, T, nu] noise of the simple mode, zero in the inactive dimensions
+
+        # Samples drawn from the Gaussian truncated to [u_min, u_max] instead of clamped, see truncate_gaussian_samples
+        self.truncate_samples = False
+        self.trunc_log_mass = None      # [K] log mass of the box under the Gaussian every sample was truncated from
+
         # covariance update
-        self.update_cov = False   # !! weird if set to True
+        self.update_cov = False
         self.step_size_cov = 0.7
-        self.kappa = 0.005
+        self.kappa = 0.005      # Floor of the variances
     
-    def set_mode(self, mppi_mode, sample_method, multi_modal):
+    def set_mode(self, mppi_mode, sample_method, multi_modal, anytime=False):
+        """
+            anytime allows a deadline in command, it needs the uni-modal halton-spline mode, see _check_anytime.
+            Sample reuse (reuse_elites = E > 0, uni-modal halton-spline mode) keeps K rollouts per tick: the E
+            elites take the places of the last fresh samples, so a tick draws K - 1 - E fresh ones. Their importance
+            weights compare the Gaussian densities of the bounded actions and ignore the clamping onto u_min/u_max,
+            so reused elites at a bound are weighted as if they were drawn inside it.
+            The sobol sampler interpolates its knots with the spline basis, which only matches the smoothing splines
+            of the halton sampler (skill_utils.bspline, s=0.5) for degree + 1 knots. It thus needs a horizon with
+            degree + 1 knots, T in 12..15 (or 3, 6, 7, 9..11) for degree 2, and raises a ValueError for the others
+        """
+        if sample_method == 'sobol' and self.n_knots != self.degree + 1:
+            raise ValueError("The sobol sampler needs degree + 1 = {} knots, the horizon T={} has {}, use the halton "
+                             "or random sampler".format(self.degree + 1, self.T, self.n_knots))
         self.mppi_mode = mppi_mode
         self.sample_method = sample_method
         self.multi_modal = multi_modal and mppi_mode == 'halton-spline'
+        # Samples perturb the mean of their mode, or of their particle in the stein mode
+        self.per_mode_sampling = self.multi_modal or mppi_mode == 'stein'
+        if mppi_mode == 'stein':
+            self._check_stein()
+            self.set_num_modes(self.num_particles)
+        self.anytime = anytime
+        if anytime:
+            self._check_anytime()
+
+    def _check_stein(self):
+        """
+            The particles of the stein mode keep the initial covariance, it is not adapted with update_cov. Checked in
+            set_mode and again at every command, for update_cov set after set_mode
+        """
+        if self.update_cov:
+            raise ValueError("The stein mode keeps the covariance of its particles fixed, got update_cov=True")
+
+    def _check_anytime(self):
+        """
+            Raises a ValueError naming the options the anytime mode does not support. Checked in set_mode and again
+            at every command with a deadline, for the options set after set_mode
+        """
+        if self.F is None:
+            raise ValueError("The anytime mode needs a dynamics function, simulated environments step all K rollouts at once")
+        unsupported = []
+        if self.mppi_mode != 'halton-spline':
+            unsupported.append("mppi_mode='{}'".format(self.mppi_mode))
+        if self.multi_modal:
+            unsupported.append("multi_modal=True")
+        if self.reuse_elites > 0:
+            unsupported.append("reuse_elites={}".format(self.reuse_elites))
+        if unsupported:
+            raise ValueError("The anytime mode needs the uni-modal halton-spline mode without sample reuse, got " +
+                             ", ".join(unsupported))
+
+    def _check_batch(self):
+        """
+            Raises a ValueError naming the options batched planning does not support, checked at every command_batch
+        """
+        if self.F is None:
+            raise ValueError("Batched planning needs a dynamics function, simulated environments only hold K rollouts")
+        unsupported = []
+        if self.mppi_mode != 'halton-spline':
+            unsupported.append("mppi_mode='{}'".format(self.mppi_mode))
+        if self.multi_modal:
+            unsupported.append("multi_modal=True")
+        if self.num_iterations > 1:
+            unsupported.append("num_iterations={}".format(self.num_iterations))
+        if self.refine_steps > 0:
+            unsupported.append("refine_steps={}".format(self.refine_steps))
+        if self.reuse_elites > 0:
+            unsupported.append("reuse_elites={}".format(self.reuse_elites))
+        if self.update_cov:
+            unsupported.append("update_cov=True")
+        if self.truncate_samples:
+            unsupported.append("truncate_samples=True")
+        if unsupported:
+            raise ValueError("Batched planning needs the uni-modal halton-spline mode with a single pass, a fixed "
+                             "covariance and no sample reuse, truncation or refinement, got " + ", ".join(unsupported))
+
+    def set_num_modes(self, num_modes, counts=None):
+        """
+            Number of modes M of the multi-modal planner. Every mode has its own mean, best trajectory, covariance
+            and temperature, stored as [M, ...] tensors, and gets a contiguous block of counts[m] samples, equal
+            blocks by default. The modes are reset when M changes, the samples are only assigned again then or
+            when counts are given
+        """
+        if num_modes == self.num_modes and counts is None:
+            return
+        if num_modes != self.num_modes:
+            self.num_modes = num_modes
+            self.mode_best_cost, self.mode_ess = None, None
+            self.mean_action_modes = torch.zeros((num_modes, self.T, self.nu), **self.tensor_args)
+            self.best_traj_modes = torch.zeros((num_modes, self.T, self.nu), **self.tensor_args)
+            self.cov_action_modes = self.init_cov_action.repeat(num_modes, self.T, 1)
+            self.scale_tril_modes = torch.sqrt(self.cov_action_modes)
+            self.beta_modes = torch.ones(num_modes, **self.tensor_args)
+        if counts is None:
+            counts = [(m + 1) * self.K // num_modes - m * self.K // num_modes for m in range(num_modes)]
+        if len(counts) != num_modes or sum(counts) != self.K or min(counts) < 1:
+            raise ValueError("Every mode needs at least one of the {} samples, got {}".format(self.K, counts))
+
+        self.mode_counts = [int(c) for c in counts]
+        starts = np.cumsum([0] + self.mode_counts[:-1])
+        self.mode_slices = [slice(int(start), int(start) + c) for start, c in zip(starts, self.mode_counts)]
+        counts = torch.tensor(self.mode_counts, device=self.device)
+        modes = torch.arange(num_modes, device=self.device)
+        self.mode_idx = torch.repeat_interleave(modes, counts) # [K] mode of every sample
+        self.mode_start = torch.tensor(starts, device=self.device) # [M] first sample of every mode
+        # [M+1, K] samples of every mode, the last row selects all of them
+        self.mode_mask = torch.cat((self.mode_idx.unsqueeze(0) == modes.unsqueeze(1),
+                                    torch.ones((1, self.K), dtype=torch.bool, device=self.device)), 0)
 
     @handle_batch_input
     def _dynamics(self, state, u, t):
@@ -213,14 +424,30 @@ class MPPI():
     def _running_cost(self, state, u, t):
         return self.running_cost(state, u, t)
 
-    def command(self, state):
+    def command(self, state, deadline=None):
         """
-            Given a state, returns the best action sequence
+            Given a state, returns the best action sequence.
+            With a deadline (seconds from the call), the rollouts are evaluated in chunks and the mean is updated
+            from the samples evaluated in time, see _compute_total_cost_anytime
         """
-        
+        start_time = time.monotonic()
+        if deadline is not None:
+            if not self.anytime:
+                raise ValueError("A deadline needs the anytime mode, see set_mode(..., anytime=True)")
+            self._check_anytime()
+        if self.mppi_mode == 'stein':
+            self._check_stein()
+        if self.num_iterations > 1 and self.F is None:
+            raise ValueError("Inner iterations need a dynamics function, simulated rollouts do not restart from the state")
+        if self.refine_steps > 0 and self.F is None:
+            raise ValueError("The gradient refinement needs differentiable dynamics, simulated rollouts are not")
+        if self.control_variate and self.mppi_mode == 'halton-spline' and self.sample_method == 'halton':
+            raise ValueError("The control variate needs samples drawn at every tick, the halton samples are fixed")
+
         if not torch.is_tensor(state):
             state = torch.tensor(state)
         self.state = state.to(**self.tensor_args)
+        self.num_problems = 1
 
         if self.mppi_mode == 'simple':
             self.U = torch.roll(self.U, -1, dims=0)
@@ -234,109 +461,239 @@ class MPPI():
             self.weights = (1. / eta) * self.cost_total_non_zero # [K]
             
             self.U += torch.sum(self.weights.view(-1, 1, 1) * self.noise, dim=0) # [K, 1, 1] * [K, T, nu] --> [T, nu] sum over K
+            if self.control_variate:
+                self.U -= self._control_variate(self.sample_noise_raw - self.noise_mu)
 
             action = self.U[:self.u_per_command]
 
-        elif self.mppi_mode == 'halton-spline':
+        elif self.mppi_mode in ['halton-spline', 'stein']:
             # shift command 1 time step [T, nu]
             self.mean_action = self._shift_action(self.mean_action)
-            if self.multi_modal:
-                self.mean_action_1 = self._shift_action(self.mean_action_1)
-                self.mean_action_2 = self._shift_action(self.mean_action_2)
-                self.best_traj_1 = self._shift_action(self.best_traj_1)
-                self.best_traj_2 = self._shift_action(self.best_traj_2)
-
-            cost_total = self._compute_total_cost_batch_halton()
+            if self.per_mode_sampling:
+                self.mean_action_modes = self._shift_action(self.mean_action_modes)
+                self.best_traj_modes = self._shift_action(self.best_traj_modes)
+            if self.update_cov:
+                self._shift_cov()
+            if self.elite_actions is not None:
+                self.elite_actions = self._shift_action(self.elite_actions)
+                self.elite_noise = self._shift_action(self.elite_noise)
+
+            if deadline is None:
+                cost_total = self._compute_total_cost_iterations()
+            else:
+                cost_total = self._compute_total_cost_anytime(deadline, start_time)
+            if self.refine_steps > 0:
+                self._refine_mean()
             action = torch.clone(self.mean_action) # !!
         
-        # Compute top n trajs
-        self.top_values, self.top_idx = torch.topk(self.weights, 20)
-        if self.ee_states != 'None':
-            self.top_trajs = torch.index_select(self.ee_states, 0, self.top_idx)
-        else:
-            self.top_trajs = torch.index_select(self.states, 0, self.top_idx)
-            pos_idx = torch.tensor([0, 2], device=self.device, dtype=torch.int32)
-            self.top_trajs = torch.index_select(self.top_trajs, 2, pos_idx)
+        # Top n trajs are computed on demand
+        self._top_trajs = None
 
         # Smoothing with Savitzky-Golay filter
         if self.filter_u:
-            u_ = action.cpu().numpy()
-            u_filtered = signal.savgol_filter(u_, self.sgf_window, self.sgf_order, deriv=0, delta=1.0, axis=0, mode='interp', cval=0.0)
-            if self.device == "cpu":
-                action = torch.from_numpy(u_filtered).to('cpu')
-            else:
-                action = torch.from_numpy(u_filtered).to('cuda')
+            action = savgol_filter(action, self.sgf_coeffs)
         return action
+
+    def command_batch(self, states):
+        """
+            Given the states [B, nx] of B independent problems, returns their best action sequences [B, T, nu].
+            The problems share the samples and are rolled out together as B*K trajectories, the rollouts
+            of problem b are the rows [b*K, (b+1)*K). Weights, best trajectories and means are per problem
+        """
+        self._check_batch()
+
+        if not torch.is_tensor(states):
+            states = torch.tensor(states)
+        B = states.shape[0]
+        if self.mean_action_batch is None or self.mean_action_batch.shape[0] != B:
+            self.mean_action_batch = torch.zeros((B, self.T, self.nu), **self.tensor_args)
+        self.num_problems = B
+        self.state = states.to(**self.tensor_args) # [B, nx], copied to the K rollouts of each problem
+
+        # shift command 1 time step [B, T, nu]
+        self.mean_action_batch = self._shift_action(self.mean_action_batch)
+        self._compute_total_cost_batch_halton()
+        action = torch.clone(self.mean_action_batch)
+
+        # Top n trajs of every problem are computed on demand
+        self._top_trajs = None
+
+        # Smoothing with Savitzky-Golay filter
+        if self.filter_u:
+            action = savgol_filter(action, self.sgf_coeffs)
+        return action
+
+    def subscribe_top_trajs(self):
+        """
+            Records the end effector rollouts from the next command on, so that top_trajs shows them instead of
+            the first two state dimensions. Only needed for the visualization of robots with end effectors
+        """
+        self.record_ee_states = True
+
+    @property
+    def top_trajs(self):
+        """
+            Positions of the n trajectories with the highest weights at the last command, [n, T, 2 or 3] or
+            [B, n, T, 2 or 3] in batch mode. Read it before the next command, the rollouts are overwritten then
+        """
+        if self._top_trajs is None:
+            self._compute_top_trajs()
+        return self._top_trajs
+
+    @property
+    def top_values(self):
+        if self._top_trajs is None:
+            self._compute_top_trajs()
+        return self._top_values
+
+    @property
+    def top_idx(self):
+        if self._top_trajs is None:
+            self._compute_top_trajs()
+        return self._top_idx
+
+    def _compute_top_trajs(self, n=20):
+        weights = self.weights.view(self.num_problems, self.K)
+        top_values, top_idx = torch.topk(weights, min(n, self.K), dim=1)
+        if self.ee_states != 'None':
+            trajs = self.ee_states
+        else:
+            trajs = torch.index_select(self.states, 2, self.pos_idx)
+        trajs = trajs.view(self.num_problems, self.K, self.T, -1)
+        # The number of problems is the one of the last command, a single command after a batch has one
+        problem_idx = torch.arange(self.num_problems, device=self.device).unsqueeze(1) # [B, 1]
+        top_trajs = trajs[problem_idx, top_idx].to(self.dtype)
+        if self.num_problems == 1:
+            top_values, top_idx, top_trajs = top_values[0], top_idx[0], top_trajs[0]
+        self._top_values, self._top_idx, self._top_trajs = top_values, top_idx, top_trajs
     
     def _shift_action(self, action_seq):
         """
-            Given an action_seq [T, nu], make a time shifted sequence
+            Given an action_seq [T, nu] or a batch of them [B, T, nu], make a time shifted sequence
         """
-        saved_action = action_seq[-1]
-        action_seq = torch.roll(action_seq, -1, dims=0)
-        action_seq[-1] = saved_action
+        saved_action = action_seq[..., -1, :]
+        action_seq = torch.roll(action_seq, -1, dims=-2)
+        action_seq[..., -1, :] = saved_action
         return action_seq
 
+    def _shift_cov(self):
+        """
+            Time shift of the covariances with the mean, the new last step starts from the initial covariance
+        """
+        self.cov_action = self._shift_action(self.cov_action)
+        self.cov_action[-1] = self.init_cov_action
+        self.scale_tril = torch.sqrt(self.cov_action)
+        if self.multi_modal:
+            self.cov_action_modes = self._shift_action(self.cov_action_modes)
+            self.cov_action_modes[:, -1] = self.init_cov_action
+            self.scale_tril_modes = torch.sqrt(self.cov_action_modes)
+
+    def _get_workspace(self, K):
+        """
+            Rollout buffers for K rollouts, only allocated again when the configuration changes
+        """
+        if self.workspace is None or not self.workspace.matches(K, self.T, self.nu, self.rollout_dtype):
+            key = (K, self.T, self.nu, self.rollout_dtype)
+            if key not in self.workspaces:
+                self.workspaces[key] = RolloutWorkspace(K, self.T, self.nu, self.tensor_args, self.rollout_dtype)
+            self.workspace = self.workspaces[key]
+        return self.workspace
+
     def _compute_rollout_costs(self, perturbed_actions):
         """
-            Given a sequence of perturbed actions, forward simulates their effects and calculates costs for each rollout
+            Given a sequence of perturbed actions, forward simulates their effects and calculates costs for each rollout.
+            The returned tensors are the buffers of the workspace and are overwritten at the next tick
         """
         K, T, nu = perturbed_actions.shape
         assert nu == self.nu
+        ws = self._get_workspace(K)
 
-        cost_total = torch.zeros(K, **self.tensor_args)
-        cost_horizon = torch.zeros([K, T], **self.tensor_args)
+        cost_total = ws.cost_total.zero_()
         cost_samples = cost_total
 
         # allow propagation of a sample of states (ex. to carry a distribution), or to start with a single state
-        if self.state.shape == (K, self.nx):
-            state = self.state
-        else:
-            state = self.state.view(1, -1).repeat(K, 1)
+        state = ws.get_state(self.state)
 
-        states = []
-        actions = []
-        ee_states = []
+        # Last rollout (of every problem) is a braking manover
+        if self.sample_null_action:
+            perturbed_actions[self.K - 1::self.K] = 0
+        if perturbed_actions.dtype != ws.rollout_dtype:
+            perturbed_actions = perturbed_actions.to(ws.rollout_dtype)
 
-        for t in range(T):
-            u = self.u_scale * perturbed_actions[:, t]
+        states, actions, ee_states, cost_horizon = self._rollout_horizon(state, perturbed_actions, self._scripted_rollout())
 
-            # Last rollout is a braking manover
-            if self.sample_null_action:
-                u[self.K -1, :] = torch.zeros_like(u[self.K -1, :])
-                self.perturbed_action[self.K - 1][t] = u[self.K -1, :]
+        # Terminal cost on the last step, so that the cost-to-go of the halton-spline weights includes it
+        if self.terminal_state_cost:
+            c = self.terminal_state_cost(states, actions)
+            cost_horizon[:, -1] += c.to(cost_horizon.dtype)
+        cost_samples += torch.sum(cost_horizon, dim=1, dtype=cost_samples.dtype)
+        cost_total += cost_samples.mean(dim=0)
+        self.cost_horizon = cost_horizon
+        return cost_total, states, actions, ee_states
 
-            state, u = self._dynamics(state, u, t)
+    def _rollout_horizon(self, state, perturbed_actions, scripted=False):
+        """
+            Horizon loop of the rollouts: steps the dynamics and evaluates the running cost at every time step.
+            Writes states [K, T, nx], actions [K, T, nu], ee_states [K, T, 3] (or 'None') and cost_horizon [K, T]
+            into the workspace and returns them. With scripted, the states of all time steps come from one
+            rollout call of the dynamics and only the costs are evaluated in the loop
+        """
+        K, T, nu = perturbed_actions.shape
+        ws = self.workspace
+        cost_horizon = ws.cost_horizon
+        actions = ws.actions
+        states = None
+        ee_states = 'None'
+        # Costs above the range of float16, e.g. sums with the collision term, saturate instead of becoming inf
+        cost_max = torch.finfo(ws.rollout_dtype).max
+        if scripted:
+            torch.mul(perturbed_actions, self.u_scale, out=actions)
+            states = self.F.rollout(state, actions, ws.get_states(state.shape[-1]))
+
+        for t in range(T):
+            if scripted:
+                state, u = states[:, t], actions[:, t]
+                self._set_rollout_state(state)
+            else:
+                u = self.u_scale * perturbed_actions[:, t]
+                state, u = self._dynamics(state, u, t)
             c = self._running_cost(state, u, t) # every time stes you get nsamples cost, we need that as output for the discount factor
-            # Update action if there were changes in M3P2I due for instance to suction constraints
-            self.perturbed_action[:,t] = u
-            cost_samples += c
             cost_horizon[:, t] = c 
+            if ws.rollout_dtype != self.dtype:
+                cost_horizon[:, t].nan_to_num_(posinf=cost_max)
+            if scripted:
+                continue
 
-            # Save total states/actions
-            states.append(state)
-            actions.append(u)
-            ee_state = (self.ee_l_state[:, :3] + self.ee_r_state[:, :3])/2 if self.ee_l_state != 'None' else 'None'
-            ee_states.append(ee_state) if ee_state != 'None' else []
-            
-        # Actions is K x T x nu
-        # States is K x T x nx
-        actions = torch.stack(actions, dim=-2)
-        states = torch.stack(states, dim=-2)
-        ee_states = torch.stack(ee_states, dim=-2) if ee_states != [] else 'None'
+            # Update action if there were changes in M3P2I due for instance to suction constraints
+            perturbed_actions[:,t] = u
+            # Save total states/actions, actions is K x T x nu and states is K x T x nx
+            if states is None:
+                states = ws.get_states(state.shape[-1])
+            states[:, t] = state
+            actions[:, t] = u
+            if self.record_ee_states and self.ee_l_state != 'None':
+                ee_states = ws.get_ee_states()
+                torch.add(self.ee_l_state[:, :3], self.ee_r_state[:, :3], out=ee_states[:, t]).div_(2)
+        return states, actions, ee_states, cost_horizon
+
+    def _set_rollout_state(self, state):
+        """
+            Hook for the states [K, nx] of one time step of a scripted rollout, before the running cost is evaluated
+        """
+        pass
 
-        # action perturbation cost
-        if self.terminal_state_cost:
-            c = self.terminal_state_cost(states, actions)
-            cost_samples += c
-        cost_total += cost_samples.mean(dim=0)
-        
-        if self.mppi_mode == 'halton-spline':
-            if self.multi_modal:
-                self.noise = self._update_multi_modal_distribution(cost_horizon, actions)
-            else:
-                self.noise = self._update_distribution(cost_horizon, actions)
-        return cost_total, states, actions, ee_states
+    def _scripted_rollout(self):
+        """
+            Whether the dynamics step through the horizon with their TorchScript rollout. Only the analytic
+            backends of dynamics.py have one, the running costs stay Python calls at every time step
+        """
+        if not self.compile_rollouts or self.F is None:
+            return False
+        if not hasattr(self.F, 'rollout'):
+            logger.warning("The dynamics have no scripted rollout, rollouts stay in eager mode")
+            self.compile_rollouts = False
+            return False
+        return True
 
     #################### Random Sampling ####################
     def _compute_total_cost_batch_simple(self):
@@ -344,7 +701,24 @@ class MPPI():
             Samples random noise and computes perturbed action sequence at each iteration. Returns total cost
         """
         # Resample noise each time we take an action
-        self.noise = self.noise_dist.sample((self.K, self.T))
+        if self.sample_method == 'colored':
+            # Unit colored noise correlated with the Cholesky factor of noise_sigma, as the white noise of noise_dist
+            colored = generate_colored_noise(self.K, self.T, self.noise_beta, device=self.device, float_dtype=self.dtype)
+            self.noise = self.noise_mu + colored @ self.noise_dist.scale_tril.T
+        elif self.use_noise_pool:
+            self.noise = self._pool_noise()
+        else:
+            self.noise = self.noise_dist.sample((self.K, self.T))
+        if self.antithetic:
+            self.noise = self.noise_mu + self._antithetic_pairs(self.noise - self.noise_mu)
+        if self.truncate_samples and self.u_min is not None:
+            # Truncated per element with the marginal standard deviations, the bounding below is then a no-op.
+            # The mass of the box is the same for all samples, so it cancels in the normalization of the weights
+            std = torch.sqrt(torch.diagonal(self.noise_sigma))
+            mean = self.U + self.noise_mu
+            z, _ = truncate_gaussian_samples((self.noise - self.noise_mu) / std, (self.u_min - mean) / std, (self.u_max - mean) / std)
+            self.noise = self.noise_mu + z * std
+        self.sample_noise_raw = self.noise
         # Broadcast own control to noise over samples; now it's K x T x nu
         self.perturbed_action = self.U + self.noise
         
@@ -369,6 +743,35 @@ class MPPI():
         self.cost_total += perturbation_cost
         return self.cost_total
 
+    def _active_action_dims(self):
+        """
+            Action dimensions whose noise is used, the others are overwritten after sampling in the simple mode
+        """
+        if self.robot == 'albert':
+            return torch.arange(11, self.nu, device=self.device)   # The arm, the base and its wheels are zeroed
+        elif self.robot == 'panda':
+            return torch.tensor([i for i in range(self.nu) if i != 8], device=self.device) # The second finger copies the first
+        return torch.arange(self.nu, device=self.device)
+
+    def _get_noise_pool(self, n):
+        N = self.noise_pool_size * self.K
+        if self.noise_pool is None or not self.noise_pool.matches(N, self.T, n, self.tensor_args):
+            self.noise_pool = NoisePool(N, self.T, n, self.tensor_args)
+        return self.noise_pool
+
+    def _pool_noise(self):
+        """
+            Noise [K, T, nu] of the simple mode from the noise pool, correlated with the Cholesky factor of the
+            covariance of the active action dimensions, which is computed once. Replaces noise_dist.sample
+        """
+        active = self._active_action_dims()
+        if self.pool_noise is None or self.pool_noise.shape[0] != self.K or self.pool_scale_tril.shape[0] != active.shape[0]:
+            self.pool_scale_tril = torch.linalg.cholesky(self.noise_sigma[active][:, active])
+            self.pool_noise = torch.zeros((self.K, self.T, self.nu), **self.tensor_args)
+        z = self._get_noise_pool(active.shape[0]).take(self.K)
+        self.pool_noise[..., active] = self.noise_mu[active] + z @ self.pool_scale_tril.T
+        return self.pool_noise
+
     def get_action_cost(self):
         if self.noise_abs_cost:
             action_cost = self.lambda_ * torch.abs(self.noise) @ self.noise_sigma_inv
@@ -390,24 +793,63 @@ class MPPI():
             Samples Halton splines once and then shifts mean according to control distribution. If random sampling is selected 
             then samples random noise at each step. Mean of control distribution is updated using gradient
         """
-        if self.sample_method == 'random':
+        self._sample_perturbed_actions()
+        self.cost_total, self.states, self.actions, self.ee_states = self._compute_rollout_costs(self.perturbed_action)
+
+        self.actions /= self.u_scale
+
+        # Update the moments of the control distribution
+        if self.mppi_mode == 'stein':
+            self.noise = self._update_stein_distribution(self.cost_horizon, self.actions)
+        elif self.multi_modal:
+            self.noise = self._update_multi_modal_distribution(self.cost_horizon, self.actions)
+        elif self.num_problems > 1:
+            self.noise = self._update_batch_distribution(self.cost_horizon, self.actions)
+        else:
+            self.noise = self._update_distribution(self.cost_horizon, self.actions)
+
+        action_cost = self.get_action_cost()
+
+        # Action perturbation cost
+        perturbation_cost = torch.sum(self.mean_action * action_cost, dim=(1, 2))
+        # if not self.multi_modal:
+        #     self.cost_total += perturbation_cost
+        return self.cost_total
+
+    def _sample_perturbed_actions(self):
+        """
+            Perturbs the current mean(s) with the scaled samples, the bounded result is self.perturbed_action [K, T, nu]
+        """
+        if self.sample_method in ['random', 'sobol', 'colored']:
             self.delta = self.get_samples(self.K, base_seed=0)
         elif self.delta == None and self.sample_method == 'halton':
             self.delta = self.get_samples(self.K, base_seed=0)
+
+        # Keeps the size but scales values by the standard deviations [T, nu], self.delta may be the read-only
+        # sample bank so it is not modified
+        delta = self._antithetic_pairs(self.delta) if self.antithetic else self.delta
+        std = self.scale_tril_modes[self.mode_idx] if self.per_mode_sampling else self.scale_tril
+        self.trunc_log_mass = None
+        if self.truncate_samples and self.u_min is not None and self.num_problems == 1:
+            # Samples within the bounds around the mean of their mode instead of clamped onto them
+            mean = self.mean_action_modes[self.mode_idx] if self.per_mode_sampling else self.mean_action
+            delta, log_mass = truncate_gaussian_samples(delta, (self.u_min - mean) / std, (self.u_max - mean) / std)
+            self.trunc_log_mass = torch.sum(log_mass, dim=(-2, -1)).expand(self.K)
+        scaled_delta = delta * std
         if self.robot == 'albert':
-            self.delta[:, :, 9:11] = 0
-            # self.delta[:, :, 12] = 0
+            scaled_delta[:, :, 9:11] = 0
+            # scaled_delta[:, :, 12] = 0
 
         # Add zero-noise seq so mean is always a part of samples
-        self.delta[-1,:,:] = self.Z_seq
-        # Keeps the size but scales values
-        scaled_delta = torch.matmul(self.delta, torch.diag(self.scale_tril)).view(self.delta.shape[0], self.T, self.nu)
+        scaled_delta[-1,:,:] = self.Z_seq
+        self.sample_noise_raw = scaled_delta
 
         # First time mean is zero then it is updated in the distribution
-        if self.multi_modal:
-            act_seq_1 = self.mean_action_1 + scaled_delta[:self.half_K, :, :]
-            act_seq_2 = self.mean_action_2 + scaled_delta[self.half_K:, :, :]
-            act_seq = torch.cat((act_seq_1, act_seq_2), 0)
+        if self.per_mode_sampling:
+            act_seq = self.mean_action_modes[self.mode_idx] + scaled_delta
+        elif self.num_problems > 1:
+            # Every problem perturbs its own mean with the same samples, [B*K, T, nu]
+            act_seq = (self.mean_action_batch.unsqueeze(1) + scaled_delta.unsqueeze(0)).view(-1, self.T, self.nu)
         else:
             act_seq = self.mean_action + scaled_delta
 
@@ -415,26 +857,227 @@ class MPPI():
         act_seq = scale_ctrl(act_seq, self.u_min, self.u_max, squash_fn=self.squash_fn)
         # print(act_seq.size())
 
+        self.log_iw = None
+        if self._reuse_active():
+            self._inject_elites(act_seq, delta)
+
         if self.multi_modal:
-            act_seq[0, :, :] = self.best_traj_1
-            act_seq[self.half_K, :, :] = self.best_traj_2
+            # The first sample of every mode is its best trajectory
+            act_seq[self.mode_start] = self.best_traj_modes
         
         self.perturbed_action = torch.clone(act_seq)
         if self.robot == 'panda':
             self.perturbed_action[:, :, 8] = self.perturbed_action[:, :, 7]
         elif self.robot == 'albert':
             self.perturbed_action[:, :, 9:11] = 0
+        return self.perturbed_action
 
-        self.cost_total, self.states, self.actions, self.ee_states = self._compute_rollout_costs(self.perturbed_action)
+    def _random_rows(self):
+        """
+            [K] mask of the samples that keep their random noise. Not random are the last sample (the mean or the
+            null action), the first sample of every mode in the multi-modal planner (its best trajectory) and the
+            reused elites
+        """
+        random = torch.ones(self.K, dtype=torch.bool, device=self.device)
+        random[-1] = False
+        if self.multi_modal:
+            random[self.mode_start] = False
+        elite_rows = self._elite_rows()
+        if elite_rows is not None:
+            random[elite_rows] = False
+        return random
 
-        self.actions /= self.u_scale
+    def _antithetic_pairs(self, delta):
+        """
+            Copy of the samples [K, T, nu] where every second random sample of a mode block (all samples in the
+            uni-modal planner) is the mirrored previous one, see _random_rows. Pairs are consecutive rows, so both
+            are evaluated in the same batch of rollouts. The noise of a pair sums to zero, which cancels its
+            contribution to the mean update when both have the same cost. The last random sample of a block with
+            an odd number of them stays unpaired
+        """
+        delta = delta.clone()
+        random = self._random_rows()
+        for block in (self.mode_slices if self.per_mode_sampling else [slice(0, self.K)]):
+            rows = torch.nonzero(random[block]).squeeze(1) + block.start
+            n = rows.shape[0] // 2
+            delta[rows[1:2 * n:2]] = -delta[rows[0:2 * n:2]]
+        return delta
+
+    def _control_variate(self, noise, evaluated=None):
+        """
+            W_r * mean_r(noise), over the random samples r of _random_rows with their total weight W_r, subtracted
+            from the weighted noise sum_k w_k noise_k of the mean update. noise are the scaled samples before the
+            bounding, whose sample mean is zero in expectation. A variance reduction heuristic, not an unbiased
+            control variate: W_r depends on the same noise, so the update shifts slightly, see bench_variance.py.
+            It removes the drift when the random samples have about the same cost.
+            Input: noise [K, T, nu] and an optional [K] mask of the evaluated samples, output [T, nu]
+        """
+        random = self._random_rows()
+        if evaluated is not None:
+            random = random & evaluated
+        return torch.sum(self.weights[random]) * torch.mean(noise[random], dim=0)
 
-        action_cost = self.get_action_cost()
+    def _reuse_active(self):
+        return self.reuse_elites > 0 and not self.per_mode_sampling and self.num_problems == 1
 
-        # Action perturbation cost
-        perturbation_cost = torch.sum(self.mean_action * action_cost, dim=(1, 2))
-        # if not self.multi_modal:
-        #     self.cost_total += perturbation_cost
+    def _elite_rows(self):
+        """
+            Rows of the reused elites, the last ones before the null action, or None when no elites are reused
+        """
+        if not self._reuse_active() or self.elite_actions is None or self.mppi_mode == 'simple':
+            return None
+        E = self.elite_actions.shape[0]
+        return slice(self.K - 1 - E, self.K - 1)
+
+    def _inject_elites(self, act_seq, delta):
+        """
+            Puts the shifted elites of the last tick in place of the last fresh samples before the null action and
+            computes their log importance weights log q_new(u) - log q_old(u), where q_old is the distribution they
+            were sampled from and q_new the current one. Both are diagonal Gaussians, the bounding of the actions
+            is ignored. Keeps the standardized noise of every sample for the elites of the next tick.
+            The elites are the best samples, not draws from q_old, and an elite kept over several ticks is compared
+            with the distribution it was first drawn from while the mean moves towards it. The ratio then grows
+            without bound and the elites take all the weight, so the log weights are truncated at max_log_iw:
+            with 0 an elite never weighs more than a fresh sample of the same cost
+        """
+        self.sample_noise = delta.clone() # [K, T, nu]
+        self.sample_log_std = torch.sum(torch.log(self.scale_tril)).repeat(self.K) # [K]
+        if self.trunc_log_mass is not None:
+            # Normalizer of the truncated Gaussian, so that q_new / q_old compares the truncated densities
+            self.sample_log_std = self.sample_log_std + self.trunc_log_mass
+        if self.elite_actions is None:
+            return
+
+        rows = self._elite_rows()
+        act_seq[rows] = self.elite_actions
+        noise_new = (self.elite_actions - self.mean_action) / self.scale_tril
+        log_q_new = -0.5 * torch.sum(noise_new ** 2, dim=(1, 2)) - self.sample_log_std[0]
+        log_q_old = -0.5 * torch.sum(self.elite_noise ** 2, dim=(1, 2)) - self.elite_log_std
+        self.log_iw = torch.zeros(self.K, **self.tensor_args)
+        self.log_iw[rows] = torch.clamp(log_q_new - log_q_old, max=self.max_log_iw)
+        self.sample_noise[rows] = self.elite_noise
+        self.sample_log_std[rows] = self.elite_log_std
+
+    def _store_elites(self, actions):
+        """
+            Keeps the E samples with the highest weights, the null action excluded, with their noise
+        """
+        E = min(self.reuse_elites, self.K - 1)
+        _, idx = torch.topk(self.weights[:self.K - 1], E)
+        self.elite_actions = actions[idx]
+        self.elite_noise = self.sample_noise[idx]
+        self.elite_log_std = self.sample_log_std[idx]
+        self.ess = 1. / torch.sum(self.weights ** 2)
+
+    def _compute_total_cost_iterations(self):
+        """
+            Runs up to num_iterations passes of _compute_total_cost_batch_halton, each one sampling around the mean
+            updated by the previous one. Stops early once the mean or the best cost converged, the number of
+            passes is stored in self.iterations
+        """
+        best_cost = None
+        for i in range(self.num_iterations):
+            # The updates assign new mean tensors, so the reference keeps the previous mean
+            prev_mean = self.mean_action
+            cost_total = self._compute_total_cost_batch_halton()
+            self.iterations = i + 1
+            if self.iterations == self.num_iterations:
+                break
+
+            prev_best, best_cost = best_cost, torch.min(cost_total).item()
+            mean_change = torch.max(torch.abs(self.mean_action - prev_mean)).item()
+            if mean_change < self.iteration_tol:
+                break
+            if prev_best is not None and abs(prev_best - best_cost) <= self.iteration_cost_tol * abs(prev_best):
+                break
+        return cost_total
+
+    #################### Anytime ####################
+    def _compute_total_cost_anytime(self, deadline, start_time):
+        """
+            Anytime version of _compute_total_cost_batch_halton. The rollouts are evaluated in chunks of
+            anytime_chunk_size until the sample budget is spent or the next chunk would miss the deadline.
+            The weights are accumulated chunk by chunk with a running minimum cost, so the mean update is the
+            one of _update_distribution restricted to the evaluated samples. Samples that were not evaluated
+            get zero weight.
+            The budget of the next tick is the number of samples expected to reach an effective sample size
+            (eta) of eta_max * K, limited by the chunks that fit in the deadline.
+            The control variate only runs over the evaluated samples
+        """
+        perturbed_action = self._sample_perturbed_actions()
+        K = self.K
+        chunk_size = min(self.anytime_chunk_size, K)
+        if self.sample_null_action:
+            perturbed_action[K - 1] = 0
+        # Smaller chunks start with the null action, the other samples follow in halton order
+        order = torch.arange(K, device=self.device)
+        if chunk_size < K:
+            order = torch.roll(order, 1)
+        budget = max(min(self.sample_budget, K), chunk_size)
+
+        costs = torch.full((K,), float('inf'), **self.tensor_args)
+        actions = torch.zeros_like(perturbed_action)
+        states = None
+        min_cost, eta, weighted_seq = None, 0, 0
+        n, chunks_time = 0, 0.
+        while n < budget:
+            rows = order[n:n + chunk_size]
+            elapsed = time.monotonic() - start_time
+            if n > 0 and elapsed + self.chunk_time > deadline:
+                break
+            chunk_start = time.monotonic()
+
+            _, chunk_states, chunk_actions, _ = self._compute_rollout_costs(perturbed_action[rows])
+            chunk_actions = chunk_actions / self.u_scale
+            traj_costs = cost_to_go(self.cost_horizon.to(self.dtype), self.gamma_seq)[:, 0] # [chunk] Costs for the next timestep
+
+            # Weights relative to the lowest cost so far, the accumulated sums are rescaled when it drops
+            chunk_min = torch.min(traj_costs)
+            if min_cost is None:
+                min_cost = chunk_min
+            elif chunk_min < min_cost:
+                rescale = torch.exp((-1.0/self.beta) * (min_cost - chunk_min))
+                eta, weighted_seq = eta * rescale, weighted_seq * rescale
+                min_cost = chunk_min
+            exp_ = torch.exp((-1.0/self.beta) * (traj_costs - min_cost))
+            eta = eta + torch.sum(exp_)
+            weighted_seq = weighted_seq + torch.sum(exp_.view(-1, 1, 1) * chunk_actions, dim=0)
+
+            costs[rows] = traj_costs
+            actions[rows] = chunk_actions
+            if states is None:
+                states = torch.zeros((K, self.T, chunk_states.shape[-1]), **self.tensor_args)
+            states[rows] = chunk_states
+            n += rows.shape[0]
+
+            chunk_time = time.monotonic() - chunk_start
+            self.chunk_time = chunk_time if self.chunk_time is None else 0.8 * self.chunk_time + 0.2 * chunk_time
+            chunks_time = chunks_time + chunk_time
+
+        self.samples_evaluated = n
+        self.total_costs = costs - min_cost
+        self.weights = torch.exp((-1.0/self.beta) * self.total_costs) / eta # [K], zero for the samples not evaluated
+        self.best_idx = torch.argmax(self.weights)
+        self.best_traj = actions[self.best_idx].to(self.dtype, copy=True)
+        new_mean = weighted_seq / eta
+        if self.control_variate:
+            evaluated = torch.zeros(K, dtype=torch.bool, device=self.device)
+            evaluated[order[:n]] = True
+            new_mean = new_mean - self._control_variate(self.sample_noise_raw, evaluated)
+        self.mean_action = (1.0 - self.step_size_mean) * self.mean_action +\
+            self.step_size_mean * new_mean
+        self.noise = actions - self.mean_action.unsqueeze(0)
+        if self.update_cov:
+            self.cov_action = self._update_cov(self.cov_action, self.weights, self.noise)
+            self.scale_tril = torch.sqrt(self.cov_action)
+        self.cost_total, self.states, self.actions, self.ee_states = costs, states, actions, 'None'
+
+        # Next budget, eta grows about linearly with the number of samples
+        budget = int(n * self.eta_max * K / eta.item())
+        overhead_time = time.monotonic() - start_time - chunks_time
+        self.overhead_time = 0.8 * self.overhead_time + 0.2 * overhead_time
+        time_budget = int((self.anytime_margin * deadline - self.overhead_time) / self.chunk_time) * chunk_size
+        self.sample_budget = max(chunk_size, min(budget, time_budget, K))
         return self.cost_total
 
     def _exp_util(self, costs):
@@ -442,26 +1085,21 @@ class MPPI():
            Calculate weights using exponential utility given cost
            Iuput: costs [K, T], costs within horizon
         """
-        traj_costs = cost_to_go(costs, self.gamma_seq) # [K, T]
+        traj_costs = cost_to_go(costs.to(self.dtype), self.gamma_seq) # [K, T]
         traj_costs = traj_costs[:,0] # [K] Costs for the next timestep
         total_costs = traj_costs - torch.min(traj_costs) #!! different from storm
+        if self.eta_target is not None:
+            self.beta = solve_temperature(total_costs.unsqueeze(0), self.eta_target, self.beta_iterations)[0][0]
         
-        # Normalization of the weights
-        exp_ = torch.exp((-1.0/self.beta) * total_costs)
+        # Normalization of the weights, reused samples are importance weighted against the current distribution
+        if self.log_iw is None:
+            exp_ = torch.exp((-1.0/self.beta) * total_costs)
+        else:
+            log_w = (-1.0/self.beta) * total_costs + self.log_iw
+            exp_ = torch.exp(log_w - torch.max(log_w))
         eta = torch.sum(exp_)       # tells how many significant samples we have, more or less
         self.weights = 1 / eta * exp_  # [K]
         # print('eta', eta)
-
-        # Update beta to make eta converge within the bounds 
-        if self.env_type == 'cube': # grady's thesis
-            eta_u_bound = 20
-            eta_l_bound = 10
-            beta_lm = 0.9
-            beta_um = 1.2
-            if eta > eta_u_bound:
-                self.beta = self.beta*beta_lm
-            elif eta < eta_l_bound:
-                self.beta = self.beta*beta_um
         
         self.total_costs = total_costs
 
@@ -471,6 +1109,15 @@ class MPPI():
             Depending on the method, the samples can be Halton or Random. Halton samples a 
             number of knots, later interpolated with a spline
         """
+        if(self.sample_method=='halton' and self.use_sample_bank):
+            try:
+                self.knot_points, self.samples = load_sample_bank(
+                    sample_shape, self.T, self.nu, self.knot_scale, self.degree,
+                    seed_val=self.seed_val, device=self.device, float_dtype=self.dtype)
+                return self.samples
+            except OSError as e:
+                logger.warning("Sample bank unavailable (%s), generating samples in memory", e)
+
         if(self.sample_method=='halton'):   # !!
             self.knot_points = generate_gaussian_halton_samples(
                 sample_shape,               # Number of samples
@@ -480,23 +1127,59 @@ class MPPI():
                 device=self.device,
                 float_dtype=self.dtype)
             
-            # Sample splines from knot points:
-            # iteratre over action dimension:
+            # Sample splines from knot points, all samples and action dimensions at once
             knot_samples = self.knot_points.view(sample_shape, self.nu, self.n_knots) # n knots is T/knot_scale (30/4 = 7)
-            self.samples = torch.zeros((sample_shape, self.T, self.nu), **self.tensor_args)
-            for i in range(sample_shape):
-                for j in range(self.nu):
-                    self.samples[i,:,j] = bspline(knot_samples[i,j,:], n=self.T, degree=self.degree)
+            self.samples = smoothing_bspline(knot_samples, self.spline_basis, self.degree).transpose(1, 2).contiguous() # [K, T, nu]
+
+        elif(self.sample_method == 'sobol'):
+            # The points are generated once, a shift modulo 1 gives other low-discrepancy points at every tick
+            if self.sobol_points is None or self.sobol_points.shape[0] != sample_shape:
+                self.sobol_points = generate_sobol_samples(sample_shape, self.ndims, seed_val=self.seed_val,
+                                                           device=self.device, float_dtype=self.dtype)
+            points = self.sobol_points
+            if self.sobol_shift:
+                points = torch.frac(points + torch.rand(self.ndims, **self.tensor_args))
+            self.knot_points = uniform_to_gaussian(points)
+            knot_samples = self.knot_points.view(sample_shape, self.nu, self.n_knots)
+            # degree + 1 knots (checked in set_mode), for which the interpolating splines of the basis are the
+            # smoothing splines of the halton sampler
+            self.samples = batched_bspline(knot_samples, self.spline_basis).transpose(1, 2).contiguous() # [K, T, nu]
 
         elif(self.sample_method == 'random'):
-            self.samples = self.noise_dist.sample((self.K, self.T))
+            # Unit normal samples, correlated and scaled with _random_sample_tril
+            if self.use_noise_pool:
+                self.samples = self._get_noise_pool(self.nu).take(self.K)
+            else:
+                self.samples = torch.randn((self.K, self.T, self.nu), **self.tensor_args)
+            tril = self._random_sample_tril()
+            if tril is not None:
+                self.samples = self.samples @ tril.T
+
+        elif(self.sample_method == 'colored'):
+            # Unit variance per time step like the unit normal samples of the random sampler, correlated in time
+            self.samples = generate_colored_noise(self.K, self.T, self.noise_beta, device=self.device, float_dtype=self.dtype)
+            tril = self._random_sample_tril()
+            if tril is not None:
+                self.samples = self.samples @ tril.T
         
         return self.samples
  
+    def _random_sample_tril(self):
+        """
+            Factor the unit random and colored samples of the halton-spline mode are multiplied with, before the
+            scaling with scale_tril. With a fixed covariance it is the Cholesky factor of noise_sigma: the samples are
+            noise_dist samples as they always were, and the perturbations have the variances noise_sigma * scale_tril^2,
+            i.e. the squares of the noise_sigma entries for a diagonal one (and of those of the halton samples).
+            With update_cov the adapted covariance is the one of the perturbations, so only the correlation of
+            noise_sigma is kept (None when it is diagonal). Turning update_cov on thus starts from the variances
+            noise_sigma instead
+        """
+        return self.corr_tril if self.update_cov else self.noise_dist.scale_tril
+
     def _update_distribution(self, costs, actions):
         """
             Update moments using sample trajectories.
-            So far only mean is updated, eventually one could also update the covariance
+            The diagonal covariance is only adapted with update_cov, see _update_cov
         """
 
         self._exp_util(costs)
@@ -504,10 +1187,12 @@ class MPPI():
         # Update best action
         best_idx = torch.argmax(self.weights)
         self.best_idx = best_idx
-        self.best_traj = torch.index_select(actions, 0, best_idx).squeeze(0)
+        self.best_traj = torch.index_select(actions, 0, best_idx).squeeze(0).to(self.dtype)
        
         weighted_seq = self.weights.view(-1, 1, 1) * actions # [K, T, nu]
         new_mean = torch.sum(weighted_seq, dim=0)
+        if self.control_variate:
+            new_mean = new_mean - self._control_variate(self.sample_noise_raw)
 
         # Gradient update for the mean
         self.mean_action = (1.0 - self.step_size_mean) * self.mean_action +\
@@ -518,14 +1203,179 @@ class MPPI():
 
         #Update Covariance
         if self.update_cov:
-            #Diagonal covariance of size AxA
-            weighted_delta = self.weights * (delta ** 2).T
-            # cov_update = torch.diag(torch.mean(torch.sum(weighted_delta.T, dim=0), dim=0))
-            cov_update = torch.mean(torch.sum(weighted_delta.T, dim=0), dim=0)
-    
-            self.cov_action = (1.0 - self.step_size_cov) * self.cov_action + self.step_size_cov * cov_update
-            self.cov_action += self.kappa #* self.init_cov_action
-            # self.cov_action[self.cov_action < 0.0005] = 0.0005
+            self.cov_action = self._update_cov(self.cov_action, self.weights, delta)
             self.scale_tril = torch.sqrt(self.cov_action)
 
-        return delta
\ No newline at end of file
+        if self._reuse_active():
+            self._store_elites(actions)
+        return delta
+
+    def _allocate_mode_samples(self, traj_costs):
+        """
+            Shifts samples between the modes for the next tick, from the running averages of the best cost of every
+            mode and of the effective sample size (sum w)^2 / sum(w^2) of its samples under the weights of all samples.
+            The shares are softmax(-(best - min best) / temperature + log(1 + ess)), on top of the min_mode_fraction
+            of K that every mode keeps so that it can recover.
+            Input: traj_costs [K]
+        """
+        M = self.num_modes
+        mode_costs = torch.where(self.mode_mask[:-1], traj_costs, torch.full_like(traj_costs, float('inf')))
+        best_cost = torch.min(mode_costs, dim=1)[0] # [M]
+        mode_mass = torch.zeros(M, **self.tensor_args).index_add_(0, self.mode_idx, self.weights)
+        mode_mass_sq = torch.zeros(M, **self.tensor_args).index_add_(0, self.mode_idx, self.weights ** 2)
+        ess = mode_mass ** 2 / mode_mass_sq.clamp(min=1e-30)
+        if self.mode_best_cost is None:
+            self.mode_best_cost, self.mode_ess = best_cost, ess
+        else:
+            decay = self.mode_alloc_decay
+            self.mode_best_cost = decay * self.mode_best_cost + (1 - decay) * best_cost
+            self.mode_ess = decay * self.mode_ess + (1 - decay) * ess
+
+        temperature = self.beta if self.mode_alloc_temperature is None else self.mode_alloc_temperature
+        scores = -(self.mode_best_cost - torch.min(self.mode_best_cost)) / temperature + torch.log1p(self.mode_ess)
+        shares = torch.softmax(scores, dim=0).tolist()
+
+        min_samples = max(2, min(int(self.min_mode_fraction * self.K), self.K // M))
+        free = self.K - M * min_samples
+        counts = [min_samples + int(share * free) for share in shares]
+        counts[int(np.argmax(shares))] += self.K - sum(counts)
+        if counts != self.mode_counts:
+            self.set_num_modes(M, counts)
+
+    #################### Gradient Refinement ####################
+    def _mean_cost(self, actions):
+        """
+            Discounted cost of the rollout of one action sequence [T, nu] from the current state, differentiable
+            with respect to the actions when the dynamics and costs are torch functions
+        """
+        state = self.state.view(1, -1)
+        states, costs = [], []
+        for t in range(self.T):
+            state, u = self._dynamics(state, actions[t:t+1], t)
+            states.append(state)
+            costs.append(self._running_cost(state, u, t))
+        costs = torch.stack(costs, dim=1).to(self.dtype) # [1, T]
+        if self.terminal_state_cost:
+            costs[:, -1] = costs[:, -1] + self.terminal_state_cost(torch.stack(states, dim=1), actions.unsqueeze(0))
+        return cost_to_go(costs, self.gamma_seq)[0, 0]
+
+    def _refine_mean(self):
+        """
+            Polishes the mean with refine_steps projected gradient steps (Adam, then clamped to u_min/u_max) through
+            the rollout of the mean sequence. The best sequence found is kept. Stores the cost decrease, the time
+            and the decrease per ms in refine_improvement, refine_time and refine_rate
+        """
+        start_time = time.monotonic()
+        actions = self.mean_action.detach().clone().requires_grad_(True)
+        optimizer = torch.optim.Adam([actions], lr=self.refine_lr)
+        best_actions, best_cost, initial_cost = None, None, None
+        with torch.enable_grad():
+            for _ in range(self.refine_steps):
+                cost = self._mean_cost(actions)
+                if best_cost is None or cost.item() < best_cost:
+                    best_actions, best_cost = actions.detach().clone(), cost.item()
+                initial_cost = cost.item() if initial_cost is None else initial_cost
+                optimizer.zero_grad()
+                cost.backward()
+                optimizer.step()
+                with torch.no_grad():
+                    actions.copy_(scale_ctrl(actions, self.u_min, self.u_max, squash_fn=self.squash_fn))
+        with torch.no_grad():
+            cost = self._mean_cost(actions).item()
+        if cost < best_cost:
+            best_actions, best_cost = actions.detach().clone(), cost
+
+        self.mean_action = best_actions
+        self.refine_improvement = initial_cost - best_cost
+        self.refine_time = (time.monotonic() - start_time) * 1000
+        self.refine_rate = self.refine_improvement / self.refine_time
+
+    #################### Stein Variational ####################
+    def _update_stein_distribution(self, costs, actions):
+        """
+            Stein variational update of the particle means theta [P, T, nu] (mean_action_modes). The gradient of the
+            log likelihood of every particle is estimated from its own samples with the MPPI weights,
+            g = sum_k w_k (u_k - theta) / sigma^2, and the particles move along
+            phi_i = 1/P sum_j k(theta_j, theta_i) g_j + grad_theta_j k(theta_j, theta_i),
+            with an RBF kernel of median bandwidth. The second term pushes the particles apart.
+            The step is preconditioned with the covariance, so that one particle takes the MPPI mean update.
+            The particle with the highest likelihood estimate becomes the mean.
+            Input: costs [K, T], actions [K, T, nu]
+        """
+        P = self.num_modes
+        traj_costs = cost_to_go(costs.to(self.dtype), self.gamma_seq)[:, 0] # [K] Costs for the next timestep
+        mode_costs = torch.where(self.mode_mask[:-1], traj_costs, torch.full_like(traj_costs, float('inf')))
+        # Weights within every particle, relative to the best sample of all particles so that their likelihoods compare
+        log_w = (-1.0/self.beta) * (mode_costs - torch.min(traj_costs)) # [P, K]
+        log_lik = torch.logsumexp(log_w, dim=1) - torch.log(self.mode_mask[:-1].sum(dim=1).to(self.dtype)) # [P]
+        sample_weights = torch.sum(torch.softmax(log_w, dim=1), dim=0) # [K] normalized within every particle
+
+        # MPPI gradient estimate of the log likelihood of every particle
+        theta = self.mean_action_modes
+        weighted_noise = sample_weights.view(-1, 1, 1) * (actions - theta[self.mode_idx])
+        score = torch.zeros_like(theta).index_add_(0, self.mode_idx, weighted_noise) / self.cov_action_modes
+
+        # RBF kernel between the particles, with the median heuristic for the bandwidth
+        x = theta.view(P, -1)
+        sq_dist = torch.cdist(x, x) ** 2 # [P, P]
+        pair_dist = sq_dist[~torch.eye(P, dtype=torch.bool, device=self.device)]
+        h = torch.clamp(torch.median(pair_dist) / math.log(P + 1), min=1e-6) if P > 1 else 1.
+        kernel = torch.exp(-sq_dist / h)
+        # sum_j grad_theta_j k(theta_j, theta_i) = 2/h (theta_i sum_j k_ji - sum_j k_ji theta_j)
+        repulsion = 2 / h * (x * kernel.sum(dim=0).unsqueeze(1) - kernel.T @ x)
+        phi = (kernel.T @ score.view(P, -1) + repulsion).view_as(theta) / P
+        self.mean_action_modes = scale_ctrl(theta + self.stein_step * self.cov_action_modes * phi, self.u_min, self.u_max,
+                                            squash_fn=self.squash_fn)
+
+        # Weights of all samples for the top trajectories, and the best particle as the mean
+        self._exp_util(costs)
+        self.best_idx = torch.argmax(self.weights)
+        self.best_traj = actions[self.best_idx].to(self.dtype)
+        self.particle_log_lik = log_lik
+        self.mean_action = self.mean_action_modes[torch.argmax(log_lik)].clone()
+        return actions - self.mean_action.unsqueeze(0)
+
+    def _update_cov(self, cov_action, weights, delta, mode_idx=None):
+        """
+            Steps the diagonal covariance [T, nu] towards the weighted variance of delta [K, T, nu] around the
+            updated mean, with a floor of kappa. With the modes mode_idx [K] of the samples, the covariances
+            [M, T, nu] of the modes are updated from their own samples
+        """
+        weighted_delta = weights.view(-1, 1, 1) * delta ** 2
+        if mode_idx is None:
+            cov_update = torch.sum(weighted_delta, dim=0) # [T, nu]
+        else:
+            cov_update = torch.zeros_like(cov_action).index_add_(0, mode_idx, weighted_delta) # [M, T, nu]
+        cov_action = (1.0 - self.step_size_cov) * cov_action + self.step_size_cov * cov_update
+        return torch.clamp(cov_action, min=self.kappa)
+
+    def _update_batch_distribution(self, costs, actions):
+        """
+            Update the means of the B problems of command_batch, each from its own K samples.
+            The problems share the samples, so the covariance is not adapted in batch mode.
+            Input: costs [B*K, T], actions [B*K, T, nu]
+        """
+        B = self.num_problems
+        traj_costs = cost_to_go(costs.to(self.dtype), self.gamma_seq)[:, 0].view(B, self.K) # [B, K] Costs for the next timestep
+        total_costs = traj_costs - torch.min(traj_costs, dim=1, keepdim=True)[0]
+
+        # Normalization of the weights per problem
+        exp_ = torch.exp((-1.0/self.beta) * total_costs)
+        eta = torch.sum(exp_, dim=1, keepdim=True)
+        self.weights = exp_ / eta # [B, K]
+        self.total_costs = total_costs
+
+        # Update best action of every problem
+        actions = actions.view(B, self.K, self.T, self.nu)
+        self.best_idx = torch.argmax(self.weights, dim=1)
+        best_idx = self.best_idx.view(B, 1, 1, 1).expand(B, 1, self.T, self.nu)
+        self.best_traj_batch = torch.gather(actions, 1, best_idx).squeeze(1).to(self.dtype)
+
+        new_mean = torch.sum(self.weights.view(B, self.K, 1, 1) * actions, dim=1) # [B, T, nu]
+
+        # Gradient update for the means
+        self.mean_action_batch = (1.0 - self.step_size_mean) * self.mean_action_batch +\
+            self.step_size_mean * new_mean
+
+        delta = actions - self.mean_action_batch.unsqueeze(1)
+        return delta.view(B * self.K, self.T, self.nu)
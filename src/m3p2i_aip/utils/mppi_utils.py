@@ -21,10 +21,18 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.#
 
+import os
+import math
+import warnings
 import numpy as np
 import torch
+import scipy.interpolate as si
 from torch.distributions.multivariate_normal import MultivariateNormal
-import ghalton
+try:
+    import ghalton
+except ImportError:
+    # Only needed to generate halton samples with use_ghalton, the sobol sampler works without it
+    ghalton = None
 
 def scale_ctrl(ctrl, action_lows, action_highs, squash_fn='clamp'):
     if len(ctrl.shape) == 1:
@@ -86,7 +94,8 @@ def generate_halton_samples(num_samples, ndims, bases=None, use_ghalton=True, se
         for dim in range(ndims):
             samples[:, dim] = generate_van_der_corput_samples_batch(idx_batch, bases[dim])
     else:
-        
+        if ghalton is None:
+            raise ImportError("ghalton is required for halton samples with use_ghalton, install it or use the sobol sampler")
         if ndims <= 100:
             perms = ghalton.EA_PERMS[:ndims]
             sequencer = ghalton.GeneralizedHalton(perms)
@@ -103,6 +112,305 @@ def generate_gaussian_halton_samples(num_samples, ndims, bases=None, use_ghalton
     
     return gaussian_halton_samples
 
+def generate_sobol_samples(num_samples, ndims, seed_val=123, device=torch.device('cpu'), float_dtype=torch.float64):
+    """
+        Scrambled Sobol points [num_samples, ndims] in [0, 1). Balanced for num_samples a power of two
+    """
+    engine = torch.quasirandom.SobolEngine(ndims, scramble=True, seed=seed_val)
+    return engine.draw(num_samples, dtype=float_dtype).to(device=device)
+
+def uniform_to_gaussian(samples):
+    """
+        Maps points in [0, 1) to standard normal samples with the inverse normal cdf
+    """
+    eps = torch.finfo(samples.dtype).eps
+    return math.sqrt(2.0) * torch.erfinv(torch.clamp(2 * samples - 1, -1 + eps, 1 - eps))
+
+def generate_colored_noise(num_samples, T, beta, device=torch.device('cpu'), float_dtype=torch.float64):
+    """
+        Power-law noise [num_samples, T, nu] with a power spectral density 1/f^beta[i] along T for every action
+        dimension i, unit variance per time step. beta = 0 is white noise, larger exponents are smoother.
+        Spectra drawn in the frequency domain and transformed with irfft, as colorednoise.powerlaw_psd_gaussian,
+        with the frequencies below 1/T set to 1/T
+    """
+    beta = torch.as_tensor(beta, device=device, dtype=float_dtype).view(-1) # [nu]
+    freqs = torch.fft.rfftfreq(T, device=device, dtype=float_dtype).clamp(min=1. / T)
+    scale = freqs.unsqueeze(1) ** (-beta / 2) # [T//2 + 1, nu]
+
+    # Standard deviation of the time samples, to normalize them
+    w = scale[1:].clone()
+    w[-1] *= (1 + (T % 2)) / 2.
+    sigma = 2 * torch.sqrt(torch.sum(w**2, dim=0)) / T # [nu]
+
+    real = torch.randn((num_samples, *scale.shape), device=device, dtype=float_dtype) * scale
+    imag = torch.randn((num_samples, *scale.shape), device=device, dtype=float_dtype) * scale
+    # The zero frequency, and the Nyquist frequency for even T, are real
+    if T % 2 == 0:
+        imag[:, -1] = 0
+        real[:, -1] *= math.sqrt(2)
+    imag[:, 0] = 0
+    real[:, 0] *= math.sqrt(2)
+    return torch.fft.irfft(torch.complex(real, imag), n=T, dim=1) / sigma
+
+def truncate_gaussian_samples(samples, lower, upper):
+    """
+        Maps standard normal samples elementwise to samples of the standard normal truncated to [lower, upper],
+        z -> Phi^-1(Phi(lower) + Phi(z) (Phi(upper) - Phi(lower))). The map is monotone, so the ranks and the
+        smoothness of spline or colored samples are kept. Returns the samples and the log of the mass
+        Phi(upper) - Phi(lower) of every interval
+    """
+    eps = torch.finfo(samples.dtype).eps
+    cdf_lower, cdf_upper = torch.special.ndtr(lower), torch.special.ndtr(upper)
+    mass = torch.clamp(cdf_upper - cdf_lower, min=eps)
+    cdf = cdf_lower + torch.special.ndtr(samples) * mass
+    return torch.special.ndtri(torch.clamp(cdf, eps, 1 - eps)), torch.log(mass)
+
+def bspline_basis(n_knots, n=100, degree=3, device=torch.device('cpu'), float_dtype=torch.float64):
+    """
+        Knot-to-horizon basis matrix [n, n_knots] of the spline used by bspline, so that the splines
+        of any batch of knots are obtained with a single matmul, see batched_bspline.
+        The basis is the interpolating spline (s=0), which is exactly what bspline returns when
+        n_knots == degree + 1. With more knots bspline smooths (s=0.5), see smoothing_bspline.
+    """
+    t_arr = np.linspace(0, n_knots, n_knots)
+    xx = np.linspace(0, n_knots, n)
+    basis = np.zeros((n, n_knots))
+    for i in range(n_knots):
+        spl = si.splrep(t_arr, np.eye(n_knots)[i], k=degree, s=0)
+        basis[:, i] = si.splev(xx, spl, ext=3)
+    return torch.as_tensor(basis, device=device, dtype=float_dtype)
+
+def batched_bspline(knots, basis):
+    """
+        Interpolates knots [..., n_knots] to splines [..., n] with a basis from bspline_basis
+    """
+    return torch.matmul(knots, basis.T)
+
+def smoothing_bspline(knots, basis, degree=3):
+    """
+        Splines [..., n] of knots [..., n_knots] as bspline returns them, i.e. smoothing splines with s=0.5.
+        With n_knots == degree + 1 they are the interpolating splines of the basis, one matmul for all knots.
+        With more knots the smoothing depends on the knot values, so every spline is fitted with scipy
+        (at T=20, 5 knots, the interpolating splines differ by 0.25 on average for unit normal knots)
+    """
+    n_knots, n = knots.shape[-1], basis.shape[0]
+    if n_knots == degree + 1:
+        return batched_bspline(knots, basis)
+    t_arr = np.linspace(0, n_knots, n_knots)
+    xx = np.linspace(0, n_knots, n)
+    splines = [si.splev(xx, si.splrep(t_arr, k, k=degree, s=0.5), ext=3) for k in knots.reshape(-1, n_knots).cpu().numpy()]
+    return torch.as_tensor(np.stack(splines), device=knots.device, dtype=knots.dtype).view(*knots.shape[:-1], n)
+
+###############
+## Filtering ##
+###############
+
+def savgol_coeffs(window_length, polyorder, device=torch.device('cpu'), float_dtype=torch.float64):
+    """
+        Savitzky-Golay fit matrix [window_length, window_length]. Row i evaluates at position i the
+        polynomial fitted to a window, so the middle row is the convolution kernel and the outer rows
+        reproduce the 'interp' edge handling of scipy.signal.savgol_filter
+    """
+    half_window = window_length // 2
+    z = np.arange(window_length) - half_window
+    vander = np.vander(z, polyorder + 1, increasing=True)
+    coeffs = vander @ np.linalg.pinv(vander)
+    return torch.as_tensor(coeffs, device=device, dtype=float_dtype)
+
+def savgol_filter(x, coeffs):
+    """
+        Filters x [..., T, nu] along T with coefficients from savgol_coeffs, any leading batch dimensions
+        are filtered in the same call. Equivalent to scipy.signal.savgol_filter(x, axis=-2, mode='interp')
+    """
+    window_length = coeffs.shape[0]
+    half_window = window_length // 2
+    T, nu = x.shape[-2], x.shape[-1]
+    if T < window_length:
+        raise ValueError("The filter window ({}) must not exceed the sequence length ({})".format(window_length, T))
+    batch_shape = x.shape[:-2]
+
+    # Interior points as one 1-D convolution over all sequences and action dimensions
+    x_seq = x.transpose(-1, -2).reshape(-1, 1, T)
+    interior = torch.nn.functional.conv1d(x_seq, coeffs[half_window].view(1, 1, -1))
+    interior = interior.view(*batch_shape, nu, T - 2 * half_window).transpose(-1, -2)
+
+    # Edges evaluate the polynomial fitted to the first and last window
+    left = torch.matmul(coeffs[:half_window], x[..., :window_length, :])
+    right = torch.matmul(coeffs[half_window + 1:], x[..., T - window_length:, :])
+    return torch.cat((left, interior, right), dim=-2)
+
+#################
+## Sample Bank ##
+#################
+
+def get_sample_bank_paths(num_samples, T, nu, knot_scale, degree, seed_val, float_dtype, cache_dir=None):
+    """
+        Paths of the cached knots and splines, keyed by the planner configuration
+    """
+    if cache_dir is None:
+        from m3p2i_aip.utils.path_utils import get_cache_path
+        cache_dir = os.path.join(get_cache_path(), 'sample_bank')
+    # The splines are the smoothing splines of smoothing_bspline
+    key = 'halton_smooth_K{}_T{}_nu{}_ks{}_deg{}_seed{}_{}'.format(num_samples, T, nu, knot_scale, degree, seed_val,
+                                                           str(float_dtype).split('.')[-1])
+    return os.path.join(cache_dir, key + '_knots.npy'), os.path.join(cache_dir, key + '_splines.npy')
+
+def _save_npy_atomic(path, array):
+    # Write to a private file first so concurrent planners never load a partial cache
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+def load_sample_bank(num_samples, T, nu, knot_scale, degree, seed_val=0, device=torch.device('cpu'), float_dtype=torch.float32, cache_dir=None):
+    """
+        Returns the Gaussian halton knots [K, n_knots*nu] and their splines [K, T, nu] from the on-disk
+        sample bank, generating and storing them on the first call for a configuration.
+        The cache is memory-mapped read-only, so planner processes on one host share one copy of the
+        pages. The returned tensors share that memory on cpu and must not be modified in place.
+    """
+    knots_path, splines_path = get_sample_bank_paths(num_samples, T, nu, knot_scale, degree, seed_val, float_dtype, cache_dir)
+    if not (os.path.exists(knots_path) and os.path.exists(splines_path)):
+        n_knots = T // knot_scale
+        knot_points = generate_gaussian_halton_samples(num_samples, n_knots * nu, use_ghalton=True, seed_val=seed_val, float_dtype=float_dtype)
+        basis = bspline_basis(n_knots, n=T, degree=degree, float_dtype=float_dtype)
+        samples = smoothing_bspline(knot_points.view(num_samples, nu, n_knots), basis, degree).transpose(1, 2)
+        os.makedirs(os.path.dirname(knots_path), exist_ok=True)
+        _save_npy_atomic(knots_path, knot_points.numpy())
+        _save_npy_atomic(splines_path, samples.contiguous().numpy())
+
+    with warnings.catch_warnings():
+        # torch warns about the non-writable memory map, the bank is read-only by design
+        warnings.simplefilter('ignore', UserWarning)
+        knot_points = torch.from_numpy(np.load(knots_path, mmap_mode='r'))
+        samples = torch.from_numpy(np.load(splines_path, mmap_mode='r'))
+    return knot_points.to(device=device), samples.to(device=device)
+
+################
+## Noise Pool ##
+################
+
+class NoisePool():
+    """
+        Unit normal noise [N, 2T, n] generated once for a configuration, from which take(K) returns [K, T, n] at
+        every tick without drawing new normals: every sequence comes from its own random row, starting at its own
+        random time offset within T, with a random sign for every dimension. The rows are drawn independently,
+        so two sequences only repeat (up to the signs) when they hit the same row and offset, with probability
+        1 / (N (T + 1)) per pair. The sequences are gathered into a preallocated buffer that is overwritten at the
+        next take
+    """
+    def __init__(self, N, T, n, tensor_args, seed_val=None):
+        generator = torch.Generator(device=tensor_args['device'])
+        if seed_val is None:
+            generator.seed()
+        else:
+            generator.manual_seed(seed_val)
+        self.N, self.T, self.n = N, T, n
+        self.tensor_args = tensor_args
+        self.pool = torch.randn((N, 2 * T, n), generator=generator, **tensor_args)
+        self.steps = torch.arange(T, device=tensor_args['device'])
+        self.buffer = None
+
+    def matches(self, N, T, n, tensor_args):
+        return (self.N, self.T, self.n) == (N, T, n) and self.tensor_args['dtype'] == tensor_args['dtype']
+
+    def take(self, K):
+        device = self.tensor_args['device']
+        rows = torch.randint(self.N, (K, 1), device=device)
+        offsets = torch.randint(self.T + 1, (K, 1), device=device)
+        signs = torch.randint(0, 2, (K, 1, self.n), device=device).mul_(2).sub_(1)
+        if self.buffer is None or self.buffer.shape[0] != K:
+            self.buffer = torch.zeros((K, self.T, self.n), **self.tensor_args)
+        # Rows of the pool flattened to [N * 2T, n]
+        idx = (rows * (2 * self.T) + offsets + self.steps).view(-1)
+        torch.index_select(self.pool.view(-1, self.n), 0, idx, out=self.buffer.view(-1, self.n))
+        return self.buffer.mul_(signs)
+
+###############
+## Workspace ##
+###############
+
+class RolloutWorkspace():
+    """
+        Preallocated [K, T, .] buffers of one planner configuration. The rollouts write into them in place,
+        so that a steady-state planner tick does not construct new tensors. K counts all rollout rows,
+        i.e. B*K when several problems are planned at once.
+        States, actions and the cost horizon are stored in rollout_dtype (defaults to the dtype of tensor_args),
+        the total costs stay in the dtype of tensor_args
+    """
+    def __init__(self, K, T, nu, tensor_args, rollout_dtype=None):
+        self.K, self.T, self.nu = K, T, nu
+        self.rollout_dtype = tensor_args['dtype'] if rollout_dtype is None else rollout_dtype
+        self.tensor_args = {'device':tensor_args['device'], 'dtype':self.rollout_dtype}
+        self.cost_total = torch.zeros(K, **tensor_args)
+        self.cost_horizon = torch.zeros([K, T], **self.tensor_args)
+        self.actions = torch.zeros([K, T, nu], **self.tensor_args)
+        self.state = None       # [K, nx] initial states of the rollouts
+        self.states = None      # [K, T, nx], nx is only known after the first dynamics step
+        self.ee_states = None   # [K, T, 3]
+
+    def matches(self, K, T, nu, rollout_dtype=None):
+        return (self.K, self.T, self.nu) == (K, T, nu) and rollout_dtype in (None, self.rollout_dtype)
+
+    def nbytes(self):
+        """
+            Memory of the [K, T, .] buffers allocated so far
+        """
+        buffers = [self.cost_horizon, self.actions, self.states, self.ee_states]
+        return sum(b.numel() * b.element_size() for b in buffers if b is not None)
+
+    def get_state(self, state):
+        """
+            Copies the initial state [nx], the states of B problems [B, nx] or the states of all rollouts [K, nx]
+            to the rollouts, each problem occupies a contiguous block of K/B rows
+        """
+        nx = state.shape[-1]
+        if self.state is None or self.state.shape[-1] != nx:
+            self.state = torch.zeros([self.K, nx], **self.tensor_args)
+        n = state.numel() // nx
+        # Broadcast copies that also convert to float16 give wrong values on the CPU, the dtype is converted first
+        self.state.view(n, -1, nx).copy_(state.to(self.rollout_dtype).view(n, 1, nx))
+        return self.state
+
+    def get_states(self, nx):
+        if self.states is None or self.states.shape[-1] != nx:
+            self.states = torch.zeros([self.K, self.T, nx], **self.tensor_args)
+        return self.states
+
+    def get_ee_states(self):
+        if self.ee_states is None:
+            self.ee_states = torch.zeros([self.K, self.T, 3], **self.tensor_args)
+        return self.ee_states
+
+#################
+## Temperature ##
+#################
+
+def solve_temperature(costs, eta_target, iterations=16, beta_range=(1e-6, 1e3)):
+    """
+        Temperatures beta [M] such that the weights exp(-costs / beta) of every row of costs [M, K] sum to
+        eta_target, i.e. about eta_target samples are significant. The costs are shifted to a minimum of zero per
+        row, inf marks the samples that do not belong to a row.
+        Bisection on log(beta) in beta_range times the cost spread of every row, with log-sum-exp and a fixed
+        number of iterations, so all rows are solved at once without synchronizing with the device.
+        Returns beta [M], eta [M] and the unnormalized weights exp_ [M, K]
+    """
+    costs = costs - torch.min(costs, dim=-1, keepdim=True)[0]
+    spread = torch.amax(torch.nan_to_num(costs, posinf=0), dim=-1).clamp(min=1e-6) # [M]
+    log_target = math.log(eta_target)
+    lo = torch.log(spread * beta_range[0])
+    hi = torch.log(spread * beta_range[1])
+    for _ in range(iterations):
+        mid = 0.5 * (lo + hi)
+        log_eta = torch.logsumexp(-costs / torch.exp(mid).unsqueeze(-1), dim=-1)
+        # eta grows with beta
+        too_many = log_eta > log_target
+        hi = torch.where(too_many, mid, hi)
+        lo = torch.where(too_many, lo, mid)
+    beta = torch.exp(0.5 * (lo + hi))
+    exp_ = torch.exp(-costs / beta.unsqueeze(-1))
+    return beta, torch.sum(exp_, dim=-1), exp_
+
 def cost_to_go(cost_seq, gamma_seq):
     """
         Calculate (discounted) cost to go for given cost sequence
@@ -20,6 +20,11 @@ def get_plot_path():
     path = os.path.join(scripts_path,'plot')
     return path
 
+def get_cache_path():
+    # Shared by all planner processes on the host, can be moved with M3P2I_CACHE_DIR
+    path = os.environ.get('M3P2I_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'm3p2i_aip'))
+    return path
+
 def load_yaml(file_path):
     with open(file_path) as file:
         yaml_params = yaml.load(file, Loader=yaml.FullLoader)
@@ -0,0 +1,77 @@
+import torch, time, types
+from m3p2i_aip.planners.motion_planner import m3p2i
+from m3p2i_aip.planners.motion_planner.dynamics import PointPushDynamics
+
+# Planners and scenarios on the analytic dynamics backends, without IsaacGym: navigation of the mobile robots and a
+# scripted push of a block to the origin. Used by the benchmarks in scripts/benchmarks, by scripts/train_value.py to
+# log rollouts, and by the tests
+
+# CPU friendly copies of the mobile robot params files, with the analytic dynamics backend
+def make_params(robot='point_robot', num_envs=200, horizon=15, device='cpu'):
+    tensor_args = {'device':device, 'dtype':torch.float32}
+    params = types.SimpleNamespace(
+        robot=robot, num_envs=num_envs, horizon=horizon, tensor_args=tensor_args,
+        dynamics_backend="analytic", environment_type="normal", dt=0.05,
+        step_dependent_dynamics=True, terminal_state_cost=None, sample_null_action=True,
+        use_priors=False, u_per_command=horizon, filter_u=True, suction_active=False,
+        block_index=7, kp_suction=400, print_flag=False)
+    if robot == 'point_robot':
+        params.nx = 4
+        params.noise_sigma = torch.tensor([[3, 0], [0, 3]], **tensor_args)
+        params.u_max = torch.tensor([3, 3], **tensor_args)
+    elif robot == 'heijn':
+        params.nx = 6
+        params.noise_sigma = torch.tensor([[3, 0, 0], [0, 3, 0], [0, 0, 5]], **tensor_args)
+        params.u_max = torch.tensor([1.5, 1.5, 3.5], **tensor_args)
+    elif robot == 'boxer':
+        params.nx = 5
+        params.noise_sigma = torch.tensor([[15, 0], [0, 15]], **tensor_args)
+        params.u_max = torch.tensor([2.5, 5.5], **tensor_args)
+    params.u_min = -params.u_max
+    return params
+
+def make_planner(params, task='navigation', goal=(3., 3.), sample_method='sobol', multi_modal=False, dynamics=None, anytime=False):
+    planner = m3p2i.M3P2I(params, dynamics)
+    planner.set_mode(mppi_mode='halton-spline', sample_method=sample_method, multi_modal=multi_modal, anytime=anytime)
+    planner.update_task(task, torch.tensor(goal, **params.tensor_args))
+    return planner
+
+def initial_state(params):
+    nx = {'point_robot':4, 'heijn':6, 'boxer':5}[params.robot]
+    return torch.zeros(nx, **params.tensor_args)
+
+# Robot and block start positions of the scripted push, the robot has to get around the block first in the last two
+push_starts = [((-1.5, -1.5), (-0.8, -0.8)), ((-2., 0.5), (-1., 0.3)), ((1., -2.), (0.8, -1.)), ((0., 2.), (0., 1.)), ((1., 1.8), (1.2, 0.9))]
+
+def make_push_params(num_envs=200, horizon=15):
+    params = make_params('point_robot', num_envs=num_envs, horizon=horizon)
+    params.nx = 6
+    return params
+
+def make_push_planner(params, sample_method='sobol', multi_modal=False, dynamics=None):
+    # Pushes the block to the origin, planned with PointPushDynamics unless another model is given
+    dynamics = PointPushDynamics(params.dt) if dynamics is None else dynamics
+    return make_planner(params, task='push', goal=(0., 0.), sample_method=sample_method, multi_modal=multi_modal, dynamics=dynamics)
+
+def push_state(robot_start, block_start, params):
+    return torch.tensor([robot_start[0], 0., robot_start[1], 0., block_start[0], block_start[1]], **params.tensor_args)
+
+def push_episode(planner, params, robot_start, block_start, ticks=300, tol=0.15, system=None, on_tick=None):
+    """
+        Closed-loop push from the start positions, the first action of every command is executed on system (the
+        dynamics of the planner by default) and on_tick(planner, state) is called with the new state. Returns the
+        success, the number of ticks and the mean command time in seconds
+    """
+    system = planner.F if system is None else system
+    state = push_state(robot_start, block_start, params)
+    tick_times = []
+    for tick in range(ticks):
+        start_time = time.monotonic()
+        action = planner.command(state)
+        tick_times.append(time.monotonic() - start_time)
+        state = system(state.unsqueeze(0), action[:1])[0][0]
+        if on_tick is not None:
+            on_tick(planner, state)
+        if torch.linalg.norm(state[4:]).item() < tol:
+            return True, tick + 1, sum(tick_times) / len(tick_times)
+    return False, ticks, sum(tick_times) / len(tick_times)
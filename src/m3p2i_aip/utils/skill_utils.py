@@ -1,5 +1,9 @@
 import torch, numpy as np, scipy.interpolate as si
 
+# Wheel radius and distance between the wheels of the differential drive bases
+wheel_radius = 0.08
+wheel_base = 2 * 0.157
+
 def _ensure_non_zero(cost, beta, factor):
     return torch.exp(-factor * (cost - beta))
 
@@ -22,7 +26,7 @@ def bspline(c_arr, t_arr=None, n=100, degree=3):
     return samples
 
 # Calculate the suction force
-def calculate_suction(block_pos, robot_pos, num_envs, kp_suction, block_index, bodies_per_env):
+def calculate_suction(block_pos, robot_pos, num_envs, kp_suction, block_index, bodies_per_env, forces=None):
     # Calculate the direction and magnitude between the block and robot 
     dir_vector = block_pos - robot_pos # [num_envs, 2]
     magnitude = 1/torch.linalg.norm(dir_vector, dim=1) # [num_envs]
@@ -32,7 +36,11 @@ def calculate_suction(block_pos, robot_pos, num_envs, kp_suction, block_index, b
 
     # Form the suction force
     unit_force = dir_vector*magnitude  # [num_envs, 2] Same as the unit direction of pulling force
-    forces = torch.zeros((num_envs, bodies_per_env, 3), dtype=torch.float32, device='cuda:0', requires_grad=False)
+    # Reuse the given [num_envs, bodies_per_env, 3] buffer if any
+    if forces is None:
+        forces = torch.zeros((num_envs, bodies_per_env, 3), dtype=torch.float32, device=block_pos.device, requires_grad=False)
+    else:
+        forces.zero_()
     
     # Start suction only when close
     # The different thresholds for real and sim envs are due to the inconsistency of 
@@ -55,7 +63,7 @@ def calculate_suction(block_pos, robot_pos, num_envs, kp_suction, block_index, b
     forces[mask, -1, 0] = kp_suction*unit_force[mask, 0]
     forces[mask, -1, 1] = kp_suction*unit_force[mask, 1]
     # Add clamping to control input
-    forces = torch.clamp(forces, min=-500, max=500)
+    forces.clamp_(min=-500, max=500)
 
     return forces, -unit_force, mask
 
@@ -64,8 +72,8 @@ def apply_fk(robot, u):
     '''
     u has the size of [dofs_per_robot]
     '''
-    r = 0.08
-    L = 2 * 0.157
+    r = wheel_radius
+    L = wheel_base
     if robot == 'boxer':
         # Diff drive fk
         u_fk = u.clone()
@@ -85,8 +93,8 @@ def apply_ik(robot, u):
     '''
     u has the size of [num_envs, dofs_per_robot]
     '''
-    r = 0.08
-    L = 2 * 0.157
+    r = wheel_radius
+    L = wheel_base
     if robot == 'boxer':
         # Diff drive fk
         u_ik = u.clone()
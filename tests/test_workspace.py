@@ -0,0 +1,51 @@
+import collections, functools
+import pytest
+import torch
+from m3p2i_aip.utils import scenario_utils
+
+# Steady-state planner ticks write into the preallocated RolloutWorkspace and construct no tensors. The random number
+# draws of the samplers that draw fresh samples at every tick are not constructions of the planner and are not counted
+constructors = ['tensor', 'as_tensor', 'zeros', 'ones', 'empty', 'full', 'arange', 'eye',
+                'zeros_like', 'ones_like', 'empty_like', 'full_like']
+
+@pytest.fixture
+def constructions(monkeypatch):
+    counts = collections.Counter()
+    counting = [False]
+    def hook(name, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if counting[0]:
+                counts[name] += 1
+            return fn(*args, **kwargs)
+        return wrapper
+    for name in constructors:
+        monkeypatch.setattr(torch, name, hook(name, getattr(torch, name)))
+    return counts, counting
+
+def count_ticks(command, state, constructions, warmup=3, ticks=5):
+    counts, counting = constructions
+    for _ in range(warmup):
+        command(state)
+    counting[0] = True
+    for _ in range(ticks):
+        command(state)
+    counting[0] = False
+    return dict(counts)
+
+@pytest.mark.parametrize('sample_method', ['sobol', 'random'])
+def test_command_constructs_no_tensors(sample_method, constructions):
+    torch.manual_seed(0)
+    params = scenario_utils.make_params('point_robot', num_envs=50)
+    planner = scenario_utils.make_planner(params, sample_method=sample_method)
+    state = scenario_utils.initial_state(params)
+    assert count_ticks(planner.command, state, constructions) == {}
+
+def test_command_batch_constructs_no_tensors(constructions):
+    torch.manual_seed(0)
+    params = scenario_utils.make_params('point_robot', num_envs=50)
+    planner = scenario_utils.make_planner(params, sample_method='sobol')
+    B = 4
+    planner.update_task('navigation', torch.tensor([3., 3.]).repeat(B, 1))
+    state = scenario_utils.initial_state(params).repeat(B, 1)
+    assert count_ticks(planner.command_batch, state, constructions) == {}